@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+""" Measures the time needed to build an encrypted message stanza.
+
+Usage: PYTHONPATH=src python benchmarks/bench_stanza_builders.py
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import timeit
+
+from mock import MagicMock
+
+# the prof module is only available inside profanity
+sys.modules['prof'] = MagicMock()
+
+from profanity_omemo_plugin import xmpp  # noqa: E402
+
+# sizes of a serialized WhisperMessage and PreKeyWhisperMessage key
+KEY_SIZE = 90
+PREKEY_SIZE = 190
+
+DEVICE_COUNTS = [1, 10, 200]
+ROUNDS = 2000
+
+
+def create_msg_data(device_count):
+    keys = {}
+    for rid in range(device_count):
+        prekey = rid % 10 == 0
+        key = os.urandom(PREKEY_SIZE if prekey else KEY_SIZE)
+        keys[100000 + rid] = (key, prekey)
+
+    return {'sid': 4711,
+            'keys': keys,
+            'jid': 'juliet@capulet.lit',
+            'iv': os.urandom(16),
+            'payload': os.urandom(140)}
+
+
+def main():
+    print('{0:>8} {1:>14}'.format('devices', 'usec/message'))
+    for device_count in DEVICE_COUNTS:
+        msg_data = create_msg_data(device_count)
+
+        def build():
+            xmpp.build_encrypted_message('romeo@montague.lit/profanity',
+                                         'juliet@capulet.lit', msg_data,
+                                         msg_id='msg-1')
+
+        seconds = min(timeit.repeat(build, number=ROUNDS, repeat=3))
+        print('{0:>8} {1:>14.1f}'.format(device_count,
+                                         seconds / ROUNDS * 1000000))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,20 +23,40 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import binascii
+import os
+import uuid
 from functools import wraps
 
 import prof
 
 import profanity_omemo_plugin.xmpp as xmpp
+from profanity_omemo_plugin.announcer import DevicelistAnnouncer
 from profanity_omemo_plugin.constants import (NS_DEVICE_LIST_NOTIFY,
                                               SETTINGS_GROUP,
                                               OMEMO_DEFAULT_ENABLED,
                                               OMEMO_DEFAULT_MESSAGE_CHAR,
+                                              OMEMO_DEFAULT_LOG_LEVEL,
+                                              OMEMO_DEFAULT_PREFETCH,
+                                              OMEMO_LOG_DUMP_PATH,
+                                              ANNOUNCE_INTERVAL,
+                                              LOG_FLUSH_INTERVAL,
+                                              MAINTENANCE_INTERVAL,
+                                              PREFETCH_INTERVAL,
+                                              SCHEDULER_INTERVAL,
                                               PLUGIN_NAME)
-from profanity_omemo_plugin.log import get_plugin_logger
+from profanity_omemo_plugin.log import (LOG_LEVELS, ShortStanza,
+                                        dropped_log_records, dump_log,
+                                        flush_log, get_plugin_logger,
+                                        set_log_level)
 from profanity_omemo_plugin.prof_omemo_state import (ProfOmemoState,
                                                      ProfOmemoUser,
                                                      ProfActiveOmemoChats)
+from profanity_omemo_plugin.prefetch import SessionPrefetcher
+from profanity_omemo_plugin.request_tracker import RequestTracker
+from profanity_omemo_plugin.scheduler import (PRIORITY_BACKGROUND,
+                                              PRIORITY_CHAT, PRIORITY_SESSION,
+                                              OutboundScheduler)
+from profanity_omemo_plugin.weak_message_store import WeakMessageStore
 
 log = get_plugin_logger(__name__)
 
@@ -45,15 +65,27 @@ log = get_plugin_logger(__name__)
 # Convenience methods
 ################################################################################
 
-def send_stanza(stanza):
+class ProfOutboundScheduler(OutboundScheduler):
+    """ Hands scheduled stanzas to profanity. """
+
+    def post(self, stanza):
+        log.debug('Sending Stanza: %s', ShortStanza(stanza))
+        prof.send_stanza(stanza)
+
+
+_scheduler = ProfOutboundScheduler()
+
+
+def send_stanza(stanza, validate=True, priority=PRIORITY_SESSION):
     """ Sends a stanza via profanity
 
-    Ensures the stanza is valid XML before sending.
+    Ensures the stanza is valid XML before sending, stanzas built by the
+    plugin itself are sent with validate=False. The stanza is sent by the
+    outbound scheduler, after all stanzas of a higher priority.
     """
 
-    if xmpp.stanza_is_valid_xml(stanza):
-        log.debug('Sending Stanza: {}'.format(stanza))
-        prof.send_stanza(stanza)
+    if not validate or xmpp.stanza_is_valid_xml(stanza):
+        _scheduler.send(stanza, priority)
         return True
 
     return False
@@ -127,10 +159,116 @@ def _set_omemo_message_char(char):
     prof.settings_string_set(SETTINGS_GROUP, 'message_char', char)
 
 
+def _get_omemo_log_level():
+    return prof.settings_string_get(
+        SETTINGS_GROUP, 'log_level', OMEMO_DEFAULT_LOG_LEVEL)
+
+
+def _set_omemo_log_level(level):
+    try:
+        set_log_level(level)
+    except ValueError:
+        prof.cons_show('Log level must be one of: {0}'.format(
+            ', '.join(sorted(LOG_LEVELS))))
+        return
+
+    prof.cons_show('OMEMO Log Level: {0}'.format(level.lower()))
+    prof.settings_string_set(SETTINGS_GROUP, 'log_level', level.lower())
+
+
+def _get_omemo_prefetch_setting():
+    return prof.settings_boolean_get(
+        SETTINGS_GROUP, 'prefetch', OMEMO_DEFAULT_PREFETCH)
+
+
+def _set_omemo_prefetch_setting(enabled):
+    msg = 'Prefetch sessions: {0}'.format(enabled)
+    log.debug(msg)
+    prof.cons_show(msg)
+    prof.settings_boolean_set(SETTINGS_GROUP, 'prefetch', enabled)
+
+    if enabled and ProfOmemoUser().account:
+        _start_prefetch()
+
+
+def _dump_log(count=None):
+    if count is not None:
+        try:
+            count = int(count)
+        except ValueError:
+            prof.cons_show('Number of log records must be a number.')
+            return
+
+    dump_root = os.path.dirname(OMEMO_LOG_DUMP_PATH)
+    if not os.path.isdir(dump_root):
+        os.makedirs(dump_root)
+
+    written = dump_log(OMEMO_LOG_DUMP_PATH, count)
+    prof.cons_show('Wrote {0} log records to {1}'.format(
+        written, OMEMO_LOG_DUMP_PATH))
+
+    dropped = dropped_log_records()
+    if dropped:
+        prof.cons_show('{0} log records were dropped.'.format(dropped))
+
+
+class ProfWeakMessageStore(WeakMessageStore):
+    """ Sends queued messages once sessions with all devices are built. """
+
+    def post_message(self, stanza, message_dict):
+        send_stanza(stanza, validate=False, priority=PRIORITY_CHAT)
+        show_chat_info(message_dict['to'], 'Queued message sent.')
+
+    def on_timeout(self, message_dict):
+        msg = 'Message was not sent, sessions could not be built: {0}'
+        show_chat_critical(message_dict['to'],
+                           msg.format(message_dict['message']))
+
+
+class ProfSessionPrefetcher(SessionPrefetcher):
+    """ Requests devicelists and bundles through the request tracker. """
+
+    def query_device_list(self, jid):
+        return _query_device_list(jid, priority=PRIORITY_BACKGROUND)
+
+    def query_bundle(self, jid, device_id):
+        return _query_bundle_info_for(jid, device_id,
+                                      priority=PRIORITY_BACKGROUND)
+
+
+class ProfDevicelistAnnouncer(DevicelistAnnouncer):
+    """ Publishes the own devicelist. """
+
+    def publish(self):
+        _announce_own_devicelist()
+
+
+_message_store = ProfWeakMessageStore()
+_requests = RequestTracker()
+_prefetcher = ProfSessionPrefetcher()
+_announcer = ProfDevicelistAnnouncer()
+
+# the second init stage waits for the own devicelist after connecting
+_init_pending = False
+# bundle publishes waiting for the server result, id -> (node, hash)
+_pending_publishes = {}
+
+
 ################################################################################
 # Decorators
 ################################################################################
 
+def parse_stanza(func):
+    """ Hands the hook a :py:class:`xmpp.Stanza`, which is parsed at most
+    once no matter how many helpers look at it.
+    """
+    @wraps(func)
+    def func_wrapper(stanza):
+        return func(xmpp.Stanza(ensure_unicode_stanza(stanza)))
+
+    return func_wrapper
+
+
 def require_sessions_for_all_devices(attrib, else_return=None):
     def wrapper(func):
         @wraps(func)
@@ -144,23 +282,19 @@ def require_sessions_for_all_devices(attrib, else_return=None):
                 log.error('Recipient not valid.')
                 return else_return
 
-            log.info('Checking Sessions for {0}'.format(recipient))
-            state = ProfOmemoState()
-            uninitialized_devices = state.devices_without_sessions(contat_jid)
-
-            own_jid = ProfOmemoUser.account
-            own_uninitialized = state.devices_without_sessions(own_jid)
-
-            uninitialized_devices += own_uninitialized
-
-            if not uninitialized_devices:
-                log.info('Recipient {0} has all sessions set up.'.format(recipient))
+            log.info('Checking Sessions for %s', recipient)
+            if not _query_missing_bundles(contat_jid):
+                log.info('Recipient %s has all sessions set up.', recipient)
                 return func(stanza)
 
             _query_device_list(contat_jid)
-            _query_device_list(own_jid)
-            log.warning('No Session found for user: {0}.'.format(recipient))
-            prof.notify('Failed to send last Message.', 5000, 'Profanity Omemo Plugin')
+            _query_device_list(ProfOmemoUser.account)
+            log.warning('No Session found for user: %s.', recipient)
+
+            body = xmpp.get_body(stanza)
+            if (body is not None
+                    and ProfActiveOmemoChats.account_is_active(contat_jid)):
+                _queue_message(contat_jid, body)
             return else_return
 
         return func_wrapper
@@ -189,24 +323,173 @@ def omemo_enabled(else_return=None):
 ################################################################################
 
 def _init_omemo():
+    global _init_pending
+
     account = ProfOmemoUser().account
     if account:
         # subscribe to devicelist updates
-        log.info('Adding Disco Feature {0}.'.format(NS_DEVICE_LIST_NOTIFY))
+        log.info('Adding Disco Feature %s.', NS_DEVICE_LIST_NOTIFY)
         # subscribe to device list updates
         prof.disco_add_feature(NS_DEVICE_LIST_NOTIFY)
 
-        log.debug('Announcing own bundle info.')
-        _announce_own_devicelist()  # announce own device list
-        _announce_own_bundle()  # announce own bundle
+        # we query our own devices to add possible other devices we own,
+        # the rest of the init runs in _finish_init once they arrived
+        _init_pending = True
+        _requests.forget(account)
+        if not _query_device_list(account):
+            _finish_init(False)
+
 
-        # we query our own devices to add possible other devices we own
-        _query_device_list(account)
+def _finish_init(devicelist_received):
+    """ Second init stage, runs once the own devicelist was received from
+        the server or could not be fetched.
 
+        The devicelist handler already announces the own device if it is
+        missing, so only the bundle is published here and only if it changed
+        since it was last published or our device is not on the server.
+    """
+    global _init_pending
 
-def _announce_own_bundle():
-    own_bundle_stanza = xmpp.create_own_bundle_stanza()
-    send_stanza(own_bundle_stanza)
+    if not _init_pending:
+        return
+    _init_pending = False
+
+    omemo_state = ProfOmemoState()
+    if not devicelist_received:
+        _announcer.announce()
+
+    # connecting is a good moment for a due SignedPreKey rotation,
+    # the bundle is announced right after anyway
+    omemo_state.rotate_signed_prekey_if_due()
+
+    published = devicelist_received and omemo_state.own_device_id_published()
+    _announce_own_bundle(force=not published)
+
+    if _get_omemo_prefetch_setting():
+        _start_prefetch()
+
+
+def _start_prefetch():
+    """ Queue the contacts with known OMEMO support and the remembered
+        OMEMO chats for the session prefetch.
+    """
+    account = ProfOmemoUser().account
+    jids = [account]
+    jids.extend(prof.settings_string_list_get(SETTINGS_GROUP,
+                                              'omemo_sessions') or [])
+    jids.extend(ProfOmemoState().store.getDeviceListJids())
+
+    _prefetcher.add(jids)
+    log.info('Prefetching sessions for %s contacts', len(_prefetcher))
+
+
+def _drain_stanzas():
+    """ Called by profanity every SCHEDULER_INTERVAL seconds, sends the
+        stanzas waiting for the rate limit.
+    """
+    if _scheduler:
+        _scheduler.drain()
+
+
+def _show_stats():
+    prof.cons_show('Outbound stanzas:')
+    for stats in _scheduler.stats():
+        prof.cons_show(
+            '  {name}: {depth} queued (max {max_depth}), {sent} sent, '
+            'wait avg {avg_ms:.0f} ms / max {max_ms:.0f} ms'.format(
+                avg_ms=stats['avg_wait'] * 1000,
+                max_ms=stats['max_wait'] * 1000, **stats))
+    prof.cons_show('Queued messages: {0}'.format(len(_message_store)))
+    prof.cons_show('Suppressed devicelist announcements: {0}'.format(
+        _announcer.suppressed))
+
+    ciphers = ProfOmemoState().session_ciphers
+    prof.cons_show('Session ciphers: {0} of {1} cached, {2} hits, '
+                   '{3} misses, {4} evicted'.format(
+                       len(ciphers), ciphers.maxsize, ciphers.hits,
+                       ciphers.misses, ciphers.evictions))
+
+
+def _run_announcer():
+    """ Called by profanity every ANNOUNCE_INTERVAL seconds, publishes
+        the own devicelist if an announcement was suppressed.
+    """
+    if _announcer and ProfOmemoUser().account:
+        _announcer.run()
+
+
+def _run_prefetch():
+    """ Called by profanity every PREFETCH_INTERVAL seconds, sends the
+        next prefetch requests.
+    """
+    if not _prefetcher or not ProfOmemoUser().account:
+        return
+
+    if not _get_omemo_prefetch_setting():
+        _prefetcher.clear()
+        return
+
+    try:
+        _prefetcher.run()
+    except Exception:
+        log.exception('Session prefetch failed.')
+
+
+def _announce_own_bundle(force=True):
+    """ Publish the own bundle, unless force is False and the bundle did
+        not change since it was last published successfully.
+    """
+    node = xmpp.own_bundle_node()
+    bundle_hash = xmpp.own_bundle_hash()
+    if not force and \
+            ProfOmemoState().store.getPublishedHash(node) == bundle_hash:
+        log.info('Own bundle is unchanged, not announcing it.')
+        return
+
+    log.debug('Announcing own bundle info.')
+    req_id = str(uuid.uuid4())
+    own_bundle_stanza = xmpp.create_own_bundle_stanza(req_id=req_id)
+    _pending_publishes[req_id] = (node, bundle_hash)
+    send_stanza(own_bundle_stanza, validate=False)
+
+
+def _handle_publish_result(node, bundle_hash, stanza):
+    if stanza.root.get('type') == 'result':
+        ProfOmemoState().store.setPublishedHash(node, bundle_hash)
+    else:
+        log.warning('Publishing %s failed', node)
+
+
+def _run_maintenance():
+    """ Periodic housekeeping, called by profanity every
+        MAINTENANCE_INTERVAL seconds.
+    """
+    if not ProfOmemoUser().account:
+        return
+
+    try:
+        omemo_state = ProfOmemoState()
+
+        # Rotate the SignedPreKey and add PreKeys generated in the
+        # background, the bundle is published once if anything changed.
+        bundle_changed = omemo_state.rotate_signed_prekey_if_due()
+        if omemo_state.checkPreKeyAmount():
+            bundle_changed = True
+
+        if bundle_changed:
+            log.info('Bundle changed, announcing own bundle.')
+            _announce_own_bundle()
+
+        _message_store.expire()
+        _requests.expire()
+
+        # the own devicelist query timed out, requests are keyed by
+        # (jid, device_id) and devicelist queries have no device id
+        account = ProfOmemoUser().account
+        if _init_pending and (account, None) not in _requests:
+            _finish_init(False)
+    except Exception:
+        log.exception('Plugin maintenance failed.')
 
 
 def _show_no_trust_mgmt_header(jid):
@@ -243,7 +526,7 @@ def _start_omemo_session(jid):
     show_chat_info(jid, 'OMEMO Session started.')
     _show_no_trust_mgmt_header(jid)
 
-    log.info('Query Devicelist for {0}'.format(jid))
+    log.info('Query Devicelist for %s', jid)
     _query_device_list(jid)
 
     prof.settings_string_list_add(SETTINGS_GROUP, 'omemo_sessions', jid)
@@ -267,12 +550,12 @@ def _end_omemo_session(jid):
 # Stanza handling
 ################################################################################
 
-def _handle_devicelist_update(stanza):
+def _handle_devicelist_update(stanza, sender_jid=None):
     omemo_state = ProfOmemoState()
     own_jid = omemo_state.own_jid
-    msg_dict = xmpp.unpack_devicelist_info(stanza)
+    msg_dict = xmpp.unpack_devicelist_info(stanza, sender_jid=sender_jid)
     sender_jid = msg_dict['from']
-    log.info('Received devicelist update from {0}'.format(sender_jid))
+    log.info('Received devicelist update from %s', sender_jid)
 
     known_devices = omemo_state.device_list_for(sender_jid)
     new_devices = msg_dict['devices']
@@ -283,27 +566,34 @@ def _handle_devicelist_update(stanza):
         device_str = ', '.join([str(d) for d in added_devices])
         msg = '{0} added devices with IDs {1}'.format(sender_jid, device_str)
         show_chat_warning(sender_jid, msg)
-        xmpp.update_devicelist(own_jid, sender_jid, new_devices)
 
-    if not omemo_state.own_device_id_published():
-        _announce_own_devicelist()
+    # only the changes are written, unchanged lists cost nothing
+    xmpp.update_devicelist(own_jid, sender_jid, new_devices)
+
+    published = omemo_state.own_device_id_published()
+    if sender_jid == own_jid:
+        _announcer.received(published)
+
+    if not published:
+        _announcer.announce()
 
     if sender_jid != own_jid:
         add_recipient_to_completer(sender_jid)
 
 
 def add_recipient_to_completer(recipient):
-    log.info('Adding {} to the completer.'.format(recipient))
+    log.info('Adding %s to the completer.', recipient)
     prof.completer_add('/omemo start', [recipient])
     prof.completer_add('/omemo show_devices', [recipient])
     prof.completer_add('/omemo fingerprints', [recipient])
     prof.completer_add('/omemo reset_devicelist', [recipient])
 
 
-def _handle_bundle_update(stanza):
+def _handle_bundle_update(stanza, sender=None, device_id=None):
     log.info('Bundle Information received.')
     omemo_state = ProfOmemoState()
-    bundle_info = xmpp.unpack_bundle_info(stanza)
+    bundle_info = xmpp.unpack_bundle_info(stanza, sender=sender,
+                                          device_id=device_id)
 
     if not bundle_info:
         log.error('Could not unpack bundle info.')
@@ -314,7 +604,7 @@ def _handle_bundle_update(stanza):
 
     try:
         omemo_state.build_session(sender, device_id, bundle_info)
-        log.info('Session built with user: {0}:{1}'.format(sender, device_id))
+        log.info('Session built with user: %s:%s', sender, device_id)
         prof.completer_add('/omemo end', [sender])
     except Exception as e:
         msg_tmpl = 'Could not build session with {0}:{1}. {2}:{3}'
@@ -322,27 +612,98 @@ def _handle_bundle_update(stanza):
         log.error(msg)
         return
 
+    # a session with an own device completes the sessions of every recipient
+    _message_store.trigger()
+
 
 def _announce_own_devicelist():
     fulljid = ProfOmemoUser().fulljid
     query_msg = xmpp.create_devicelist_update_msg(fulljid)
     log.info('Announce own device list.')
-    log.info(query_msg)
-    send_stanza(query_msg)
+    log.debug('%s', ShortStanza(query_msg))
+    send_stanza(query_msg, validate=False)
+
 
+def _query_bundle_info_for(recipient, deviceid, priority=PRIORITY_SESSION):
+    """ Request the bundle of a device, unless the same request is still
+    in flight or backing off.
 
-def _query_bundle_info_for(recipient, deviceid):
-    log.info('Query Bundle for {0}:{1}'.format(recipient, deviceid))
+    :returns: True if the request was sent
+    """
     account = ProfOmemoUser().account
-    stanza = xmpp.create_bundle_request_stanza(account, recipient, deviceid)
-    send_stanza(stanza)
+    req_id = _requests.start(recipient, deviceid, requester=account)
+    if req_id is None:
+        log.debug('Bundle for %s:%s already requested', recipient, deviceid)
+        return False
+
+    log.info('Query Bundle for %s:%s', recipient, deviceid)
+    stanza = xmpp.create_bundle_request_stanza(account, recipient, deviceid,
+                                               req_id=req_id)
+    return send_stanza(stanza, validate=False, priority=priority)
 
 
-def _query_device_list(contact_jid):
-    log.info('Query Device list for {0}'.format(contact_jid))
+def _query_device_list(contact_jid, priority=PRIORITY_SESSION):
+    """ Request the devicelist of a contact, unless the same request is
+    still in flight or backing off.
+
+    :returns: True if the request was sent
+    """
     fulljid = ProfOmemoUser().fulljid
-    query_msg = xmpp.create_devicelist_query_msg(fulljid, contact_jid)
-    send_stanza(query_msg)
+    req_id = _requests.start(contact_jid, requester=fulljid)
+    if req_id is None:
+        log.debug('Device list for %s already requested', contact_jid)
+        return False
+
+    log.info('Query Device list for %s', contact_jid)
+    query_msg = xmpp.create_devicelist_query_msg(fulljid, contact_jid,
+                                                 req_id=req_id)
+    return send_stanza(query_msg, validate=False, priority=priority)
+
+
+def _query_missing_bundles(barejid):
+    """ Request the bundles of the devices of barejid and of the own
+        account which have no session yet.
+
+    :returns: True if any session is missing
+    """
+    omemo_state = ProfOmemoState()
+    uninitialzed_devices = omemo_state.devices_without_sessions(barejid)
+
+    # devices with a request in flight are skipped, notify only about
+    # new requests
+    requested = [d for d in uninitialzed_devices
+                 if _query_bundle_info_for(barejid, d)]
+
+    if requested:
+        d_str = ', '.join([str(d) for d in requested])
+        msg = 'Requesting bundles for missing devices {0}'.format(d_str)
+
+        log.info(msg)
+        prof.notify(msg, 5000, 'Profanity Omemo Plugin')
+
+    own_jid = ProfOmemoUser.account
+    own_uninitialized = omemo_state.devices_without_sessions(own_jid)
+
+    requested = [d for d in own_uninitialized
+                 if _query_bundle_info_for(own_jid, d)]
+
+    if requested:
+        d_str = ', '.join([str(d) for d in requested])
+        msg = 'Requesting own bundles for missing devices {0}'.format(d_str)
+
+        log.info(msg)
+        prof.notify(msg, 5000, 'Profanity Omemo Plugin')
+
+    return bool(uninitialzed_devices or own_uninitialized)
+
+
+def _queue_message(barejid, message):
+    """ Keep the message until the sessions with all devices are built. """
+    _message_store.add({'from': ProfOmemoUser.fulljid,
+                        'to': barejid,
+                        'message': message})
+    if _message_store.has_messages_for(barejid):
+        show_chat_info(barejid, 'Message queued: {0}'.format(message))
 
 
 ################################################################################
@@ -350,20 +711,19 @@ def _query_device_list(contact_jid):
 ################################################################################
 
 @omemo_enabled()
+@parse_stanza
 @require_sessions_for_all_devices('to')
 def prof_on_message_stanza_send(stanza):
-    stanza = ensure_unicode_stanza(stanza)
-
     contact_jid = xmpp.get_recipient(stanza)
     if not ProfActiveOmemoChats.account_is_active(contact_jid):
-        log.debug('Chat not activated for {0}'.format(contact_jid))
+        log.debug('Chat not activated for %s', contact_jid)
         return None
 
     try:
         if xmpp.is_xmpp_plaintext_message(stanza):
-            encrypted_stanza = xmpp.encrypt_stanza(stanza)
-            if xmpp.stanza_is_valid_xml(encrypted_stanza):
-                return encrypted_stanza
+            # the encrypted stanza is built from escaped values only and
+            # needs no validation
+            return xmpp.encrypt_stanza(stanza)
     except Exception as e:
         log.exception('Could not encrypt message')
 
@@ -383,34 +743,15 @@ def prof_pre_chat_message_send(barejid, message):
         return message
 
     if not ProfActiveOmemoChats.account_is_active(barejid):
-        log.info('Chat not activated for {0}'.format(barejid))
+        log.debug('Chat not activated for %s', barejid)
         return message
 
-    omemo_state = ProfOmemoState()
-    uninitialzed_devices = omemo_state.devices_without_sessions(barejid)
-
-    if uninitialzed_devices:
-        d_str = ', '.join([str(d) for d in uninitialzed_devices])
-        msg = 'Requesting bundles for missing devices {0}'.format(d_str)
-
-        log.info(msg)
-        prof.notify(msg, 5000, 'Profanity Omemo Plugin')
-
-        for device in uninitialzed_devices:
-            _query_bundle_info_for(barejid, device)
-
-    own_jid = ProfOmemoUser.account
-    own_uninitialized = omemo_state.devices_without_sessions(own_jid)
-
-    if own_uninitialized:
-        d_str = ', '.join([str(d) for d in own_uninitialized])
-        msg = 'Requesting own bundles for missing devices {0}'.format(d_str)
-
-        log.info(msg)
-        prof.notify(msg, 5000, 'Profanity Omemo Plugin')
-
-        for device in own_uninitialized:
-            _query_bundle_info_for(own_jid, device)
+    if (_query_missing_bundles(barejid)
+            or _message_store.has_messages_for(barejid)):
+        # keep the message until the sessions are built, messages queued
+        # before it have to be sent first
+        _queue_message(barejid, message)
+        return None
 
     return message
 
@@ -420,10 +761,13 @@ def prof_pre_chat_message_send(barejid, message):
 ################################################################################
 
 @omemo_enabled(else_return=True)
+@parse_stanza
 def prof_on_message_stanza_receive(stanza):
-    stanza = ensure_unicode_stanza(stanza)
+    if stanza.kind == xmpp.STANZA_OTHER:
+        # plain chat, receipts, chat states etc. are left to profanity
+        return True
 
-    log.info('Received Message: {0}'.format(stanza))
+    log.debug('Received Message: %s', ShortStanza(stanza))
     if xmpp.is_devicelist_update(stanza):
         log.info('Device List update detected.')
         try:
@@ -461,7 +805,7 @@ def prof_on_message_stanza_receive(stanza):
                 # only mark the message if it was an OMEMO encrypted message
                 try:
                     message_char = _get_omemo_message_char()
-                    log.debug('Set incoming Message Character: {0}'.format(message_char))
+                    log.debug('Set incoming Message Character: %s', message_char)
                     prof.chat_set_incoming_char(sender, message_char)
                     prof.incoming_message(sender, resource, plain_msg)
                 finally:
@@ -485,10 +829,64 @@ def prof_on_message_stanza_receive(stanza):
     return True
 
 
+def _is_response_to(request, stanza):
+    """ Check that a stanza with the id of request comes from the queried
+    jid, results for the own account may come without sender.
+    """
+    if stanza.root.get('type') not in ('result', 'error'):
+        return False
+
+    sender = stanza.root.get('from')
+    if sender is None:
+        return request.jid == ProfOmemoUser.account
+
+    return sender.rsplit('/', 1)[0] == request.jid
+
+
+def _handle_response(request, stanza):
+    failed = stanza.root.get('type') == 'error'
+    _requests.resolve(request.id, error=failed)
+
+    if request.device_id is None:
+        if failed:
+            log.warning('Device list query for %s failed', request.jid)
+        else:
+            log.info('Device List received for %s.', request.jid)
+            _handle_devicelist_update(stanza, sender_jid=request.jid)
+
+        if request.jid == ProfOmemoUser.account:
+            _finish_init(not failed)
+    else:
+        if failed:
+            log.warning('Bundle query for %s:%s failed', request.jid,
+                        request.device_id)
+        else:
+            _handle_bundle_update(stanza, sender=request.jid,
+                                  device_id=request.device_id)
+
+
 @omemo_enabled(else_return=True)
+@parse_stanza
 def prof_on_iq_stanza_receive(stanza):
-    stanza = ensure_unicode_stanza(stanza)
-    log.info('Received IQ: {0}'.format(stanza))
+    # responses to own requests are dispatched by their id, only the start
+    # tag of the stanza is read for that
+    stanza_id = stanza.root.get('id')
+    request = _requests.lookup(stanza_id)
+    if request is not None and _is_response_to(request, stanza):
+        log.debug('Received response: %s', ShortStanza(stanza))
+        _handle_response(request, stanza)
+        return False
+
+    if stanza_id in _pending_publishes and \
+            stanza.root.get('type') in ('result', 'error'):
+        node, bundle_hash = _pending_publishes.pop(stanza_id)
+        _handle_publish_result(node, bundle_hash, stanza)
+        return False
+
+    if stanza.kind == xmpp.STANZA_OTHER:
+        return True
+
+    log.debug('Received IQ: %s', ShortStanza(stanza))
 
     if xmpp.is_bundle_update(stanza):  # bundle information received
         log.info('Bundle update detected.')
@@ -532,18 +930,18 @@ def _parse_args(arg1=None, arg2=None, arg3=None):
         current_recipient = prof.get_current_recipient()
 
         if not current_recipient and arg2 != current_recipient:
-            log.info('Opening Chat Window for {0}'.format(arg2))
+            log.info('Opening Chat Window for %s', arg2)
             prof.send_line('/msg {0}'.format(arg2))
 
         recipient = arg2 or current_recipient
         if recipient:
-            log.info('Start OMEMO session with: {0}'.format(recipient))
+            log.info('Start OMEMO session with: %s', recipient)
             _start_omemo_session(recipient)
 
     elif arg1 == 'end':
         # ensure we are in a chat window
         jid = arg2 or prof.get_current_muc() or prof.get_current_recipient()
-        log.info('Ending OMEMO session with: {0}'.format(jid))
+        log.info('Ending OMEMO session with: %s', jid)
         if jid:
             _end_omemo_session(jid)
 
@@ -551,6 +949,19 @@ def _parse_args(arg1=None, arg2=None, arg3=None):
         if arg2 == 'message_prefix':
             if arg3 is not None:
                 _set_omemo_message_char(arg3)
+        elif arg2 == 'log_level':
+            if arg3 is not None:
+                _set_omemo_log_level(arg3)
+        elif arg2 == 'prefetch':
+            if arg3 in ('on', 'off'):
+                _set_omemo_prefetch_setting(arg3 == 'on')
+
+    elif arg1 == 'log':
+        if arg2 == 'dump':
+            _dump_log(arg3)
+
+    elif arg1 == 'stats':
+        _show_stats()
 
     elif arg1 == 'account':
         prof.cons_show('Account: {0}'.format(account))
@@ -575,6 +986,7 @@ def _parse_args(arg1=None, arg2=None, arg3=None):
         if contact_jid != ProfOmemoUser.account:
             omemo_state = ProfOmemoState()
             omemo_state.set_devices(contact_jid, [])
+            _requests.forget(contact_jid)
             _query_device_list(contact_jid)
 
     elif arg1 == 'fingerprints':
@@ -614,13 +1026,20 @@ def prof_on_chat_win_focus(barejid):
 
 
 def prof_init(version, status, account_name, fulljid):
+    try:
+        set_log_level(_get_omemo_log_level())
+    except ValueError:
+        set_log_level(OMEMO_DEFAULT_LOG_LEVEL)
+
     log.info('prof_init() called')
     synopsis = [
         '/omemo',
         '/omemo on|off',
         '/omemo start|end [jid]',
-        '/omemo set'
+        '/omemo set',
+        '/omemo log dump [<count>]',
         '/omemo status',
+        '/omemo stats',
         '/omemo account',
         '/omemo fulljid',
         '/omemo fingerprints',
@@ -634,7 +1053,14 @@ def prof_init(version, status, account_name, fulljid):
         ['start|end <jid>', ('Start an OMEMO based conversation with <jid> '
                              'window or current window.')],
         ['set', 'Set Settings like Message Prefix'],
+        ['set log_level debug|info|warning|error',
+         'Set the level of the plugin log messages'],
+        ['set prefetch on|off', ('Build sessions with known OMEMO contacts '
+                                 'in the background after connecting')],
+        ['log dump [<count>]', ('Write the last <count> log records to '
+                                '{0}').format(OMEMO_LOG_DUMP_PATH)],
         ['status', 'Display the current Profanity OMEMO Plugin status.'],
+        ['stats', 'Display queue and cache statistics.'],
         ['fingerprints <jid>', 'Display the known fingerprints for <jid>'],
         ['account', 'Show current account name'],
         ['reset_devicelist <jid>', 'Manually reset a contacts devicelist.'],
@@ -647,11 +1073,23 @@ def prof_init(version, status, account_name, fulljid):
     prof.register_command('/omemo', 1, 3,
                           synopsis, description, args, examples, _parse_args)
 
-    prof.completer_add('/omemo', ['on', 'off', 'status', 'start', 'end', 'set'
-                                  'account', 'fulljid', 'show_devices',
-                                  'reset_devicelist', 'fingerprints'])
+    prof.completer_add('/omemo', ['on', 'off', 'status', 'start', 'end', 'set',
+                                  'log', 'stats', 'account', 'fulljid',
+                                  'show_devices', 'reset_devicelist',
+                                  'fingerprints'])
 
-    prof.completer_add('/omemo set', ['message_prefix'])
+    prof.completer_add('/omemo set', ['message_prefix', 'log_level',
+                                      'prefetch'])
+    prof.completer_add('/omemo set prefetch', ['on', 'off'])
+    prof.completer_add('/omemo set log_level', sorted(LOG_LEVELS))
+    prof.completer_add('/omemo log', ['dump'])
+
+    prof.register_timed(_run_maintenance, MAINTENANCE_INTERVAL)
+    prof.register_timed(_run_prefetch, PREFETCH_INTERVAL)
+    prof.register_timed(_drain_stanzas, SCHEDULER_INTERVAL)
+    prof.register_timed(_run_announcer, ANNOUNCE_INTERVAL)
+    # log records are only passed to profanity from its main thread
+    prof.register_timed(flush_log, LOG_FLUSH_INTERVAL)
 
     # set user and init omemo only if account_name and fulljid provided
     if account_name is not None and fulljid is not None:
@@ -673,13 +1111,23 @@ def prof_on_connect(account_name, fulljid):
 
 
 def prof_on_disconnect(account_name, fulljid):
+    global _init_pending
+
     log.debug('prof_on_disconnect() called')
+    _init_pending = False
+    _pending_publishes.clear()
+    _message_store.clear()
+    _requests.clear()
+    _prefetcher.clear()
+    _scheduler.clear()
+    _announcer.clear()
     ProfOmemoUser.reset()
 
 
 def prof_on_shutdown():
     log.debug('prof_on_shutdown() called')
     ProfOmemoUser.reset()
+    flush_log()
 
 
 def human_hash(fpr):
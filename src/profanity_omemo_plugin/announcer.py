@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+
+from profanity_omemo_plugin.log import get_plugin_logger
+
+logger = get_plugin_logger(__name__)
+
+# minimum seconds between two publishes of the own devicelist
+PUBLISH_INTERVAL = 10
+# seconds to wait for the server echo of a publish before publishing again
+ECHO_TIMEOUT = 30
+
+
+class DevicelistAnnouncer(object):
+    """ Publishes the own devicelist at most once per ``interval``.
+
+    After a publish further announcements are suppressed until the server
+    echoes the own devicelist back or ``echo_timeout`` passed. Announcements
+    suppressed by the interval alone are published by a later :py:meth:`run`.
+    """
+
+    def __init__(self, interval=PUBLISH_INTERVAL, echo_timeout=ECHO_TIMEOUT,
+                 clock=time.time):
+        self.interval = interval
+        self.echo_timeout = echo_timeout
+        self.clock = clock
+        self.suppressed = 0
+        self._published = None  # time of the last publish
+        self._awaiting_echo = False
+        self._pending = False
+
+    def announce(self):
+        """ Publish the own devicelist unless a publish is in flight.
+
+        :returns: True if the devicelist was published
+        """
+        if self._blocked(self.clock()):
+            self.suppressed += 1
+            self._pending = True
+            return False
+
+        return self._publish()
+
+    def received(self, published):
+        """ The own devicelist arrived from the server.
+
+        :param published: whether it contains the own device
+        """
+        self._awaiting_echo = False
+        if published:
+            self._pending = False
+
+    def run(self):
+        """ Publish a suppressed announcement once that is allowed. """
+        if self._pending and not self._blocked(self.clock()):
+            return self._publish()
+        return False
+
+    def clear(self):
+        self._published = None
+        self._awaiting_echo = False
+        self._pending = False
+
+    def publish(self):
+        # send the own devicelist
+        pass
+
+    def _blocked(self, now):
+        if self._published is None:
+            return False
+
+        elapsed = now - self._published
+        if self._awaiting_echo and elapsed < self.echo_timeout:
+            return True
+
+        return elapsed < self.interval
+
+    def _publish(self):
+        if self.suppressed:
+            logger.debug('Publishing own devicelist, %s announcements '
+                         'suppressed so far', self.suppressed)
+        self._published = self.clock()
+        self._awaiting_echo = True
+        self._pending = False
+        self.publish()
+        return True
@@ -26,14 +26,38 @@ PLUGIN_NAME = 'omemo'
 
 HOME = os.path.expanduser('~')
 XDG_DATA_HOME = os.environ.get('XDG_DATA_HOME', os.path.join(HOME, '.local', 'share'))
+OMEMO_LOG_DUMP_PATH = os.path.join(XDG_DATA_HOME, 'profanity', 'omemo',
+                                   'omemo_log.txt')
 
 LOGGER_NAME = 'ProfOmemoLogger'
 SETTINGS_GROUP = 'omemo'
 OMEMO_DEFAULT_ENABLED = True
 OMEMO_DEFAULT_MESSAGE_CHAR = '@'
+OMEMO_DEFAULT_LOG_LEVEL = 'info'
+OMEMO_DEFAULT_PREFETCH = False
+
+# seconds between two runs of the periodic plugin maintenance
+MAINTENANCE_INTERVAL = 60
+
+# seconds between two runs of the session prefetch
+PREFETCH_INTERVAL = 10
+
+# seconds between two runs of the outbound stanza scheduler
+SCHEDULER_INTERVAL = 1
+
+# seconds between two flushes of the queued log records to profanity
+LOG_FLUSH_INTERVAL = 1
+
+# seconds between two checks for a suppressed devicelist announcement
+ANNOUNCE_INTERVAL = 10
 
 # OMEMO namespace constants
 NS_OMEMO = 'eu.siacs.conversations.axolotl'
 NS_DEVICE_LIST = NS_OMEMO + '.devicelist'
 NS_DEVICE_LIST_NOTIFY = NS_DEVICE_LIST + '+notify'
 NS_BUNDLES = NS_OMEMO + '.bundles'
+
+# XMPP namespace constants
+NS_PUBSUB = 'http://jabber.org/protocol/pubsub'
+NS_PUBSUB_EVENT = NS_PUBSUB + '#event'
+NS_FORWARD = 'urn:xmpp:forward:0'
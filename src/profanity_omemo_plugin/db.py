@@ -41,7 +41,7 @@ def get_connection(user):
     db_root = os.path.dirname(db_path)
     if not os.path.isdir(db_root):
         os.makedirs(db_root)
-    log.info('Using database path {}'.format(db_path))
+    log.info('Using database path %s', db_path)
     conn = sqlite3.connect(db_path, check_same_thread=False)
     return conn
 
@@ -18,10 +18,16 @@
 # the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import copy
+import io
 import logging
-import traceback
+import threading
+from collections import deque
+
+from profanity_omemo_plugin.constants import OMEMO_DEFAULT_LOG_LEVEL
 
 PROFANITY_IS_HOST = True
 
@@ -30,6 +36,24 @@ try:
 except ImportError:
     PROFANITY_IS_HOST = False
 
+# stanzas passed as ShortStanza are cut off after this many characters
+MAX_LOGGED_STANZA_LENGTH = 1024
+
+# records waiting to be passed to profanity, older records are dropped on
+# overflow
+LOG_QUEUE_SIZE = 1000
+# records kept in memory for /omemo log dump
+LOG_HISTORY_SIZE = 1000
+
+DUMP_FORMAT = '%(asctime)s %(levelname)s %(name)s - %(message)s'
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
 
 class ProfLogHandler(logging.Handler):
 
@@ -44,38 +68,200 @@ class ProfLogHandler(logging.Handler):
         self.prof_formatter = logging.Formatter(fmt_str)
         self.setFormatter(self.prof_formatter)
 
-    def emit(self, record):
-
         if PROFANITY_IS_HOST:
-            level_fn_map = {
-                10: prof.log_debug,  # DEBUG
-                20: prof.log_info,  # INFO
-                30: prof.log_warning,  # WARNING
-                40: prof.log_error  # ERROR
+            self.level_fn_map = {
+                logging.DEBUG: prof.log_debug,
+                logging.INFO: prof.log_info,
+                logging.WARNING: prof.log_warning,
+                logging.ERROR: prof.log_error,
+                logging.CRITICAL: prof.log_error
             }
 
+    def emit(self, record):
+
+        if PROFANITY_IS_HOST:
             try:
+                # the formatter appends the traceback of exc_info records
                 log_message = self.format(record)
-                try:
-                    if record.levelno == 40 and record.exc_info:
-                        tb_info = record.exc_info
-                        log_message += '\n' + traceback.print_exception(*tb_info)
-                except TypeError:  # tb_info is None
-                    pass
-
-                level_fn_map[record.levelno](log_message)
+                log_fn = self.level_fn_map.get(record.levelno, prof.log_error)
+                log_fn(log_message)
             except Exception as e:
                 prof.log_error('Could not log last message. {0}'.format(repr(e)))
 
 
+class ShortStanza(object):
+    """ Log argument which cuts off long stanzas.
+
+    The stanza is only shortened if the record is actually formatted, so
+    passing it to a disabled log level costs nothing.
+    """
+
+    __slots__ = ('stanza',)
+
+    def __init__(self, stanza):
+        self.stanza = stanza
+
+    def __str__(self):
+        # accept xmpp.Stanza objects as well as plain text
+        text = getattr(self.stanza, 'text', self.stanza)
+        if text is None:
+            return 'None'
+
+        if len(text) > MAX_LOGGED_STANZA_LENGTH:
+            return '{0}... [{1} characters]'.format(
+                text[:MAX_LOGGED_STANZA_LENGTH], len(text))
+
+        return text
+
+    __unicode__ = __str__
+
+
+class AsyncLogHandler(logging.Handler):
+    """ Passes records on to a target handler when it is flushed.
+
+    emit() only appends the record to a bounded queue, so logging never
+    blocks the caller on the target. The queue is drained by
+    :py:meth:`flush`, which has to be called on profanity's main thread as
+    the profanity API must not be used from other threads. If the queue is
+    full the oldest record is dropped and counted. The last records are
+    also kept in a ring buffer, which can be written to a file with
+    :py:meth:`dump`.
+    """
+
+    def __init__(self, target, capacity=LOG_QUEUE_SIZE,
+                 history=LOG_HISTORY_SIZE):
+        super(AsyncLogHandler, self).__init__()
+        self.target = target
+        self.capacity = capacity
+        self.dropped = 0
+        self.history = deque(maxlen=history)
+
+        self._pending = deque()
+        self._reported = 0
+        # records may be emitted from any thread
+        self._pending_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            record = self._prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        with self._pending_lock:
+            self.history.append(record)
+            if len(self._pending) >= self.capacity:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(record)
+
+    def flush(self):
+        """ Pass the queued records to the target on the calling thread. """
+        with self._pending_lock:
+            records, self._pending = self._pending, deque()
+            dropped = self.dropped - self._reported
+            self._reported = self.dropped
+
+        if dropped:
+            self.target.handle(logging.makeLogRecord({
+                'name': __name__,
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': '{0} log records dropped'.format(dropped)}))
+
+        for record in records:
+            self.target.handle(record)
+
+    def dump(self, path, count=None):
+        """ Write the last count records to path.
+
+        :returns: the number of records written
+        """
+        with self._pending_lock:
+            records = list(self.history)
+        if count is not None:
+            records = records[-count:] if count > 0 else []
+
+        formatter = logging.Formatter(DUMP_FORMAT)
+        with io.open(path, 'w', encoding='utf-8') as dump_file:
+            for record in records:
+                dump_file.write(formatter.format(record))
+                dump_file.write('\n')
+
+        return len(records)
+
+    def _prepare(self, record):
+        # resolve the arguments right away, they might change until the
+        # record is flushed
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
 python_omemo_logger = logging.getLogger('omemo')
 python_omemo_logger.setLevel(logging.DEBUG)
 python_omemo_logger.addHandler(ProfLogHandler())
 
+_plugin_handler = AsyncLogHandler(ProfLogHandler(prefix='ProfOmemoPlugin'))
+_plugin_loggers = {}
+_plugin_log_level = LOG_LEVELS[OMEMO_DEFAULT_LOG_LEVEL]
+
 
 def get_plugin_logger(name):
+    try:
+        return _plugin_loggers[name]
+    except KeyError:
+        pass
+
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    logger.addHandler(ProfLogHandler(prefix='ProfOmemoPlugin'))
+    logger.setLevel(_plugin_log_level)
+    logger.addHandler(_plugin_handler)
+    _plugin_loggers[name] = logger
 
     return logger
+
+
+def set_log_level(level):
+    """ Set the level of all plugin loggers.
+
+    :param level: one of the names in LOG_LEVELS
+    :raises ValueError: if the level name is unknown
+    """
+    global _plugin_log_level
+
+    try:
+        _plugin_log_level = LOG_LEVELS[level.lower()]
+    except (KeyError, AttributeError):
+        raise ValueError('Unknown log level {0}'.format(level))
+
+    for logger in _plugin_loggers.values():
+        logger.setLevel(_plugin_log_level)
+    python_omemo_logger.setLevel(_plugin_log_level)
+
+    return _plugin_log_level
+
+
+def dump_log(path, count=None):
+    """ Write the last count plugin log records to path.
+
+    :returns: the number of records written
+    """
+    return _plugin_handler.dump(path, count)
+
+
+def flush_log():
+    """ Pass the queued plugin log records to profanity, only call this
+    from profanity's main thread.
+    """
+    _plugin_handler.flush()
+
+
+def dropped_log_records():
+    """ The number of plugin log records dropped on overflow. """
+    return _plugin_handler.dropped
@@ -1,5 +1,8 @@
 ''' Database helper functions '''
 
+import binascii
+from contextlib import contextmanager
+
 
 def table_exists(db, name):
     """ Check if the specified table exists in the db. """
@@ -13,3 +16,93 @@ def table_exists(db, name):
 def user_version(db):
     """ Return the value of PRAGMA user_version. """
     return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+@contextmanager
+def explicit_transaction(db):
+    """ Run the block in a transaction begun and committed by hand.
+
+        The implicit transaction handling of the sqlite3 module is switched
+        off meanwhile, Python 2 would otherwise start its own transaction
+        before the first DML statement and commit before DDL statements.
+    """
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        db.execute('BEGIN')
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    finally:
+        db.isolation_level = isolation_level
+
+
+def fingerprint(public_key):
+    """ Return the hex fingerprint of a serialized identity public key. """
+    # the first byte is the key type
+    return binascii.hexlify(public_key[1:]).decode('ascii')
+
+
+class DeferredCommitConnection(object):
+    """ Wraps a :py:class:`sqlite3.Connection` so that commits issued inside
+        of a :py:meth:`transaction` block are deferred until the outermost
+        block is left.
+    """
+
+    def __init__(self, dbConn):
+        self._dbConn = dbConn
+        self._depth = 0
+        self._after_commit = []
+
+    def __getattr__(self, name):
+        return getattr(self._dbConn, name)
+
+    @property
+    def isolation_level(self):
+        return self._dbConn.isolation_level
+
+    @isolation_level.setter
+    def isolation_level(self, value):
+        self._dbConn.isolation_level = value
+
+    @property
+    def in_transaction(self):
+        return self._depth > 0
+
+    def commit(self):
+        if not self._depth:
+            self._dbConn.commit()
+
+    def after_commit(self, callback):
+        """ Call callback once the current transaction is committed.
+
+            Outside of a transaction it is called right away, callbacks of a
+            rolled back transaction are dropped.
+        """
+        if self._depth:
+            self._after_commit.append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def transaction(self):
+        """ Commit once on success, roll everything back on error. """
+        self._depth += 1
+        try:
+            yield self
+        except Exception:
+            self._depth -= 1
+            if not self._depth:
+                self._after_commit = []
+                self._dbConn.rollback()
+            raise
+
+        self._depth -= 1
+        if not self._depth:
+            self._dbConn.commit()
+            callbacks, self._after_commit = self._after_commit, []
+            for callback in callbacks:
+                callback()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+# Copyright 2015 Daniel Gultsch <daniel@cgultsch.de>
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+class DeviceListStore():
+    """ Stores the devicelists of all contacts.
+
+        The lists are loaded once and kept in memory together with a reverse
+        index from device id to jid, the table is only written to. Changes
+        are applied in memory after they were written, if the surrounding
+        transaction is rolled back :py:meth:`discardChanges` makes the next
+        access load the lists again.
+    """
+
+    def __init__(self, dbConn):
+        """
+        :type dbConn: Connection
+        """
+        self.dbConn = dbConn
+        # set of device ids by jid, None until loaded
+        self.devices = None
+        # jid by device id
+        self.jids = None
+
+    def getDevices(self, jid):
+        return self._load().get(jid, frozenset())
+
+    def getJids(self):
+        return list(self._load())
+
+    def getJidFromDevice(self, deviceId):
+        self._load()
+        return self.jids.get(deviceId)
+
+    def discardChanges(self):
+        """ Forget the loaded lists, they are read again on next access. """
+        self.devices = None
+        self.jids = None
+
+    def setDevices(self, jid, deviceIds):
+        """ Replace the devicelist of jid, only changed rows are written.
+
+            :returns: a tuple of the sets of added and removed device ids
+        """
+        known = self.getDevices(jid)
+        deviceIds = set(deviceIds)
+        added = deviceIds - known
+        removed = known - deviceIds
+        if not added and not removed:
+            return added, removed
+
+        c = self.dbConn.cursor()
+        c.executemany('DELETE FROM devicelists WHERE jid = ? AND device_id = ?',
+                      [(jid, deviceId) for deviceId in removed])
+        c.executemany('INSERT OR IGNORE INTO devicelists (jid, device_id) '
+                      'VALUES (?, ?)', [(jid, deviceId) for deviceId in added])
+        self.dbConn.commit()
+
+        for deviceId in removed:
+            self._remove(jid, deviceId)
+        for deviceId in added:
+            self._add(jid, deviceId)
+        return added, removed
+
+    def addDevice(self, jid, deviceId):
+        """ Add a single device, returns False if it was known already. """
+        if deviceId in self.getDevices(jid):
+            return False
+
+        q = 'INSERT OR IGNORE INTO devicelists (jid, device_id) VALUES (?, ?)'
+        c = self.dbConn.cursor()
+        c.execute(q, (jid, deviceId))
+        self.dbConn.commit()
+
+        self._add(jid, deviceId)
+        return True
+
+    def _load(self):
+        if self.devices is None:
+            self.devices = {}
+            self.jids = {}
+
+            q = 'SELECT jid, device_id FROM devicelists'
+            c = self.dbConn.cursor()
+            for jid, deviceId in c.execute(q):
+                if isinstance(jid, bytes):
+                    # the store connection returns text as bytes
+                    jid = jid.decode('utf-8')
+                self._add(jid, deviceId)
+
+        return self.devices
+
+    def _add(self, jid, deviceId):
+        self.devices.setdefault(jid, set()).add(deviceId)
+        self.jids[deviceId] = jid
+
+    def _remove(self, jid, deviceId):
+        devices = self.devices[jid]
+        devices.discard(deviceId)
+        if not devices:
+            del self.devices[jid]
+
+        if self.jids.get(deviceId) == jid:
+            del self.jids[deviceId]
@@ -18,21 +18,24 @@
 #
 
 import logging
+from contextlib import contextmanager
 
 from axolotl.state.axolotlstore import AxolotlStore
 from axolotl.util.keyhelper import KeyHelper
 
+from .db_helpers import DeferredCommitConnection
+from .devicelist import DeviceListStore
 from .encryption import EncryptionState
 from .liteidentitykeystore import LiteIdentityKeyStore
 from .liteprekeystore import LitePreKeyStore
 from .litesessionstore import LiteSessionStore
 from .litesignedprekeystore import LiteSignedPreKeyStore
+from .prekeypool import DEFAULT_PREKEY_AMOUNT
+from .publishstate import PublishState
 from .sql import SQLDatabase
 
 log = logging.getLogger('gajim.plugin_system.omemo')
 
-DEFAULT_PREKEY_AMOUNT = 100
-MIN_PREKEY_AMOUNT = 80
 SPK_ARCHIVE_TIME = 86400 * 15  # 15 Days
 SPK_CYCLE_TIME = 86400         # 24 Hours
 
@@ -45,16 +48,49 @@ class LiteAxolotlStore(AxolotlStore):
             raise AssertionError('Expected a sqlite3.Connection got ' +
                                  str(connection))
 
+        # all stores share the wrapper, so transaction() covers them all
+        connection = DeferredCommitConnection(connection)
+        self.dbConn = connection
+
         self.sql = SQLDatabase(connection)
         self.identityKeyStore = LiteIdentityKeyStore(connection)
         self.preKeyStore = LitePreKeyStore(connection)
         self.signedPreKeyStore = LiteSignedPreKeyStore(connection)
         self.sessionStore = LiteSessionStore(connection)
         self.encryptionStore = EncryptionState(connection)
+        self.publishState = PublishState(connection)
+        self.deviceListStore = DeviceListStore(connection)
+        # (remote identity key, trust) by (recipient_id, device_id)
+        self.trustIndex = {}
 
         if not self.getLocalRegistrationId():
             log.info("Generating Axolotl keys")
-            self._generate_axolotl_keys()
+            with self.transaction():
+                self._generate_axolotl_keys()
+
+    @contextmanager
+    def transaction(self):
+        """ Run the block as a single unit of work.
+
+            The per statement commits of the stores are suppressed and
+            pending sessions are flushed, everything is committed once when
+            the block is left. On error all changes are rolled back.
+        """
+        with self.dbConn.transaction():
+            try:
+                yield self
+            except Exception:
+                self.sessionStore.discardChanges()
+                self.identityKeyStore.discardLocalData()
+                self.deviceListStore.discardChanges()
+                self.trustIndex.clear()
+                raise
+
+            self.sessionStore.flush()
+
+    def afterCommit(self, callback):
+        """ Call callback once the current transaction is committed. """
+        self.dbConn.after_commit(callback)
 
     def _generate_axolotl_keys(self):
         identityKeyPair = KeyHelper.generateIdentityKeyPair()
@@ -67,9 +103,7 @@ class LiteAxolotlStore(AxolotlStore):
             identityKeyPair, KeyHelper.getRandomSequence(65536))
 
         self.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
-
-        for preKey in preKeys:
-            self.storePreKey(preKey.getId(), preKey)
+        self.preKeyStore.storePreKeys(preKeys)
 
     def getIdentityKeyPair(self):
         return self.identityKeyStore.getIdentityKeyPair()
@@ -82,17 +116,50 @@ class LiteAxolotlStore(AxolotlStore):
 
     def saveIdentity(self, recepientId, identityKey):
         self.identityKeyStore.saveIdentity(recepientId, identityKey)
+        self._invalidateTrust(recepientId)
 
     def deleteIdentity(self, recipientId, identityKey):
         self.identityKeyStore.deleteIdentity(recipientId, identityKey)
+        self._invalidateTrust(recipientId)
 
     def isTrustedIdentity(self, recepientId, identityKey):
         return self.identityKeyStore.isTrustedIdentity(recepientId,
                                                        identityKey)
 
+    def getTrust(self, recipientId, publicKey):
+        return self.identityKeyStore.getTrust(recipientId, publicKey)
+
     def setTrust(self, identityKey, trust):
+        # the key may be used by any recipient
+        self.trustIndex.clear()
         return self.identityKeyStore.setTrust(identityKey, trust)
 
+    def getDeviceTrust(self, recipientId, deviceId):
+        """ Return the trust of the identity key used by the session with
+            the given device, None if there is no session.
+
+            The result is kept in memory until the identity or the session
+            changes.
+        """
+        key = (recipientId, deviceId)
+        entry = self.trustIndex.get(key)
+        if entry is not None:
+            return entry[1]
+
+        publicKey = self.sessionStore.getRemoteIdentityKey(recipientId,
+                                                           deviceId)
+        if publicKey is None:
+            return None
+
+        trust = self.identityKeyStore.getTrust(recipientId, publicKey)
+        self.trustIndex[key] = (publicKey, trust)
+        return trust
+
+    def _invalidateTrust(self, recipientId):
+        for key in list(self.trustIndex):
+            if key[0] == recipientId:
+                del self.trustIndex[key]
+
     def getFingerprints(self, jid):
         return self.identityKeyStore.getFingerprints(jid)
 
@@ -132,24 +199,60 @@ class LiteAxolotlStore(AxolotlStore):
     def getInactiveSessionsKeys(self, recipientId):
         return self.sessionStore.getInactiveSessionsKeys(recipientId)
 
+    def getRemoteIdentityKey(self, recipientId, deviceId):
+        return self.sessionStore.getRemoteIdentityKey(recipientId, deviceId)
+
     def getSubDeviceSessions(self, recepientId):
         # TODO Reuse this
         return self.sessionStore.getSubDeviceSessions(recepientId)
 
     def getJidFromDevice(self, device_id):
-        return self.sessionStore.getJidFromDevice(device_id)
+        return self.deviceListStore.getJidFromDevice(device_id)
+
+    def getDevices(self, jid):
+        return self.deviceListStore.getDevices(jid)
+
+    def getDeviceListJids(self):
+        return self.deviceListStore.getJids()
+
+    def setDevices(self, jid, deviceIds):
+        return self.deviceListStore.setDevices(jid, deviceIds)
+
+    def addDevice(self, jid, deviceId):
+        return self.deviceListStore.addDevice(jid, deviceId)
 
     def storeSession(self, recepientId, deviceId, sessionRecord):
         self.sessionStore.storeSession(recepientId, deviceId, sessionRecord)
 
+        # most stores only advance the ratchet, keep the trust in that case
+        key = (recepientId, deviceId)
+        entry = self.trustIndex.get(key)
+        if entry is not None:
+            publicKey = self.sessionStore.getRemoteIdentityKey(recepientId,
+                                                               deviceId)
+            if publicKey != entry[0]:
+                del self.trustIndex[key]
+
     def containsSession(self, recepientId, deviceId):
         return self.sessionStore.containsSession(recepientId, deviceId)
 
+    def getSessionDevices(self, recepientId):
+        return self.sessionStore.getSessionDevices(recepientId)
+
     def deleteSession(self, recepientId, deviceId):
         self.sessionStore.deleteSession(recepientId, deviceId)
+        self.trustIndex.pop((recepientId, deviceId), None)
 
     def deleteAllSessions(self, recepientId):
         self.sessionStore.deleteAllSessions(recepientId)
+        self._invalidateTrust(recepientId)
+
+    def invalidateSession(self, recepientId, deviceId):
+        self.sessionStore.invalidateSession(recepientId, deviceId)
+        self.trustIndex.pop((recepientId, deviceId), None)
+
+    def flush(self):
+        self.sessionStore.flush()
 
     def getSessionsFromJid(self, recipientId):
         return self.sessionStore.getSessionsFromJid(recipientId)
@@ -187,3 +290,9 @@ class LiteAxolotlStore(AxolotlStore):
 
     def removeOldSignedPreKeys(self, timestamp):
         self.signedPreKeyStore.removeOldSignedPreKeys(timestamp)
+
+    def getPublishedHash(self, node):
+        return self.publishState.getHash(node)
+
+    def setPublishedHash(self, node, contentHash):
+        self.publishState.setHash(node, contentHash)
@@ -33,25 +33,39 @@ class LiteIdentityKeyStore(IdentityKeyStore):
         :type dbConn: Connection
         """
         self.dbConn = dbConn
+        # the local identity never changes once it is generated, it is read
+        # once and kept as (registrationId, IdentityKeyPair)
+        self.localData = None
 
     def getIdentityKeyPair(self):
-        q = "SELECT public_key, private_key FROM identities " + \
-            "WHERE recipient_id = -1"
-        c = self.dbConn.cursor()
-        c.execute(q)
-        result = c.fetchone()
-
-        publicKey, privateKey = result
-        return IdentityKeyPair(
-            IdentityKey(DjbECPublicKey(publicKey[1:])),
-            DjbECPrivateKey(privateKey))
+        return self._loadLocalData()[1]
 
     def getLocalRegistrationId(self):
-        q = "SELECT registration_id FROM identities WHERE recipient_id = -1"
-        c = self.dbConn.cursor()
-        c.execute(q)
-        result = c.fetchone()
-        return result[0] if result else None
+        localData = self._loadLocalData()
+        return localData[0] if localData else None
+
+    def discardLocalData(self):
+        """ Read the local identity from the db again on the next access.
+        """
+        self.localData = None
+
+    def _loadLocalData(self):
+        if self.localData is None:
+            q = "SELECT registration_id, public_key, private_key " \
+                "FROM identities WHERE recipient_id = -1"
+            c = self.dbConn.cursor()
+            c.execute(q)
+            result = c.fetchone()
+            if result is None:
+                return None
+
+            registrationId, publicKey, privateKey = result
+            identityKeyPair = IdentityKeyPair(
+                IdentityKey(DjbECPublicKey(publicKey[1:])),
+                DjbECPrivateKey(privateKey))
+            self.localData = (registrationId, identityKeyPair)
+
+        return self.localData
 
     def storeLocalData(self, registrationId, identityKeyPair):
         q = "INSERT INTO identities( " + \
@@ -64,6 +78,7 @@ class LiteIdentityKeyStore(IdentityKeyStore):
                    identityKeyPair.getPrivateKey().serialize()))
 
         self.dbConn.commit()
+        self.localData = (registrationId, identityKeyPair)
 
     def saveIdentity(self, recipientId, identityKey):
         q = "INSERT INTO identities (recipient_id, public_key, trust) " \
@@ -94,11 +109,15 @@ class LiteIdentityKeyStore(IdentityKeyStore):
         self.dbConn.commit()
 
     def isTrustedIdentity(self, recipientId, identityKey):
+        return self.getTrust(recipientId,
+                             identityKey.getPublicKey().serialize())
+
+    def getTrust(self, recipientId, publicKey):
         q = "SELECT trust FROM identities WHERE recipient_id = ? " \
             "AND public_key = ?"
         c = self.dbConn.cursor()
 
-        c.execute(q, (recipientId, identityKey.getPublicKey().serialize()))
+        c.execute(q, (recipientId, publicKey))
         result = c.fetchone()
 
         states = [UNTRUSTED, TRUSTED, UNDECIDED]
@@ -142,13 +161,14 @@ class LiteIdentityKeyStore(IdentityKeyStore):
         return result
 
     def getUndecidedFingerprints(self, jid):
-        q = "SELECT trust FROM identities WHERE recipient_id = ? AND trust = ?"
+        q = "SELECT public_key FROM identities WHERE recipient_id = ? AND trust = ?"
         c = self.dbConn.cursor()
 
         result = []
         c.execute(q, (jid, UNDECIDED))
-        result = c.fetchall()
-
+        rows = c.fetchall()
+        for row in rows:
+            result.append(row[0])
         return result
 
     def getNewFingerprints(self, jid):
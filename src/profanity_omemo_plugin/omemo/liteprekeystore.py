@@ -55,6 +55,13 @@ class LitePreKeyStore(PreKeyStore):
         cursor.execute(q, (preKeyId, preKeyRecord.serialize()))
         self.dbConn.commit()
 
+    def storePreKeys(self, preKeyRecords):
+        q = "INSERT INTO prekeys (prekey_id, record) VALUES(?,?)"
+        cursor = self.dbConn.cursor()
+        cursor.executemany(q, [(r.getId(), r.serialize())
+                               for r in preKeyRecords])
+        self.dbConn.commit()
+
     def containsPreKey(self, preKeyId):
         q = "SELECT record FROM prekeys WHERE prekey_id = ?"
         cursor = self.dbConn.cursor()
@@ -80,8 +87,8 @@ class LitePreKeyStore(PreKeyStore):
         return cursor.fetchone()[0]
 
     def generateNewPreKeys(self, count):
-        startId = self.getCurrentPreKeyId() + 1
+        startId = (self.getCurrentPreKeyId() or 0) + 1
         preKeys = KeyHelper.generatePreKeys(startId, count)
+        self.storePreKeys(preKeys)
 
-        for preKey in preKeys:
-            self.storePreKey(preKey.getId(), preKey)
+        return preKeys
@@ -20,26 +20,90 @@
 from axolotl.state.sessionrecord import SessionRecord
 from axolotl.state.sessionstore import SessionStore
 
+from .db_helpers import fingerprint
+from .lru import LRUCache
+
+DEFAULT_SESSION_CACHE_SIZE = 256
+
 
 class LiteSessionStore(SessionStore):
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, cacheSize=DEFAULT_SESSION_CACHE_SIZE):
         """
         :type dbConn: Connection
         """
         self.dbConn = dbConn
+        # deserialized SessionRecords by (recipient_id, device_id)
+        self.records = LRUCache(cacheSize)
+        # (serialized SessionRecord, remote identity key) tuples which are
+        # not written to the db yet
+        self.dirty = {}
+        # set of device ids with a session by recipient_id, loaded once per
+        # recipient and kept up to date by storeSession and deleteSession
+        self.sessionDevices = {}
 
     def loadSession(self, recipientId, deviceId):
-        q = "SELECT record FROM sessions WHERE recipient_id = ? AND device_id = ?"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId, deviceId))
-        result = c.fetchone()
+        key = (recipientId, deviceId)
+        record = self.records.get(key)
+        if record is not None:
+            return record
 
-        if result:
-            return SessionRecord(serialized=result[0])
+        pending = self.dirty.get(key)
+        if pending is not None:
+            serialized = pending[0]
         else:
-            return SessionRecord()
+            q = "SELECT record FROM sessions " \
+                "WHERE recipient_id = ? AND device_id = ?"
+            c = self.dbConn.cursor()
+            c.execute(q, (recipientId, deviceId))
+            result = c.fetchone()
+
+            if not result:
+                return SessionRecord()
+
+            serialized = result[0]
+
+        record = SessionRecord(serialized=serialized)
+        self.records.put(key, record)
+        return record
+
+    def invalidateSession(self, recipientId, deviceId):
+        """ Drop the cached SessionRecord, the next load returns the
+            last stored state again.
+        """
+        self.records.pop((recipientId, deviceId))
+
+    def discardChanges(self):
+        """ Forget all cached and pending SessionRecords. """
+        self.records.clear()
+        self.dirty.clear()
+        self.sessionDevices.clear()
+
+    def flush(self):
+        """ Write all pending SessionRecords in a single transaction. """
+        if not self.dirty:
+            return
+
+        # update in place, so the row and its index entries stay untouched
+        # apart from the record, new sessions are inserted afterwards
+        update = "UPDATE sessions SET record = ?, remote_identity_key = ?, " \
+                 "fingerprint = ?, active = 1 " \
+                 "WHERE recipient_id = ? AND device_id = ?"
+        insert = "INSERT OR IGNORE INTO sessions(record, " \
+                 "remote_identity_key, fingerprint, recipient_id, device_id) " \
+                 "VALUES(?,?,?,?,?)"
+        rows = []
+        for (recipientId, deviceId), (record, publicKey) in self.dirty.items():
+            fpr = fingerprint(publicKey) if publicKey is not None else None
+            rows.append((record, publicKey, fpr, recipientId, deviceId))
+
+        c = self.dbConn.cursor()
+        c.executemany(update, rows)
+        c.executemany(insert, rows)
+        self.dbConn.commit()
+        self.dirty.clear()
 
     def getSubDeviceSessions(self, recipientId):
+        self.flush()
         q = "SELECT device_id from sessions WHERE recipient_id = ?"
         c = self.dbConn.cursor()
         c.execute(q, (recipientId, ))
@@ -49,6 +113,7 @@ class LiteSessionStore(SessionStore):
         return deviceIds
 
     def getJidFromDevice(self, device_id):
+        self.flush()
         q = "SELECT recipient_id from sessions WHERE device_id = ?"
         c = self.dbConn.cursor()
         c.execute(q, (device_id, ))
@@ -57,6 +122,7 @@ class LiteSessionStore(SessionStore):
         return result[0]
 
     def getActiveDeviceTuples(self):
+        self.flush()
         q = "SELECT recipient_id, device_id FROM sessions WHERE active = 1"
         c = self.dbConn.cursor()
         result = []
@@ -65,32 +131,75 @@ class LiteSessionStore(SessionStore):
         return result
 
     def storeSession(self, recipientId, deviceId, sessionRecord):
-        self.deleteSession(recipientId, deviceId)
+        key = (recipientId, deviceId)
+        self.records.put(key, sessionRecord)
 
-        q = "INSERT INTO sessions(recipient_id, device_id, record) VALUES(?,?,?)"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId, deviceId, sessionRecord.serialize()))
-        self.dbConn.commit()
+        identityKey = sessionRecord.getSessionState().getRemoteIdentityKey()
+        if identityKey is not None:
+            identityKey = identityKey.getPublicKey().serialize()
+        self.dirty[key] = (sessionRecord.serialize(), identityKey)
 
-    def containsSession(self, recipientId, deviceId):
-        q = "SELECT record FROM sessions WHERE recipient_id = ? AND device_id = ?"
+        devices = self.sessionDevices.get(recipientId)
+        if devices is not None:
+            devices.add(deviceId)
+
+    def getRemoteIdentityKey(self, recipientId, deviceId):
+        """ Return the serialized public identity key of the session with
+            the given device or None if there is no session.
+        """
+        pending = self.dirty.get((recipientId, deviceId))
+        if pending is not None:
+            return pending[1]
+
+        q = "SELECT remote_identity_key FROM sessions " \
+            "WHERE recipient_id = ? AND device_id = ?"
         c = self.dbConn.cursor()
         c.execute(q, (recipientId, deviceId))
         result = c.fetchone()
 
-        return result is not None
+        return result[0] if result else None
+
+    def containsSession(self, recipientId, deviceId):
+        return deviceId in self.getSessionDevices(recipientId)
+
+    def getSessionDevices(self, recipientId):
+        """ Return the set of device ids of recipientId with a session. """
+        devices = self.sessionDevices.get(recipientId)
+        if devices is None:
+            q = "SELECT device_id FROM sessions WHERE recipient_id = ?"
+            c = self.dbConn.cursor()
+            devices = set(row[0] for row in c.execute(q, (recipientId, )))
+            devices.update(deviceId for jid, deviceId in self.dirty
+                           if jid == recipientId)
+            self.sessionDevices[recipientId] = devices
+
+        return devices
 
     def deleteSession(self, recipientId, deviceId):
+        self.records.pop((recipientId, deviceId))
+        self.dirty.pop((recipientId, deviceId), None)
+        self.sessionDevices.get(recipientId, set()).discard(deviceId)
+
         q = "DELETE FROM sessions WHERE recipient_id = ? AND device_id = ?"
         self.dbConn.cursor().execute(q, (recipientId, deviceId))
         self.dbConn.commit()
 
     def deleteAllSessions(self, recipientId):
+        for key in self.records.keys():
+            if key[0] == recipientId:
+                self.records.pop(key)
+
+        for key in list(self.dirty):
+            if key[0] == recipientId:
+                del self.dirty[key]
+        self.sessionDevices.pop(recipientId, None)
+
         q = "DELETE FROM sessions WHERE recipient_id = ?"
         self.dbConn.cursor().execute(q, (recipientId, ))
         self.dbConn.commit()
 
     def getAllSessions(self):
+        self.flush()
         q = "SELECT _id, recipient_id, device_id, record, active from sessions"
         c = self.dbConn.cursor()
         result = []
@@ -99,6 +208,7 @@ class LiteSessionStore(SessionStore):
         return result
 
     def getSessionsFromJid(self, recipientId):
+        self.flush()
         q = "SELECT _id, recipient_id, device_id, record, active from sessions" \
             " WHERE recipient_id = ?"
         c = self.dbConn.cursor()
@@ -108,6 +218,7 @@ class LiteSessionStore(SessionStore):
         return result
 
     def getSessionsFromJids(self, recipientId):
+        self.flush()
         q = "SELECT _id, recipient_id, device_id, record, active from sessions" \
             " WHERE recipient_id IN ({})" \
             .format(', '.join(['?'] * len(recipientId)))
@@ -118,26 +229,40 @@ class LiteSessionStore(SessionStore):
         return result
 
     def setActiveState(self, deviceList, jid):
+        self.flush()
         c = self.dbConn.cursor()
+        placeholders = ', '.join(['?'] * len(deviceList))
 
-        q = "UPDATE sessions SET active = {} " \
-            "WHERE recipient_id = '{}' AND device_id IN ({})" \
-            .format(1, jid, ', '.join(['?'] * len(deviceList)))
-        c.execute(q, deviceList)
+        q = "UPDATE sessions SET active = 1 " \
+            "WHERE recipient_id = ? AND device_id IN ({})" \
+            .format(placeholders)
+        c.execute(q, [jid] + list(deviceList))
 
-        q = "UPDATE sessions SET active = {} " \
-            "WHERE recipient_id = '{}' AND device_id NOT IN ({})" \
-            .format(0, jid, ', '.join(['?'] * len(deviceList)))
-        c.execute(q, deviceList)
+        q = "UPDATE sessions SET active = 0 " \
+            "WHERE recipient_id = ? AND device_id NOT IN ({})" \
+            .format(placeholders)
+        c.execute(q, [jid] + list(deviceList))
+        self.dbConn.commit()
+
+    def updateActiveState(self, jid, activated, deactivated):
+        """ Only touch the sessions of devices whose state changed. """
+        self.flush()
+        q = "UPDATE sessions SET active = ? " \
+            "WHERE recipient_id = ? AND device_id = ?"
+        rows = [(1, jid, deviceId) for deviceId in activated]
+        rows.extend((0, jid, deviceId) for deviceId in deactivated)
+
+        c = self.dbConn.cursor()
+        c.executemany(q, rows)
         self.dbConn.commit()
 
     def getInactiveSessionsKeys(self, recipientId):
-        q = "SELECT record FROM sessions WHERE active = 0 AND recipient_id = ?"
+        self.flush()
+        q = "SELECT remote_identity_key FROM sessions " \
+            "WHERE active = 0 AND recipient_id = ? " \
+            "AND remote_identity_key IS NOT NULL"
         c = self.dbConn.cursor()
         result = []
         for row in c.execute(q, (recipientId,)):
-            public_key = (SessionRecord(serialized=row[0]).
-                          getSessionState().getRemoteIdentityKey().
-                          getPublicKey())
-            result.append(public_key.serialize())
+            result.append(row[0])
         return result
@@ -17,6 +17,8 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import time
+
 from axolotl.invalidkeyidexception import InvalidKeyIdException
 from axolotl.state.signedprekeyrecord import SignedPreKeyRecord
 from axolotl.state.signedprekeystore import SignedPreKeyStore
@@ -56,9 +58,11 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
         return results
 
     def storeSignedPreKey(self, signedPreKeyId, signedPreKeyRecord):
-        q = "INSERT INTO signed_prekeys (prekey_id, record) VALUES(?,?)"
+        q = "INSERT INTO signed_prekeys (prekey_id, timestamp, record) " \
+            "VALUES(?,?,?)"
         cursor = self.dbConn.cursor()
-        cursor.execute(q, (signedPreKeyId, signedPreKeyRecord.serialize()))
+        cursor.execute(q, (signedPreKeyId, int(time.time()),
+                           signedPreKeyRecord.serialize()))
         self.dbConn.commit()
 
     def containsSignedPreKey(self, signedPreKeyId):
@@ -92,8 +96,7 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
             return result[0]
 
     def getSignedPreKeyTimestamp(self, signedPreKeyId):
-        q = "SELECT strftime('%s', timestamp) FROM " \
-            "signed_prekeys WHERE prekey_id = ?"
+        q = "SELECT timestamp FROM signed_prekeys WHERE prekey_id = ?"
 
         cursor = self.dbConn.cursor()
         cursor.execute(q, (signedPreKeyId, ))
@@ -106,8 +109,7 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
         return result[0]
 
     def removeOldSignedPreKeys(self, timestamp):
-        q = "DELETE FROM signed_prekeys " \
-            "WHERE timestamp < datetime(?, 'unixepoch')"
+        q = "DELETE FROM signed_prekeys WHERE timestamp < ?"
         cursor = self.dbConn.cursor()
         cursor.execute(q, (timestamp, ))
         self.dbConn.commit()
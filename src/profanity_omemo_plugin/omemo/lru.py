@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """ A size bounded mapping which drops the least recently used entry. """
+
+    def __init__(self, maxsize, on_evict=None):
+        """
+        :param maxsize: the maximum amount of entries kept in the cache
+        :param on_evict: optional callable invoked as on_evict(key, value)
+                         whenever an entry is dropped to make room
+        """
+        if maxsize < 1:
+            raise ValueError('LRUCache needs a maxsize of at least 1.')
+
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            # re-insert to mark the entry as most recently used
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+
+        while len(self._data) > self.maxsize:
+            old_key, old_value = self._data.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from axolotl.util.keyhelper import KeyHelper
+from axolotl.util.medium import Medium
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# XEP-0384: the bundle SHOULD contain 100 PreKeys, but MUST contain no less
+# than 20.
+DEFAULT_PREKEY_AMOUNT = 100
+MIN_PREKEY_AMOUNT = 20
+MAX_PREKEY_AMOUNT = 250
+
+# consumption is measured over CONSUMPTION_WINDOW, the pool should survive
+# REFILL_HORIZON seconds at that rate before it is refilled
+CONSUMPTION_WINDOW = 3600
+REFILL_HORIZON = 3600
+
+
+class PreKeyPool(object):
+    """ Keeps the PreKey pool of a :py:class:`LitePreKeyStore` filled.
+
+        The Curve25519 key pairs are generated by a worker thread. Only the
+        bulk insert of finished keys happens on the calling thread, as the
+        sqlite connection belongs to it.
+    """
+
+    def __init__(self, preKeyStore, background=True):
+        self.preKeyStore = preKeyStore
+        self.background = background
+
+        self._consumed = deque()
+        self._ready = queue.Queue()
+        self._jobs = None
+        self._worker = None
+        self._pending = 0
+        self._next_id = None
+
+    @property
+    def consumption_rate(self):
+        """ PreKeys consumed per CONSUMPTION_WINDOW. """
+        self._expire_consumed(time.time())
+        return len(self._consumed)
+
+    @property
+    def low_watermark(self):
+        """ Refill once fewer keys than this are left. """
+        expected = self.consumption_rate * REFILL_HORIZON // CONSUMPTION_WINDOW
+        return min(DEFAULT_PREKEY_AMOUNT // 2 + expected, MAX_PREKEY_AMOUNT // 2)
+
+    @property
+    def target_size(self):
+        """ The amount of keys the pool is filled up to. """
+        return max(DEFAULT_PREKEY_AMOUNT,
+                   min(2 * self.low_watermark, MAX_PREKEY_AMOUNT))
+
+    def consumed(self, count=1):
+        """ Record that PreKeys have been used to build sessions. """
+        now = time.time()
+        for _ in range(count):
+            self._consumed.append(now)
+        self._expire_consumed(now)
+
+    def refill(self):
+        """ Store finished PreKeys and schedule the generation of new ones.
+
+            Keys are only generated on the calling thread if the pool would
+            otherwise drop below the XEP-0384 minimum.
+
+            :returns: the list of PreKeyRecords added to the store
+        """
+        added = self._store_ready()
+
+        count = self.preKeyStore.getPreKeyCount() + self._pending
+        if count >= self.low_watermark:
+            return added
+
+        missing = self.target_size - count
+        if count < MIN_PREKEY_AMOUNT or not self.background:
+            preKeys = self._generate(self._reserve_ids(missing), missing)
+            self.preKeyStore.storePreKeys(preKeys)
+            log.info('%s PreKeys created', len(preKeys))
+            return added + preKeys
+
+        self._schedule(missing)
+        return added
+
+    def join(self):
+        """ Block until all scheduled PreKeys are generated. """
+        if self._jobs is not None:
+            self._jobs.join()
+
+    def _expire_consumed(self, now):
+        while self._consumed and self._consumed[0] < now - CONSUMPTION_WINDOW:
+            self._consumed.popleft()
+
+    def _reserve_ids(self, count):
+        if self._next_id is None:
+            current = self.preKeyStore.getCurrentPreKeyId() or 0
+            self._next_id = current + 1
+
+        start = self._next_id
+        self._next_id = ((start + count - 1) % (Medium.MAX_VALUE - 1)) + 1
+        return start
+
+    def _generate(self, start, count):
+        return KeyHelper.generatePreKeys(start, count)
+
+    def _schedule(self, count):
+        if self._worker is None:
+            self._jobs = queue.Queue()
+            self._worker = threading.Thread(target=self._work,
+                                            name='PreKeyPool')
+            self._worker.daemon = True
+            self._worker.start()
+
+        self._pending += count
+        self._jobs.put((self._reserve_ids(count), count))
+        log.debug('Scheduled generation of %s PreKeys', count)
+
+    def _work(self):
+        while True:
+            start, count = self._jobs.get()
+            try:
+                self._ready.put((count, self._generate(start, count)))
+            except Exception:
+                log.exception('Could not generate PreKeys')
+                self._ready.put((count, []))
+            finally:
+                self._jobs.task_done()
+
+    def _store_ready(self):
+        added = []
+        while True:
+            try:
+                count, preKeys = self._ready.get_nowait()
+            except queue.Empty:
+                break
+
+            self._pending -= count
+            added.extend(preKeys)
+
+        if added:
+            self.preKeyStore.storePreKeys(added)
+            log.info('%s PreKeys created in background', len(added))
+
+        return added
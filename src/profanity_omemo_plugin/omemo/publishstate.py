@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 Bahtiar `kalkin-` Gadimov <bahtiar@gadimov.de>
+# Copyright 2015 Daniel Gultsch <daniel@cgultsch.de>
+#
+# This file is part of Gajim-OMEMO plugin.
+#
+# The Gajim-OMEMO plugin is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# Gajim-OMEMO is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+class PublishState():
+    """ Remembers the content hash of the own published PEP nodes, so
+        unchanged nodes are not published again after a reconnect.
+    """
+
+    def __init__(self, dbConn):
+        """
+        :type dbConn: Connection
+        """
+        self.dbConn = dbConn
+
+    def getHash(self, node):
+        q = 'SELECT hash FROM published_nodes WHERE node = ?'
+        c = self.dbConn.cursor()
+        c.execute(q, (node, ))
+        result = c.fetchone()
+        if result is None:
+            return None
+
+        contentHash = result[0]
+        if isinstance(contentHash, bytes):
+            # the store connection returns text as bytes
+            contentHash = contentHash.decode('ascii')
+        return contentHash
+
+    def setHash(self, node, contentHash):
+        q = """INSERT OR REPLACE INTO published_nodes (node, hash)
+               VALUES (?, ?)"""
+
+        c = self.dbConn.cursor()
+        c.execute(q, (node, contentHash))
+        self.dbConn.commit()
+
+    def removeHash(self, node):
+        q = 'DELETE FROM published_nodes WHERE node = ?'
+
+        c = self.dbConn.cursor()
+        c.execute(q, (node, ))
+        self.dbConn.commit()
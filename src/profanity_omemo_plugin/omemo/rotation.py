@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+from .liteaxolotlstore import SPK_CYCLE_TIME
+
+
+class SignedPreKeyRotation(object):
+    """ Remembers when the current SignedPreKey has to be rotated.
+
+        The deadline is read from the store once and afterwards only
+        updated by :py:meth:`reschedule`, so checking it is free of queries.
+    """
+
+    def __init__(self, signedPreKeyStore, cycleTime=SPK_CYCLE_TIME):
+        self.signedPreKeyStore = signedPreKeyStore
+        self.cycleTime = cycleTime
+        self.deadline = None
+
+    def due(self, now=None):
+        if self.deadline is None:
+            self.reschedule()
+
+        if now is None:
+            now = time.time()
+
+        return now >= self.deadline
+
+    def reschedule(self):
+        """ Calculate the deadline from the current SignedPreKey. """
+        store = self.signedPreKeyStore
+        signedPreKeyId = store.getCurrentSignedPreKeyId()
+        if not signedPreKeyId:
+            # there is no SignedPreKey yet, create one immediately
+            self.deadline = 0
+            return
+
+        timestamp = int(store.getSignedPreKeyTimestamp(signedPreKeyId))
+        self.deadline = timestamp + self.cycleTime
@@ -16,7 +16,31 @@
 # You should have received a copy of the GNU General Public License along with
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
-from .db_helpers import user_version
+from axolotl.state.sessionrecord import SessionRecord
+from google.protobuf.message import DecodeError
+
+from .db_helpers import explicit_transaction, fingerprint, user_version
+
+# Every lookup the stores issue is answered from one of these indexes,
+# the UNIQUE(recipient_id, device_id) constraint of the sessions table or
+# the primary keys of the WITHOUT ROWID tables.
+CREATE_INDEXES = '''
+    CREATE UNIQUE INDEX IF NOT EXISTS
+        identities_recipient_index ON identities (recipient_id, public_key);
+
+    CREATE INDEX IF NOT EXISTS
+        identities_trust_index ON identities (recipient_id, trust, public_key);
+
+    CREATE INDEX IF NOT EXISTS
+        identities_public_key_index ON identities (public_key);
+
+    CREATE INDEX IF NOT EXISTS
+        sessions_device_index ON sessions (device_id, recipient_id);
+
+    CREATE INDEX IF NOT EXISTS
+        sessions_active_index
+        ON sessions (active, recipient_id, device_id, remote_identity_key);
+'''
 
 
 class SQLDatabase():
@@ -55,36 +79,47 @@ class SQLDatabase():
                     next_prekey_id INTEGER, timestamp INTEGER, trust INTEGER,
                     shown INTEGER DEFAULT 0);
 
-                CREATE UNIQUE INDEX IF NOT EXISTS
-                    public_key_index ON identities (public_key, recipient_id);
-
                 CREATE TABLE IF NOT EXISTS prekeys(
-                    _id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    prekey_id INTEGER UNIQUE, sent_to_server BOOLEAN,
-                    record BLOB);
+                    prekey_id INTEGER PRIMARY KEY, record BLOB)
+                    WITHOUT ROWID;
 
                 CREATE TABLE IF NOT EXISTS signed_prekeys (
-                    _id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    prekey_id INTEGER UNIQUE,
-                    timestamp NUMERIC DEFAULT CURRENT_TIMESTAMP, record BLOB);
+                    prekey_id INTEGER PRIMARY KEY,
+                    timestamp INTEGER NOT NULL
+                        DEFAULT (CAST(strftime('%%s', 'now') AS INTEGER)),
+                    record BLOB)
+                    WITHOUT ROWID;
 
                 CREATE TABLE IF NOT EXISTS sessions (
                     _id INTEGER PRIMARY KEY AUTOINCREMENT,
                     recipient_id TEXT, device_id INTEGER,
                     record BLOB, timestamp INTEGER, active INTEGER DEFAULT 1,
+                    remote_identity_key BLOB, fingerprint TEXT,
                     UNIQUE(recipient_id, device_id));
 
                 CREATE TABLE IF NOT EXISTS encryption_state (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    jid TEXT UNIQUE,
-                    encryption INTEGER
-                    );
-                '''
+                    jid TEXT PRIMARY KEY,
+                    encryption INTEGER)
+                    WITHOUT ROWID;
+
+                CREATE TABLE IF NOT EXISTS published_nodes (
+                    node TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL)
+                    WITHOUT ROWID;
+
+                CREATE TABLE IF NOT EXISTS devicelists (
+                    jid TEXT NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    PRIMARY KEY (jid, device_id))
+                    WITHOUT ROWID;
+
+                %s
+                ''' % (CREATE_INDEXES)
 
             create_db_sql = """
                 BEGIN TRANSACTION;
                 %s
-                PRAGMA user_version=5;
+                PRAGMA user_version=9;
                 END TRANSACTION;
                 """ % (create_tables)
             self.dbConn.executescript(create_db_sql)
@@ -152,3 +187,140 @@ class SQLDatabase():
                                           PRAGMA user_version=5;
                                           END TRANSACTION;
                                       """ % (add_timestamp))
+
+        if user_version(self.dbConn) < 6:
+            # Rebuilds the small key tables as WITHOUT ROWID tables, stores
+            # the SignedPreKey timestamps as unix epoch and adds indexes for
+            # the lookups done on every message. The rows are copied inside
+            # sqlite, nothing is loaded into Python.
+            compact_tables = """
+                CREATE TABLE prekeys_v6 (
+                    prekey_id INTEGER PRIMARY KEY, record BLOB)
+                    WITHOUT ROWID;
+                INSERT INTO prekeys_v6 (prekey_id, record)
+                    SELECT prekey_id, record FROM prekeys
+                    WHERE prekey_id IS NOT NULL;
+                DROP TABLE prekeys;
+                ALTER TABLE prekeys_v6 RENAME TO prekeys;
+
+                CREATE TABLE signed_prekeys_v6 (
+                    prekey_id INTEGER PRIMARY KEY,
+                    timestamp INTEGER NOT NULL
+                        DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                    record BLOB)
+                    WITHOUT ROWID;
+                INSERT INTO signed_prekeys_v6 (prekey_id, timestamp, record)
+                    SELECT prekey_id,
+                           COALESCE(CAST(strftime('%s', timestamp) AS INTEGER),
+                                    CAST(strftime('%s', 'now') AS INTEGER)),
+                           record
+                    FROM signed_prekeys
+                    WHERE prekey_id IS NOT NULL;
+                DROP TABLE signed_prekeys;
+                ALTER TABLE signed_prekeys_v6 RENAME TO signed_prekeys;
+
+                CREATE TABLE encryption_state_v6 (
+                    jid TEXT PRIMARY KEY,
+                    encryption INTEGER)
+                    WITHOUT ROWID;
+                INSERT INTO encryption_state_v6 (jid, encryption)
+                    SELECT jid, encryption FROM encryption_state
+                    WHERE jid IS NOT NULL;
+                DROP TABLE encryption_state;
+                ALTER TABLE encryption_state_v6 RENAME TO encryption_state;
+
+                DROP INDEX IF EXISTS public_key_index;
+                CREATE UNIQUE INDEX IF NOT EXISTS identities_recipient_index
+                    ON identities (recipient_id, public_key);
+                CREATE INDEX IF NOT EXISTS identities_trust_index
+                    ON identities (recipient_id, trust, public_key);
+                CREATE INDEX IF NOT EXISTS identities_public_key_index
+                    ON identities (public_key);
+                CREATE INDEX IF NOT EXISTS sessions_device_index
+                    ON sessions (device_id, recipient_id);
+                CREATE INDEX IF NOT EXISTS sessions_active_index
+                    ON sessions (active, recipient_id, device_id);
+            """
+
+            self.dbConn.executescript(""" BEGIN TRANSACTION;
+                                          %s
+                                          PRAGMA user_version=6;
+                                          END TRANSACTION;
+                                      """ % (compact_tables))
+
+        if user_version(self.dbConn) < 7:
+            # Adds the remote identity key of every session as own column,
+            # trust lookups no longer have to parse the SessionRecord
+            add_identity_key = [
+                'ALTER TABLE sessions ADD COLUMN remote_identity_key BLOB',
+                'ALTER TABLE sessions ADD COLUMN fingerprint TEXT',
+                'DROP INDEX IF EXISTS sessions_active_index',
+                '''CREATE INDEX sessions_active_index
+                       ON sessions (active, recipient_id, device_id,
+                                    remote_identity_key)''']
+
+            # the schema change and the backfill are one transaction
+            with explicit_transaction(self.dbConn):
+                for statement in add_identity_key:
+                    self.dbConn.execute(statement)
+                self._backfillRemoteIdentityKeys()
+                self.dbConn.execute('PRAGMA user_version=7')
+
+        if user_version(self.dbConn) < 8:
+            # Remembers the content hash of the own published PEP nodes
+            self.dbConn.executescript(""" BEGIN TRANSACTION;
+                CREATE TABLE IF NOT EXISTS published_nodes (
+                    node TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL)
+                    WITHOUT ROWID;
+                PRAGMA user_version=8;
+                END TRANSACTION;
+            """)
+
+        if user_version(self.dbConn) < 9:
+            # Stores the devicelists of all contacts, the lists known so far
+            # are taken from the active sessions
+            self.dbConn.executescript(""" BEGIN TRANSACTION;
+                CREATE TABLE IF NOT EXISTS devicelists (
+                    jid TEXT NOT NULL,
+                    device_id INTEGER NOT NULL,
+                    PRIMARY KEY (jid, device_id))
+                    WITHOUT ROWID;
+                INSERT OR IGNORE INTO devicelists (jid, device_id)
+                    SELECT recipient_id, device_id FROM sessions
+                    WHERE active = 1 AND recipient_id IS NOT NULL
+                    AND device_id IS NOT NULL;
+                PRAGMA user_version=9;
+                END TRANSACTION;
+            """)
+
+    def _backfillRemoteIdentityKeys(self, batchSize=100):
+        """ Parse the stored SessionRecords batch by batch and write their
+            remote identity keys.
+        """
+        select = "SELECT _id, record FROM sessions WHERE _id > ? " \
+                 "ORDER BY _id LIMIT ?"
+        update = "UPDATE sessions SET remote_identity_key = ?, " \
+                 "fingerprint = ? WHERE _id = ?"
+        c = self.dbConn.cursor()
+        lastId = -1
+        while True:
+            rows = c.execute(select, (lastId, batchSize)).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for _id, record in rows:
+                try:
+                    identityKey = SessionRecord(serialized=record) \
+                        .getSessionState().getRemoteIdentityKey()
+                except DecodeError:
+                    # unreadable records are left without a key
+                    continue
+
+                if identityKey is not None:
+                    publicKey = identityKey.getPublicKey().serialize()
+                    updates.append((publicKey, fingerprint(publicKey), _id))
+
+            c.executemany(update, updates)
+            lastId = rows[-1][0]
@@ -20,6 +20,8 @@
 import logging
 import time
 from base64 import b64encode
+from collections import OrderedDict
+from functools import wraps
 
 from Crypto.Random import get_random_bytes
 from axolotl.duplicatemessagexception import DuplicateMessageException
@@ -37,9 +39,11 @@ from axolotl.untrustedidentityexception import UntrustedIdentityException
 from axolotl.util.keyhelper import KeyHelper
 
 from .aes_gcm import NoValidSessions, decrypt, encrypt
-from .liteaxolotlstore import (LiteAxolotlStore, DEFAULT_PREKEY_AMOUNT,
-                               MIN_PREKEY_AMOUNT, SPK_CYCLE_TIME,
+from .liteaxolotlstore import (LiteAxolotlStore, SPK_CYCLE_TIME,
                                SPK_ARCHIVE_TIME)
+from .lru import LRUCache
+from .prekeypool import PreKeyPool
+from .rotation import SignedPreKeyRotation
 
 log = logging.getLogger('gajim.plugin_system.omemo')
 logAxolotl = logging.getLogger('axolotl')
@@ -49,35 +53,65 @@ UNTRUSTED = 0
 TRUSTED = 1
 UNDECIDED = 2
 
+# SessionCiphers kept for the most recently used devices
+DEFAULT_CIPHER_CACHE_SIZE = 512
+
+
+class UntrustedSender(Exception):
+    pass
+
+
+def transactional(func):
+    """ Run the decorated method in a single store transaction. """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            with self.store.transaction():
+                return func(self, *args, **kwargs)
+        except Exception:
+            # the bundle may miss PreKeys whose removal was rolled back
+            self._bundle = None
+            self._bundle_prekeys = None
+            raise
+    return wrapper
+
 
 class OmemoState:
-    def __init__(self, own_jid, connection, account, plugin):
+    def __init__(self, own_jid, connection, account, plugin,
+                 blind_trust=False,
+                 cipher_cache_size=DEFAULT_CIPHER_CACHE_SIZE):
         """ Instantiates an OmemoState object.
 
             :param connection: an :py:class:`sqlite3.Connection`
+            :param blind_trust: trust every identity which is not explicitly
+                marked as untrusted
+            :param cipher_cache_size: the amount of SessionCiphers kept
         """
         self.account = account
+        self.blind_trust = blind_trust
         self.plugin = plugin
-        self.session_ciphers = {}
+        # SessionCiphers by (jid, device_id), they only reference the store
+        # so dropping one loses nothing
+        self.session_ciphers = LRUCache(cipher_cache_size,
+                                        on_evict=self._cipher_evicted)
         self.own_jid = own_jid
-        self.device_ids = {}
-        self.own_devices = []
         self.store = LiteAxolotlStore(connection)
         self.encryption = self.store.encryptionStore
-        for jid, device_id in self.store.getActiveDeviceTuples():
-            if jid != own_jid:
-                self.add_device(jid, device_id)
-            else:
-                self.add_own_device(device_id)
-
-        log.info(self.account + ' => Roster devices after boot:' +
-                 str(self.device_ids))
+        self.prekey_pool = PreKeyPool(self.store.preKeyStore)
+        self.spk_rotation = SignedPreKeyRotation(self.store.signedPreKeyStore)
+        # the bundle is rebuilt only if prekeys or the signed prekey changed
+        self._bundle = None
+        self._bundle_prekeys = None
+
+        log.info(self.account + ' => Devicelists known after boot: ' +
+                 str(len(self.store.getDeviceListJids())))
         log.info(self.account + ' => Own devices after boot:' +
-                 str(self.own_devices))
+                 str(sorted(self.own_devices)))
         log.debug(self.account + ' => ' +
                   str(self.store.preKeyStore.getPreKeyCount()) +
                   ' PreKeys available')
 
+    @transactional
     def build_session(self, recipient_id, device_id, bundle_dict):
         sessionBuilder = SessionBuilder(self.store, self.store, self.store,
                                         self.store, recipient_id, device_id)
@@ -111,14 +145,11 @@ class OmemoState:
                 A list of devices
         """
 
-        self.device_ids[name] = devices
+        self.store.setDevices(name, devices)
         log.info(self.account + ' => Saved devices for ' + name)
 
     def add_device(self, name, device_id):
-        if name not in self.device_ids:
-            self.device_ids[name] = [device_id]
-        elif device_id not in self.device_ids[name]:
-            self.device_ids[name].append(device_id)
+        self.store.addDevice(name, device_id)
 
     def set_own_devices(self, devices):
         """ Overwrite the current :py:attribute:`OmemoState.own_devices` with
@@ -129,12 +160,36 @@ class OmemoState:
             devices : [int]
                 A list of device_ids
         """
-        self.own_devices = devices
+        self.store.setDevices(self.own_jid, devices)
         log.info(self.account + ' => Saved own devices')
 
+    def update_devices(self, jid, devices):
+        """ Apply a received devicelist, only the devices that were added
+            or removed are written together with their session state.
+
+            Returns
+            -------
+            bool
+                `False` if the devicelist did not change
+        """
+        if set(devices) == self.store.getDevices(jid):
+            return False
+
+        with self.store.transaction():
+            added, removed = self.store.setDevices(jid, devices)
+            self.store.sessionStore.updateActiveState(jid, added, removed)
+
+        log.info(self.account + ' => Devices of ' + jid + ' changed, added: ' +
+                 str(sorted(added)) + ' removed: ' + str(sorted(removed)))
+        return True
+
     def add_own_device(self, device_id):
-        if device_id not in self.own_devices:
-            self.own_devices.append(device_id)
+        self.store.addDevice(self.own_jid, device_id)
+
+    @property
+    def own_devices(self):
+        """ The set of published device ids of the own account. """
+        return self.store.getDevices(self.own_jid)
 
     @property
     def own_device_id(self):
@@ -152,15 +207,21 @@ class OmemoState:
 
     @property
     def bundle(self):
-        self.checkPreKeyAmount()
-        prekeys = [
-            (k.getId(), b64encode(k.getKeyPair().getPublicKey().serialize()))
-            for k in self.store.loadPreKeys()
-        ]
+        if self._bundle is None:
+            self._bundle = self._build_bundle()
 
+        return self._bundle
+
+    def _build_bundle(self):
         identityKeyPair = self.store.getIdentityKeyPair()
+        self.checkPreKeyAmount()
 
-        self.cycleSignedPreKey(identityKeyPair)
+        if not self.store.getCurrentSignedPreKeyId():
+            self.cycleSignedPreKey(identityKeyPair)
+
+        if self._bundle_prekeys is None:
+            self._bundle_prekeys = OrderedDict()
+            self._add_bundle_prekeys(self.store.loadPreKeys())
 
         signedPreKey = self.store.loadSignedPreKey(
             self.store.getCurrentSignedPreKeyId())
@@ -168,14 +229,32 @@ class OmemoState:
         result = {
             'signedPreKeyId': signedPreKey.getId(),
             'signedPreKeyPublic':
-            b64encode(signedPreKey.getKeyPair().getPublicKey().serialize()),
-            'signedPreKeySignature': b64encode(signedPreKey.getSignature()),
+            _b64(signedPreKey.getKeyPair().getPublicKey().serialize()),
+            'signedPreKeySignature': _b64(signedPreKey.getSignature()),
             'identityKey':
-            b64encode(identityKeyPair.getPublicKey().serialize()),
-            'prekeys': prekeys
+            _b64(identityKeyPair.getPublicKey().serialize()),
+            'prekeys': list(self._bundle_prekeys.items())
         }
         return result
 
+    def _add_bundle_prekeys(self, preKeys):
+        if self._bundle_prekeys is None:
+            return
+
+        for k in preKeys:
+            public_key = k.getKeyPair().getPublicKey().serialize()
+            self._bundle_prekeys[k.getId()] = _b64(public_key)
+
+        self._bundle = None
+
+    def _remove_bundle_prekey(self, preKeyId):
+        if self._bundle_prekeys is None:
+            return
+
+        if self._bundle_prekeys.pop(preKeyId, None) is not None:
+            self._bundle = None
+
+    @transactional
     def decrypt_msg(self, msg_dict):
         own_id = self.own_device_id
         if msg_dict['sid'] == own_id:
@@ -206,6 +285,9 @@ class OmemoState:
             except (DuplicateMessageException) as e:
                 log.warning('Duplicate message found ' + str(e.args))
                 return
+            except UntrustedSender as e:
+                log.warning('Dropped message => ' + str(e))
+                return
 
         except (DuplicateMessageException) as e:
             log.warning('Duplicate message found ' + str(e.args))
@@ -220,6 +302,7 @@ class OmemoState:
         log.debug("Decrypted Message => " + result)
         return result
 
+    @transactional
     def create_msg(self, from_jid, jid, plaintext):
         key = get_random_bytes(16)
         iv = get_random_bytes(16)
@@ -237,14 +320,15 @@ class OmemoState:
         # Encrypt the message key with for each of receivers devices
         for device in devices_list:
             try:
-                if self.isTrusted(jid, device) == TRUSTED:
+                trust = self.isTrusted(jid, device)
+                if trust == TRUSTED:
                     cipher = self.get_session_cipher(jid, device)
                     cipher_key = cipher.encrypt(key)
                     prekey = isinstance(cipher_key, PreKeyWhisperMessage)
                     encrypted_keys[device] = (cipher_key.serialize(), prekey)
                 else:
                     log.debug('Skipped Device because Trust is: ' +
-                              str(self.isTrusted(jid, device)))
+                              str(trust))
             except:
                 log.warning('Failed to find key for device ' + str(device))
 
@@ -256,14 +340,15 @@ class OmemoState:
         # Encrypt the message key with for each of our own devices
         for device in my_other_devices:
             try:
-                if self.isTrusted(from_jid, device) == TRUSTED:
+                trust = self.isTrusted(from_jid, device)
+                if trust == TRUSTED:
                     cipher = self.get_session_cipher(from_jid, device)
                     cipher_key = cipher.encrypt(key)
                     prekey = isinstance(cipher_key, PreKeyWhisperMessage)
                     encrypted_keys[device] = (cipher_key.serialize(), prekey)
                 else:
                     log.debug('Skipped own Device because Trust is: ' +
-                              str(self.isTrusted(from_jid, device)))
+                              str(trust))
             except:
                 log.warning('Failed to find key for device ' + str(device))
 
@@ -276,6 +361,7 @@ class OmemoState:
         log.debug('Finished encrypting message')
         return result
 
+    @transactional
     def create_gc_msg(self, from_jid, jid, plaintext):
         key = get_random_bytes(16)
         iv = get_random_bytes(16)
@@ -293,9 +379,6 @@ class OmemoState:
 
         key += tag
 
-        for tup in devices_list:
-            self.get_session_cipher(tup[0], tup[1])
-
         # Encrypt the message key with for each of receivers devices
         for nick in self.plugin.groupchat[room]:
             jid_to = self.plugin.groupchat[room][nick]
@@ -303,15 +386,17 @@ class OmemoState:
                 continue
             if jid_to in encrypted_jids:  # We already encrypted to this JID
                 continue
-            for rid, cipher in self.session_ciphers[jid_to].items():
+            for rid in self.store.getDevices(jid_to):
                 try:
-                    if self.isTrusted(jid_to, rid) == TRUSTED:
+                    trust = self.isTrusted(jid_to, rid)
+                    if trust == TRUSTED:
+                        cipher = self.get_session_cipher(jid_to, rid)
                         cipher_key = cipher.encrypt(key)
                         prekey = isinstance(cipher_key, PreKeyWhisperMessage)
                         encrypted_keys[rid] = (cipher_key.serialize(), prekey)
                     else:
                         log.debug('Skipped Device because Trust is: ' +
-                                  str(self.isTrusted(jid_to, rid)))
+                                  str(trust))
                 except:
                     log.exception('ERROR:')
                     log.warning('Failed to find key for device ' +
@@ -327,13 +412,14 @@ class OmemoState:
         for dev in my_other_devices:
             try:
                 cipher = self.get_session_cipher(from_jid, dev)
-                if self.isTrusted(from_jid, dev) == TRUSTED:
+                trust = self.isTrusted(from_jid, dev)
+                if trust == TRUSTED:
                     cipher_key = cipher.encrypt(key)
                     prekey = isinstance(cipher_key, PreKeyWhisperMessage)
                     encrypted_keys[dev] = (cipher_key.serialize(), prekey)
                 else:
                     log.debug('Skipped own Device because Trust is: ' +
-                              str(self.isTrusted(from_jid, dev)))
+                              str(trust))
             except:
                 log.exception('ERROR:')
                 log.warning('Failed to find key for device ' + str(dev))
@@ -363,20 +449,21 @@ class OmemoState:
                 jid_to = self.plugin.groupchat[room][nick]
                 if jid_to == self.own_jid:
                     continue
-                for device in self.device_ids[jid_to]:
+                for device in self.store.getDevices(jid_to):
                     devicelist.append((jid_to, device))
             return devicelist
 
         if jid == self.own_jid:
             return set(self.own_devices) - set({self.own_device_id})
-        if jid not in self.device_ids:
-            return set()
-        return set(self.device_ids[jid])
+        return set(self.store.getDevices(jid))
 
     def isTrusted(self, recipient_id, device_id):
-        record = self.store.loadSession(recipient_id, device_id)
-        identity_key = record.getSessionState().getRemoteIdentityKey()
-        return self.store.isTrustedIdentity(recipient_id, identity_key)
+        trust = self.store.getDeviceTrust(recipient_id, device_id)
+        if trust is None:
+            raise NoSessionException('No session for ' + recipient_id)
+        if self.blind_trust and trust != UNTRUSTED:
+            return TRUSTED
+        return trust
 
     def getFingerprints(self, recipient_id):
         return self.store.getFingerprints(recipient_id)
@@ -409,24 +496,26 @@ class OmemoState:
                 A list of device_ids
         """
         known_devices = self.device_list_for(jid)
-        missing_devices = [dev
-                           for dev in known_devices
-                           if not self.store.containsSession(jid, dev)]
+        ready = self.store.getSessionDevices(jid)
+        missing_devices = [dev for dev in known_devices if dev not in ready]
         if missing_devices:
             log.info(self.account + ' => Missing device sessions for ' +
                      jid + ': ' + str(missing_devices))
         return missing_devices
 
     def get_session_cipher(self, jid, device_id):
-        if jid not in self.session_ciphers:
-            self.session_ciphers[jid] = {}
-
-        if device_id not in self.session_ciphers[jid]:
+        key = (jid, device_id)
+        cipher = self.session_ciphers.get(key)
+        if cipher is None:
             cipher = SessionCipher(self.store, self.store, self.store,
                                    self.store, jid, device_id)
-            self.session_ciphers[jid][device_id] = cipher
+            self.session_ciphers.put(key, cipher)
 
-        return self.session_ciphers[jid][device_id]
+        return cipher
+
+    def _cipher_evicted(self, key, cipher):
+        log.debug(self.account + ' => Dropped SessionCipher of ' +
+                  str(key[0]) + ':' + str(key[1]))
 
     def handlePreKeyWhisperMessage(self, recipient_id, device_id, key):
         preKeyWhisperMessage = PreKeyWhisperMessage(serialized=key)
@@ -438,10 +527,22 @@ class OmemoState:
             log.debug(self.account +
                       " => Received PreKeyWhisperMessage from " +
                       recipient_id)
-            key = sessionCipher.decryptPkmsg(preKeyWhisperMessage)
+            try:
+                key = sessionCipher.decryptPkmsg(preKeyWhisperMessage)
+            except Exception:
+                # the cached record may be half way through processing the
+                # message, reload the last stored state on the next access
+                self.store.invalidateSession(recipient_id, device_id)
+                raise
+            preKeyId = preKeyWhisperMessage.getPreKeyId()
+            if not self.store.containsPreKey(preKeyId):
+                self._remove_bundle_prekey(preKeyId)
+                self.prekey_pool.consumed()
+
             # Publish new bundle after PreKey has been used
-            # for building a new Session
-            self.plugin.publish_bundle(self.account)
+            # for building a new Session, once its removal is committed
+            self.store.afterCommit(
+                lambda: self.plugin.publish_bundle(self.account))
             self.add_device(recipient_id, device_id)
             return key
         except UntrustedIdentityException as e:
@@ -452,28 +553,47 @@ class OmemoState:
         whisperMessage = WhisperMessage(serialized=key)
         log.debug(self.account + " => Received WhisperMessage from " +
                   recipient_id)
-        if self.isTrusted(recipient_id, device_id):
+        if self.isTrusted(recipient_id, device_id) == TRUSTED:
             sessionCipher = self.get_session_cipher(recipient_id, device_id)
             key = sessionCipher.decryptMsg(whisperMessage)
             self.add_device(recipient_id, device_id)
             return key
         else:
-            raise Exception("Received WhisperMessage "
-                            "from Untrusted Fingerprint! => " + recipient_id)
+            raise UntrustedSender("Received WhisperMessage from "
+                                  "untrusted device " + str(device_id) +
+                                  " of " + recipient_id)
 
+    @transactional
     def checkPreKeyAmount(self):
-        # Check if enough PreKeys are available
-        preKeyCount = self.store.preKeyStore.getPreKeyCount()
-        if preKeyCount < MIN_PREKEY_AMOUNT:
-            newKeys = DEFAULT_PREKEY_AMOUNT - preKeyCount
-            self.store.preKeyStore.generateNewPreKeys(newKeys)
-            log.info(self.account + ' => ' + str(newKeys) +
-                     ' PreKeys created')
+        # Check if enough PreKeys are available, new keys are generated in
+        # the background and added on one of the next calls
+        preKeys = self.prekey_pool.refill()
+        if preKeys:
+            self._add_bundle_prekeys(preKeys)
+            log.info(self.account + ' => ' + str(len(preKeys)) +
+                     ' PreKeys added')
+        return preKeys
+
+    def rotate_signed_prekey_if_due(self):
+        """ Rotate the SignedPreKey if SPK_CYCLE_TIME has passed.
+
+            Returns
+            -------
+            bool
+                `True` if the bundle changed and should be published again
+        """
+        if not self.spk_rotation.due():
+            return False
 
+        return self.cycleSignedPreKey(self.store.getIdentityKeyPair())
+
+    @transactional
     def cycleSignedPreKey(self, identityKeyPair):
         # Publish every SPK_CYCLE_TIME a new SignedPreKey
         # Delete all exsiting SignedPreKeys that are older
         # then SPK_ARCHIVE_TIME
+        # Returns True if a new SignedPreKey was created
+        created = False
 
         # Check if SignedPreKey exist and create if not
         if not self.store.getCurrentSignedPreKeyId():
@@ -482,6 +602,7 @@ class OmemoState:
             self.store.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
             log.debug(self.account +
                       ' => New SignedPreKey created, because none existed')
+            created = True
 
         # if SPK_CYCLE_TIME is reached, generate a new SignedPreKey
         now = int(time.time())
@@ -493,7 +614,18 @@ class OmemoState:
                 identityKeyPair, self.store.getNextSignedPreKeyId())
             self.store.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
             log.debug(self.account + ' => Cycled SignedPreKey')
+            created = True
 
         # Delete all SignedPreKeys that are older than SPK_ARCHIVE_TIME
         timestamp = now - SPK_ARCHIVE_TIME
         self.store.removeOldSignedPreKeys(timestamp)
+
+        self.spk_rotation.reschedule()
+        if created:
+            self._bundle = None
+
+        return created
+
+
+def _b64(data):
+    return b64encode(data).decode('ascii')
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import deque
+
+from profanity_omemo_plugin.log import get_plugin_logger
+from profanity_omemo_plugin.prof_omemo_state import ProfOmemoState
+
+logger = get_plugin_logger(__name__)
+
+# requests sent per prefetch run
+PREFETCH_REQUESTS_PER_RUN = 5
+
+
+class SessionPrefetcher(object):
+    """ Builds sessions with contacts before the first message is sent.
+
+    Every :py:meth:`run` sends at most ``budget`` requests. First the
+    devicelist of each contact is queried, in a later run the bundles of
+    its devices without session are requested. The sessions are built when
+    the bundles arrive, like for any other bundle response.
+    """
+
+    def __init__(self, budget=PREFETCH_REQUESTS_PER_RUN):
+        self.budget = budget
+        self._devicelists = deque()  # jids to query the devicelist for
+        self._bundles = deque()  # jids to request missing bundles for
+        self._devices = deque()  # (jid, device_id) to request bundles for
+        self._queued = set()
+
+    def __len__(self):
+        return len(self._devicelists) + len(self._bundles) + len(self._devices)
+
+    def add(self, jids):
+        """ Queue contacts, contacts queued before are skipped. """
+        for jid in jids:
+            if jid and jid not in self._queued:
+                self._queued.add(jid)
+                self._devicelists.append(jid)
+
+    def run(self):
+        """ Send the next requests.
+
+        :returns: the number of requests sent
+        """
+        sent = 0
+        # only contacts whose devicelist was queried in an earlier run
+        # have a chance to know their devices
+        ready = len(self._bundles)
+
+        while sent < self.budget and self._devicelists:
+            jid = self._devicelists.popleft()
+            if self.query_device_list(jid):
+                sent += 1
+            self._bundles.append(jid)
+
+        while sent < self.budget and (self._devices or ready):
+            if not self._devices:
+                jid = self._bundles.popleft()
+                ready -= 1
+                missing = self.missing_devices(jid)
+                self._devices.extend((jid, device) for device in missing)
+                continue
+
+            jid, device_id = self._devices.popleft()
+            if self.query_bundle(jid, device_id):
+                sent += 1
+
+        if sent:
+            logger.debug('Prefetch sent %s requests, %s left', sent, len(self))
+
+        return sent
+
+    def clear(self):
+        self._devicelists.clear()
+        self._bundles.clear()
+        self._devices.clear()
+        self._queued.clear()
+
+    def missing_devices(self, jid):
+        return ProfOmemoState().devices_without_sessions(jid)
+
+    def query_device_list(self, jid):
+        # request the devicelist, returns True if a request was sent
+        return False
+
+    def query_bundle(self, jid, device_id):
+        # request the bundle, returns True if a request was sent
+        return False
@@ -20,8 +20,6 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-import prof
-
 from profanity_omemo_plugin.db import get_connection
 from profanity_omemo_plugin.log import get_plugin_logger
 
@@ -29,12 +27,6 @@ logger = get_plugin_logger(__name__)
 
 from profanity_omemo_plugin.omemo.state import OmemoState
 
-# Monkeypatching trusted state until it has been implemented correctly
-def _isTrusted(self, recipient_id, device_id):
-    return True
-
-OmemoState.isTrusted = _isTrusted
-
 
 class DummyPLugin(object):
     def publish_bundle(self, account):
@@ -59,7 +51,10 @@ class ProfOmemoState(object):
         if own_jid not in cls.__states:
             # create the OmemoState for the current user
             connection = get_connection(own_jid)
-            new_state = OmemoState(own_jid, connection, account, DummyPLugin())
+            # trust handling is not implemented yet, trust every identity
+            # which was not explicitly marked as untrusted
+            new_state = OmemoState(own_jid, connection, account, DummyPLugin(),
+                                   blind_trust=True)
             cls.__states[own_jid] = new_state
 
         return cls.__states[own_jid]
@@ -74,10 +69,10 @@ class ProfActiveOmemoChats(object):
         raw_jid = cls.as_raw_jid(contact_jid)
         if raw_jid not in cls._active:
             cls._active[raw_jid] = {'deactivated': False}
-            prof.log_info('Added {0} to active chats'.format(raw_jid))
+            logger.info('Added %s to active chats', raw_jid)
         else:
             cls.activate(raw_jid)
-            prof.log_info('Chat with {0} re-activated.')
+            logger.info('Chat with %s re-activated.', raw_jid)
 
     @classmethod
     def activate(cls, contact_jid):
@@ -105,7 +100,7 @@ class ProfActiveOmemoChats(object):
     @classmethod
     def account_is_registered(cls, contact_jid):
         raw_jid = cls.as_raw_jid(contact_jid)
-        prof.log_info('Active Chats: [{0}]'.format(', '.join(cls._active)))
+        logger.debug('Active Chats: %s', cls._active)
         active_user = cls._active.get(raw_jid)
 
         return active_user is not None
@@ -113,7 +108,7 @@ class ProfActiveOmemoChats(object):
     @classmethod
     def account_is_active(cls, contact_jid):
         raw_jid = cls.as_raw_jid(contact_jid)
-        prof.log_info('Active Chats: [{0}]'.format(', '.join(cls._active)))
+        logger.debug('Active Chats: %s', cls._active)
         active_user = cls._active.get(raw_jid)
         if not active_user:
             return False
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+import uuid
+from collections import namedtuple
+
+# seconds until an unanswered request counts as failed
+REQUEST_TIMEOUT = 30
+# seconds to wait before repeating a failed request, doubled on every
+# further failure up to MAX_BACKOFF
+BACKOFF = 60
+MAX_BACKOFF = 3600
+
+# the context of an outstanding request, device_id is None for devicelists
+PendingRequest = namedtuple('PendingRequest',
+                            ['id', 'requester', 'jid', 'device_id', 'sent'])
+
+
+class RequestTracker(object):
+    """ Keeps track of outstanding bundle and devicelist requests.
+
+    Requests are identified by ``(jid, device_id)``, device_id is None for
+    devicelist queries. While a request is in flight or backing off after
+    a failure, equal requests are suppressed.
+
+    Responses are matched by the id of the request, which maps to its
+    :py:class:`PendingRequest` context.
+    """
+
+    def __init__(self, timeout=REQUEST_TIMEOUT, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF):
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._pending = {}  # key -> request id
+        self._requests = {}  # request id -> PendingRequest
+        self._failures = {}  # key -> (failed attempts, time of next retry)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def start(self, jid, device_id=None, requester=None, now=None):
+        """ Register a new request.
+
+        :returns: the id to send the request with, or None if the request
+                  should not be sent now
+        """
+        if now is None:
+            now = time.time()
+
+        key = (jid, device_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            if now - self._requests[pending].sent < self.timeout:
+                return None
+            self._fail(pending, now)
+
+        failures = self._failures.get(key)
+        if failures is not None and now < failures[1]:
+            return None
+
+        request_id = str(uuid.uuid4())
+        self._pending[key] = request_id
+        self._requests[request_id] = PendingRequest(request_id, requester,
+                                                    jid, device_id, now)
+        return request_id
+
+    def lookup(self, request_id):
+        """ :returns: the PendingRequest with the given id or None """
+        return self._requests.get(request_id)
+
+    def resolve(self, request_id, error=False, now=None):
+        """ Mark the request with the given id as answered.
+
+        An error response counts as a failure, the next request backs off.
+
+        :returns: the PendingRequest or None if the id is unknown
+        """
+        request = self._requests.get(request_id)
+        if request is None:
+            return None
+
+        if error:
+            self._fail(request_id, time.time() if now is None else now)
+        else:
+            del self._requests[request_id]
+            del self._pending[(request.jid, request.device_id)]
+            self._failures.pop((request.jid, request.device_id), None)
+
+        return request
+
+    def expire(self, now=None):
+        """ Count requests without answer after the timeout as failed. """
+        if now is None:
+            now = time.time()
+
+        expired = [request.id for request in self._requests.values()
+                   if now - request.sent >= self.timeout]
+        for request_id in expired:
+            self._fail(request_id, now)
+
+        return len(expired)
+
+    def forget(self, jid, device_id=None):
+        """ Allow the next request for ``(jid, device_id)`` right away. """
+        key = (jid, device_id)
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            del self._requests[pending]
+        self._failures.pop(key, None)
+
+    def clear(self):
+        self._pending.clear()
+        self._requests.clear()
+        self._failures.clear()
+
+    def _fail(self, request_id, now):
+        request = self._requests.pop(request_id)
+        key = (request.jid, request.device_id)
+        del self._pending[key]
+
+        attempts = self._failures.get(key, (0, 0))[0] + 1
+        delay = min(self.backoff * 2 ** min(attempts - 1, 16),
+                    self.max_backoff)
+        self._failures[key] = (attempts, now + delay)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import time
+from collections import deque
+
+# priority classes, lower values are sent first
+PRIORITY_CHAT = 0  # chat messages
+PRIORITY_SESSION = 1  # devicelist and bundle traffic of the current chats
+PRIORITY_BACKGROUND = 2  # prefetch and other background queries
+PRIORITY_NAMES = ('chat', 'session', 'background')
+
+# stanzas per second and the size of a burst
+STANZA_RATE = 10
+STANZA_BURST = 20
+
+
+class TokenBucket(object):
+    """ Allows rate operations per second with bursts of up to capacity. """
+
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def take(self):
+        """ :returns: True if a token was available and is used now """
+        now = self.clock()
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class OutboundScheduler(object):
+    """ Sends stanzas by priority class, limited by a token bucket.
+
+    Stanzas are sent right away while tokens are left and no stanza of the
+    same or a higher priority is waiting. Otherwise they are queued until
+    :py:meth:`drain` is called again.
+    """
+
+    def __init__(self, rate=STANZA_RATE, burst=STANZA_BURST,
+                 clock=time.time):
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.clock = clock
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+
+        # metrics per priority class
+        self.sent = [0 for _ in PRIORITY_NAMES]
+        self.max_depth = [0 for _ in PRIORITY_NAMES]
+        self.total_wait = [0.0 for _ in PRIORITY_NAMES]
+        self.max_wait = [0.0 for _ in PRIORITY_NAMES]
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues)
+
+    def send(self, stanza, priority=PRIORITY_BACKGROUND):
+        """ Queue a stanza and send as many stanzas as allowed. """
+        queue = self._queues[priority]
+        queue.append((stanza, self.clock()))
+        self.max_depth[priority] = max(self.max_depth[priority], len(queue))
+        self.drain()
+
+    def drain(self):
+        """ Send queued stanzas by priority while tokens are left.
+
+        :returns: the number of sent stanzas
+        """
+        sent = 0
+        for priority, queue in enumerate(self._queues):
+            while queue:
+                if not self.bucket.take():
+                    return sent
+
+                stanza, queued = queue.popleft()
+                wait = self.clock() - queued
+                self.sent[priority] += 1
+                self.total_wait[priority] += wait
+                self.max_wait[priority] = max(self.max_wait[priority], wait)
+
+                self.post(stanza)
+                sent += 1
+
+        return sent
+
+    def clear(self):
+        for queue in self._queues:
+            queue.clear()
+
+    def stats(self):
+        """ The metrics of every priority class, highest priority first. """
+        result = []
+        for priority, name in enumerate(PRIORITY_NAMES):
+            sent = self.sent[priority]
+            result.append({
+                'name': name,
+                'depth': len(self._queues[priority]),
+                'max_depth': self.max_depth[priority],
+                'sent': sent,
+                'avg_wait': self.total_wait[priority] / sent if sent else 0.0,
+                'max_wait': self.max_wait[priority],
+            })
+        return result
+
+    def post(self, stanza):
+        # hand the stanza to the connection, e.g. prof.send_stanza(stanza)
+        pass
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Precompiled templates for the stanzas the plugin sends.
+
+The templates are split into their static fragments once at import time,
+rendering a stanza only fills the slots and joins the parts once.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from string import Formatter
+from xml.sax.saxutils import escape
+
+from profanity_omemo_plugin.constants import (NS_BUNDLES, NS_DEVICE_LIST,
+                                              NS_OMEMO, NS_PUBSUB)
+
+
+def quote_attr(value):
+    """ Escape a value for use in a double quoted XML attribute. """
+    return escape(value, {'"': '&quot;'})
+
+
+class StanzaTemplate(object):
+    """ A stanza template with ``{name}`` placeholders.
+
+        Values given as keyword arguments to the constructor are static, they
+        are escaped and merged into the surrounding fragments right away.
+        All other placeholders are slots filled by :py:meth:`render`.
+    """
+
+    def __init__(self, template, **static):
+        parts = ['']
+        slots = []
+        for literal, name, _, _ in Formatter().parse(template):
+            parts[-1] += literal
+            if name is None:
+                continue
+
+            if name in static:
+                parts[-1] += quote_attr(static[name])
+            else:
+                slots.append((len(parts), name))
+                parts.extend([None, ''])
+
+        self.parts = parts
+        self.slots = slots
+
+    def render(self, **values):
+        """ Fill the slots with the given text values.
+
+            The values are inserted as they are, escaping is up to the caller
+            as most of them are base64 or numbers.
+        """
+        parts = list(self.parts)
+        for index, name in self.slots:
+            parts[index] = values[name]
+
+        return ''.join(parts)
+
+    def render_each(self, rows):
+        """ Render the template for every tuple of slot values and join the
+            results, the values of a row are given in slot order.
+        """
+        parts = list(self.parts)
+        indexes = [index for index, _ in self.slots]
+        result = []
+        for row in rows:
+            for index, value in zip(indexes, row):
+                parts[index] = value
+            result.extend(parts)
+
+        return ''.join(result)
+
+
+ENCRYPTED_MESSAGE = StanzaTemplate(
+    '<message to="{to}" from="{from_jid}" id="{id}" type="chat">'
+    '<body>I sent you an OMEMO encrypted message.</body>'
+    '<encrypted xmlns="{omemo_ns}">'
+    '<header sid="{sid}">'
+    '{keys}'
+    '<iv>{iv}</iv>'
+    '</header>'
+    '<payload>{payload}</payload>'
+    '</encrypted>'
+    '<markable xmlns="urn:xmpp:chat-markers:0"/>'
+    '<request xmlns="urn:xmpp:receipts"/>'
+    '<store xmlns="urn:xmpp:hints"/>'
+    '</message>',
+    omemo_ns=NS_OMEMO)
+
+KEY = StanzaTemplate('<key rid="{rid}">{key}</key>')
+PREKEY_KEY = StanzaTemplate('<key prekey="true" rid="{rid}">{key}</key>')
+
+OWN_BUNDLE = StanzaTemplate(
+    '<iq from="{from_jid}" type="set" id="{id}">'
+    '<pubsub xmlns="{pubsub_ns}">'
+    '<publish node="{bundles_ns}:{device_id}">'
+    '<item>'
+    '<bundle xmlns="{omemo_ns}">'
+    '{bundle}'
+    '</bundle>'
+    '</item>'
+    '</publish>'
+    '</pubsub>'
+    '</iq>',
+    pubsub_ns=NS_PUBSUB, bundles_ns=NS_BUNDLES, omemo_ns=NS_OMEMO)
+
+OWN_BUNDLE_CONTENT = StanzaTemplate(
+    '<signedPreKeyPublic signedPreKeyId="{spk_id}">{spk}</signedPreKeyPublic>'
+    '<signedPreKeySignature>{spk_signature}</signedPreKeySignature>'
+    '<identityKey>{identity_key}</identityKey>'
+    '<prekeys>{prekeys}</prekeys>')
+
+PREKEY_PUBLIC = StanzaTemplate(
+    '<preKeyPublic preKeyId="{key_id}">{key}</preKeyPublic>')
+
+BUNDLE_REQUEST = StanzaTemplate(
+    '<iq type="get" from="{from_jid}" to="{to}" id="{id}">'
+    '<pubsub xmlns="{pubsub_ns}">'
+    '<items node="{bundles_ns}:{device_id}"/>'
+    '</pubsub>'
+    '</iq>',
+    pubsub_ns=NS_PUBSUB, bundles_ns=NS_BUNDLES)
+
+DEVICELIST_UPDATE = StanzaTemplate(
+    '<iq type="set" from="{from_jid}" id="{id}">'
+    '<pubsub xmlns="{pubsub_ns}">'
+    '<publish node="{devicelist_ns}">'
+    '<item id="1">'
+    '<list xmlns="{omemo_ns}">'
+    '{devices}'
+    '</list>'
+    '</item>'
+    '</publish>'
+    '</pubsub>'
+    '</iq>',
+    pubsub_ns=NS_PUBSUB, devicelist_ns=NS_DEVICE_LIST, omemo_ns=NS_OMEMO)
+
+DEVICE = StanzaTemplate('<device id="{id}"/>')
+
+DEVICELIST_QUERY = StanzaTemplate(
+    '<iq type="get" from="{from_jid}" to="{to}" id="{id}">'
+    '<pubsub xmlns="{pubsub_ns}">'
+    '<items node="{devicelist_ns}" />'
+    '</pubsub>'
+    '</iq>',
+    pubsub_ns=NS_PUBSUB, devicelist_ns=NS_DEVICE_LIST)
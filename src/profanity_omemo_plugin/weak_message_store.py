@@ -18,17 +18,44 @@
 # the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from prof_omemo_state import ProfOmemoState
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+from collections import OrderedDict, deque
+
+import profanity_omemo_plugin.xmpp as xmpp
+from profanity_omemo_plugin.log import get_plugin_logger
+from profanity_omemo_plugin.prof_omemo_state import ProfOmemoState, \
+    ProfOmemoUser
+
+logger = get_plugin_logger(__name__)
+
+# messages kept per recipient, the oldest message is dropped on overflow
+MAX_MESSAGES_PER_RECIPIENT = 10
+# seconds a message may wait for missing sessions
+MESSAGE_TIMEOUT = 60
 
 
 class WeakMessageStore(object):
+    """ Holds outgoing messages until sessions with all devices exist.
+
+    Messages are kept in FIFO order per recipient. :py:meth:`trigger`
+    encrypts and posts the messages of every recipient whose sessions are
+    complete, :py:meth:`expire` reports the messages which waited too long.
+    """
+
+    def __init__(self, max_size=MAX_MESSAGES_PER_RECIPIENT,
+                 timeout=MESSAGE_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._messages = OrderedDict()
+
+    def __len__(self):
+        return sum(len(messages) for messages in self._messages.values())
 
-    def __init__(self):
-        # - maybe max store size (10 Messages FIFO drop)
-        # - configure timeout
-        # - run a checker thread
-        # - use wait on empty store to save cpu
-        self._messages = []
+    def has_messages_for(self, recipient):
+        return recipient in self._messages
 
     def add(self, message_dict):
         """ Adds a Message dict to the store.
@@ -37,26 +64,108 @@ class WeakMessageStore(object):
                         'to': 'juliet@capulet.lit',
                         'message': 'Some Message',}
 
-        - adds a timestamp to the dict
-        - tries to post immediately
+        A timestamp is added to the dict and the message is posted
+        immediately if the sessions are complete already.
+        """
+        message_dict.setdefault('timestamp', time.time())
+        recipient = message_dict['to']
+
+        messages = self._messages.setdefault(recipient, deque())
+        messages.append(message_dict)
+        if len(messages) > self.max_size:
+            self.on_timeout(messages.popleft())
+
+        self.trigger(recipient)
 
+    def trigger(self, recipient=None):
+        """ Posts the messages of all recipients whose sessions are complete.
+
+        :param recipient: only check the messages for this recipient
+        :returns: the number of posted messages
         """
-        pass
+        if recipient is None:
+            recipients = list(self._messages)
+        elif recipient in self._messages:
+            recipients = [recipient]
+        else:
+            return 0
 
-    def post_message(self, stanza):
-        # post the encrypted message, e.g. prof.send_message(stanza)
-        pass
+        posted = 0
+        for recipient in recipients:
+            if self.missing_devices(recipient):
+                continue
 
-    def trigger(self):
+            messages = self._messages[recipient]
+            while messages:
+                message_dict = messages[0]
+                try:
+                    stanza = self.encrypt(message_dict)
+                except Exception:
+                    # keep the order, the message is reported on timeout
+                    logger.exception('Could not encrypt queued message.')
+                    break
+
+                messages.popleft()
+                self.post_message(stanza, message_dict)
+                posted += 1
+
+            if not messages:
+                del self._messages[recipient]
+
+        return posted
+
+    def expire(self, now=None):
+        """ Drops messages older than the timeout and reports them.
+
+        :returns: the number of dropped messages
         """
-        Gets triggered from the outside to check all messages if
-        they are ready to encrypt and calls post_message.
+        if now is None:
+            now = time.time()
+
+        deadline = now - self.timeout
+        expired = 0
+        for recipient in list(self._messages):
+            messages = self._messages[recipient]
+            while messages and messages[0]['timestamp'] < deadline:
+                self.on_timeout(messages.popleft())
+                expired += 1
+
+            if not messages:
+                del self._messages[recipient]
 
-        Or -> requests the missing bundles.
+        return expired
 
+    def clear(self):
+        """ Drops and reports all messages. """
+        messages, self._messages = self._messages, OrderedDict()
+        for recipient_messages in messages.values():
+            for message_dict in recipient_messages:
+                self.on_timeout(message_dict)
+
+    def missing_devices(self, recipient):
+        """ The devices of recipient and of the own account without a
+            session.
         """
+        omemo_state = ProfOmemoState()
+        missing = omemo_state.devices_without_sessions(recipient)
+        missing += omemo_state.devices_without_sessions(ProfOmemoUser.account)
+        return missing
+
+    def encrypt(self, message_dict):
+        plaintext = message_dict['message']
+        try:
+            plaintext = plaintext.encode('utf-8')
+        except AttributeError:
+            pass
+
+        return xmpp.create_encrypted_message(message_dict['from'],
+                                             message_dict['to'], plaintext)
 
-    def on_timeout(self):
+    def post_message(self, stanza, message_dict):
+        # post the encrypted message, e.g. prof.send_stanza(stanza)
+        pass
+
+    def on_timeout(self, message_dict):
         # posts some information to the ui if the bundle is not received yet
-        # or a device is not trusted."
-        pass
\ No newline at end of file
+        # or a device is not trusted.
+        pass
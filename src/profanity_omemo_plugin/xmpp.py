@@ -20,17 +20,22 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import hashlib
 import random
 import uuid
 from base64 import b64decode, b64encode
+from xml.parsers import expat
 
 from profanity_omemo_plugin.constants import NS_OMEMO, NS_DEVICE_LIST, \
-    NS_DEVICE_LIST_NOTIFY, NS_BUNDLES
+    NS_BUNDLES, NS_PUBSUB, NS_PUBSUB_EVENT, NS_FORWARD
 from profanity_omemo_plugin.errors import StanzaNodeNotFound, \
     CouldNotCreateBundleStanza
-from profanity_omemo_plugin.log import get_plugin_logger
+from profanity_omemo_plugin.log import ShortStanza, get_plugin_logger
 from profanity_omemo_plugin.prof_omemo_state import ProfOmemoState, \
     ProfOmemoUser
+from profanity_omemo_plugin.stanza_builder import BUNDLE_REQUEST, DEVICE, \
+    DEVICELIST_QUERY, DEVICELIST_UPDATE, ENCRYPTED_MESSAGE, KEY, OWN_BUNDLE, \
+    OWN_BUNDLE_CONTENT, PREKEY_KEY, PREKEY_PUBLIC, quote_attr
 
 try:
     from lxml import etree as ET
@@ -55,19 +60,70 @@ def stanza_as_xml(stanza):
     return xml
 
 
+class Stanza(object):
+    """ A stanza passed to a plugin hook.
+
+        The stanza is parsed on first access of :py:attr:`xml` and the result
+        is shared by all helpers, so it is parsed at most once per hook call.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._xml = None
+        self._kind = None
+        self._root = None
+
+    @property
+    def xml(self):
+        if self._xml is None:
+            self._xml = stanza_as_xml(self.text)
+        return self._xml
+
+    @property
+    def kind(self):
+        """ One of the STANZA_* kinds, see :py:func:`classify_stanza`. """
+        if self._kind is None:
+            self._kind = classify_stanza(self.text)
+        return self._kind
+
+    @property
+    def root(self):
+        """ The attributes of the root element.
+
+            Unless the stanza is parsed already, only its start tag is read.
+        """
+        if self._root is None:
+            if self._xml is not None:
+                self._root = dict(self._xml.attrib)
+            else:
+                self._root = root_attributes(self.text)
+        return self._root
+
+    def __contains__(self, value):
+        return value in self.text
+
+
+def as_stanza(stanza):
+    """ Wrap stanza text in a :py:class:`Stanza`, pass Stanzas through. """
+    if isinstance(stanza, Stanza):
+        return stanza
+
+    return Stanza(stanza)
+
+
 def find_node(xml, name, ns=None):
     node = None
 
     if ns:
         xq = './/{%s}%s' % (ns, name)
-        logger.debug('Looking up node for query {0}'.format(xq))
+        logger.debug('Looking up node for query %s', xq)
         node = xml.find(xq)
 
     if node is None:
         # ChatSecure seems to use the wrong xml namespace
         # use a fallback here with the custom namespace for some nodes
         xq = './/{%s}%s' % ('jabber:client', name)
-        logger.debug('Fallback node lookup for query {0}'.format(xq))
+        logger.debug('Fallback node lookup for query %s', xq)
         node = xml.find(xq)
 
     if node is None:
@@ -77,19 +133,18 @@ def find_node(xml, name, ns=None):
 
 
 def encrypt_stanza(stanza):
-    logger.debug('Enrypting stanza {0}'.format(stanza))
-    logger.debug('Convert stanza to xml.')
-    msg_xml = stanza_as_xml(stanza)
+    stanza = as_stanza(stanza)
+    logger.debug('Enrypting stanza %s', ShortStanza(stanza))
+    msg_xml = stanza.xml
     fulljid = msg_xml.attrib.get('from', ProfOmemoUser().fulljid)
-    logger.debug('Sender: {0}'.format(fulljid))
+    logger.debug('Sender: %s', fulljid)
     jid = msg_xml.attrib['to']
     account, resource = jid.rsplit('/', 1) if '/' in jid else (jid, '')
-    logger.debug('Recipient {0} [{1}]'.format(account, resource))
+    logger.debug('Recipient %s [%s]', account, resource)
     msg_id = msg_xml.attrib['id']
-    logger.debug('Message ID: {0}'.format(msg_id))
+    logger.debug('Message ID: %s', msg_id)
     body_node = msg_xml.find('.//body')
     plaintext = body_node.text
-    logger.debug('Message: {0}'.format(plaintext))
 
     try:
         plaintext = plaintext.encode('utf-8')
@@ -102,42 +157,46 @@ def encrypt_stanza(stanza):
 def update_devicelist(from_jid, recipient, devices):
     omemo_state = ProfOmemoState()
 
-    logger.debug('Update devices for account: {0}'.format(from_jid))
-    logger.info('Adding Device ID\'s: {0} for {1}.'.format(devices, recipient))
+    logger.debug('Update devices for account: %s', from_jid)
     if devices:
-        if from_jid == recipient:
-            logger.info('Adding own devices')
-            omemo_state.set_own_devices(devices)
+        if omemo_state.update_devices(recipient, devices):
+            logger.info('Device List update done for %s.', recipient)
         else:
-            logger.info('Adding recipients devices')
-            omemo_state.set_devices(recipient, devices)
-
-        omemo_state.store.sessionStore.setActiveState(devices, from_jid)
-        logger.info('Device List update done.')
+            logger.debug('Device List of %s is unchanged.', recipient)
 
 
 def get_recipient(stanza):
+    stanza = as_stanza(stanza)
     try:
-        xml = stanza_as_xml(stanza)
-        recipient = xml.attrib['to']
-        logger.debug('Found recipient {0} in stanza {1}'.format(recipient, stanza))
+        recipient = stanza.xml.attrib['to']
+        logger.debug('Found recipient %s in stanza %s', recipient,
+                     ShortStanza(stanza))
     except:
-        logger.error('Recipient not found in stanza {0}'.format(stanza))
+        logger.error('Recipient not found in stanza %s', ShortStanza(stanza))
         return None
 
     return recipient
 
 
+def get_body(stanza):
+    """ The text of the body of a message stanza or None. """
+    body_node = as_stanza(stanza).xml.find('.//body')
+    if body_node is None:
+        return None
+
+    return body_node.text
+
+
 def get_root_attrib(stanza, attrib):
+    stanza = as_stanza(stanza)
     try:
-        xml = stanza_as_xml(stanza)
-        result = xml.attrib[attrib]
+        result = stanza.xml.attrib[attrib]
     except KeyError:
-        logger.error('Stanza has not attrib {0}'.format(attrib))
+        logger.error('Stanza has not attrib %s', attrib)
         return None
     except Exception as e:
-        logger.error('Failed to parse stanza: {0}'.format(stanza))
-        logger.error('{0}: {1}'.format(type(e).__name__, e.message))
+        logger.error('Failed to parse stanza: %s', ShortStanza(stanza))
+        logger.error('%s: %s', type(e).__name__, e)
         return None
 
     return result
@@ -149,27 +208,165 @@ def get_root_attrib(stanza, attrib):
 
 def stanza_is_valid_xml(stanza):
     """ Validates a given stanza to be valid xml"""
+    stanza = as_stanza(stanza)
     try:
-        _ = stanza_as_xml(stanza)
+        _ = stanza.xml
     except Exception as e:
-        logger.error('Stanza is not valid xml. {0}'.format(e))
-        logger.error(stanza)
+        logger.error('Stanza is not valid xml. %s', e)
+        logger.error('%s', ShortStanza(stanza))
         return False
 
     return True
 
 
+STANZA_OTHER = 'other'
+STANZA_OMEMO_MESSAGE = 'omemo_message'
+STANZA_DEVICELIST = 'devicelist'
+STANZA_BUNDLE = 'bundle'
+
+# element names as reported by expat with namespace_separator=' '
+_MESSAGE = ('jabber:client message', 'message')
+_PUBSUB_CONTAINERS = (NS_PUBSUB + ' pubsub', NS_PUBSUB_EVENT + ' event')
+_FORWARDED = NS_FORWARD + ' forwarded'
+
+
+class _Classified(Exception):
+    """ Stops the classifying parser as soon as the kind is known. """
+
+    def __init__(self, kind):
+        super(_Classified, self).__init__(kind)
+        self.kind = kind
+
+
+class _StanzaClassifier(object):
+    """ expat handlers looking at the root and the first level children,
+        forwarded messages are followed to the wrapped message.
+    """
+
+    def __init__(self):
+        self.path = []
+
+    def start(self, name, attrib):
+        path = self.path
+        depth = len(path)
+
+        if depth == 0:
+            if name in _MESSAGE or name in ('jabber:client iq', 'iq'):
+                if attrib.get('type') != 'error':
+                    path.append(name)
+                    return
+            raise _Classified(STANZA_OTHER)
+
+        parent = path[-1]
+        if name == NS_OMEMO + ' encrypted' and parent in _MESSAGE:
+            raise _Classified(STANZA_OMEMO_MESSAGE)
+
+        if parent in _PUBSUB_CONTAINERS:
+            node = attrib.get('node', '')
+            if name.rsplit(' ', 1)[-1] != 'items':
+                raise _Classified(STANZA_OTHER)
+            if node == NS_DEVICE_LIST:
+                raise _Classified(STANZA_DEVICELIST)
+            if node.startswith(NS_BUNDLES + ':'):
+                raise _Classified(STANZA_BUNDLE)
+            raise _Classified(STANZA_OTHER)
+
+        if depth == 1:
+            if parent not in _MESSAGE and name not in _PUBSUB_CONTAINERS:
+                # an iq without pubsub payload
+                raise _Classified(STANZA_OTHER)
+            path.append(name)
+        elif depth == 2 and path[0] in _MESSAGE and name == _FORWARDED:
+            # message carbons and archived messages wrap the message
+            path.append(name)
+        elif parent == _FORWARDED and name in _MESSAGE:
+            path.append(name)
+        else:
+            # a subtree of no interest, only its depth is tracked
+            path.append(None)
+
+    def end(self, name):
+        self.path.pop()
+
+
+def classify_stanza(text):
+    """ Classify a stanza without building a tree.
+
+        Only the root element and its direct children are inspected, parsing
+        stops as soon as the kind is known. Stanzas which are not well formed
+        are classified as STANZA_OTHER.
+
+        :returns: STANZA_OMEMO_MESSAGE, STANZA_DEVICELIST, STANZA_BUNDLE or
+                  STANZA_OTHER
+    """
+    if not text:
+        return STANZA_OTHER
+
+    classifier = _StanzaClassifier()
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.StartElementHandler = classifier.start
+    parser.EndElementHandler = classifier.end
+
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+
+    try:
+        parser.Parse(text, True)
+    except _Classified as e:
+        return e.kind
+    except expat.ExpatError:
+        pass
+
+    return STANZA_OTHER
+
+
+class _RootParsed(Exception):
+    """ Stops the parser after the start tag of the root element. """
+
+    def __init__(self, attrib):
+        super(_RootParsed, self).__init__()
+        self.attrib = attrib
+
+
+def _stop_at_root(name, attrib):
+    raise _RootParsed(attrib)
+
+
+def root_attributes(text):
+    """ The attributes of the root element of a stanza, parsing stops right
+        after its start tag.
+
+        :returns: a dict, which is empty for stanzas which are not well formed
+    """
+    if not text:
+        return {}
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = _stop_at_root
+
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+
+    try:
+        parser.Parse(text, True)
+    except _RootParsed as e:
+        return e.attrib
+    except expat.ExpatError:
+        pass
+
+    return {}
+
+
 def is_devicelist_update(stanza):
-    return NS_DEVICE_LIST in stanza and not NS_DEVICE_LIST_NOTIFY in stanza
+    return as_stanza(stanza).kind == STANZA_DEVICELIST
 
 
 def is_bundle_update(stanza):
-    return NS_BUNDLES in stanza
+    return as_stanza(stanza).kind == STANZA_BUNDLE
 
 
 def is_encrypted_message(stanza):
-    # TODO: check in NS_OMEMO only
-    return 'encrypted' in stanza
+    return as_stanza(stanza).kind == STANZA_OMEMO_MESSAGE
 
 
 def is_xmpp_message(stanza):
@@ -187,24 +384,28 @@ def is_xmpp_plaintext_message(stanza):
 # Unwrapping XMPP stanzas
 ################################################################################
 
-def unpack_bundle_info(stanza):
+def unpack_bundle_info(stanza, sender=None, device_id=None):
+    """ Unpack a bundle, sender and device_id are taken from the stanza
+        unless they are known from the request.
+    """
     logger.info('Unwrapping bundle info.')
-    bundle_xml = stanza_as_xml(stanza)
+    bundle_xml = as_stanza(stanza).xml
 
-    try:
-        sender = bundle_xml.attrib['from'].rsplit('/', 1)[0]
-        logger.debug('Found sender jid {0} in bundle info.'.format(sender))
-    except KeyError:
-        # we assume bundle updates without sender to be own bundles for
-        # different devices
-        sender = ProfOmemoUser.account
-        logger.debug(
-            'Fallback to known sender {0} while unpacking bundle info'.format(sender)
-        )
+    if sender is None:
+        try:
+            sender = bundle_xml.attrib['from'].rsplit('/', 1)[0]
+            logger.debug('Found sender jid %s in bundle info.', sender)
+        except KeyError:
+            # we assume bundle updates without sender to be own bundles for
+            # different devices
+            sender = ProfOmemoUser.account
+            logger.debug('Fallback to known sender %s while unpacking '
+                         'bundle info', sender)
 
     try:
-        items_node = find_node(bundle_xml, 'items', ns='http://jabber.org/protocol/pubsub')
-        device_id = items_node.attrib['node'].split(':')[-1]
+        if device_id is None:
+            items_node = find_node(bundle_xml, 'items', ns='http://jabber.org/protocol/pubsub')
+            device_id = items_node.attrib['node'].split(':')[-1]
 
         bundle_node = find_node(bundle_xml, 'bundle', ns=NS_OMEMO)
 
@@ -234,7 +435,7 @@ def unpack_bundle_info(stanza):
             return
 
     except StanzaNodeNotFound as e:
-        logger.warning('Could not unpack bundle info. {0}'.format(e))
+        logger.warning('Could not unpack bundle info. %s', e)
         return
 
     bundle_dict = {
@@ -272,20 +473,21 @@ def unpack_encrypted_stanza(encrypted_stanza):
     """
 
     logger.info('Unpacking encrypted Message stanza.')
-    xml = ET.fromstring(encrypted_stanza)
+    encrypted_stanza = as_stanza(encrypted_stanza)
+    xml = encrypted_stanza.xml
     if '<forwarded' in encrypted_stanza:
         xml = xml.find('.//{jabber:client}message')
 
     sender_fulljid = xml.attrib['from']
     sender, resource = sender_fulljid.rsplit('/', 1)
-    logger.debug('Found sender {0} [{1}]'.format(sender, resource))
+    logger.debug('Found sender %s [%s]', sender, resource)
 
     encrypted_node = xml.find('.//{%s}encrypted' % NS_OMEMO)
 
     header_node = encrypted_node.find('.//{%s}header' % NS_OMEMO)
 
     sid = int(header_node.attrib['sid'])
-    logger.debug('Found sender ID: {0}'.format(sid))
+    logger.debug('Found sender ID: %s', sid)
 
     iv_node = header_node.find('.//{%s}iv' % NS_OMEMO)
     iv = iv_node.text
@@ -313,13 +515,17 @@ def unpack_encrypted_stanza(encrypted_stanza):
     return msg_dict
 
 
-def unpack_devicelist_info(stanza):
-    xml = stanza_as_xml(stanza)
+def unpack_devicelist_info(stanza, sender_jid=None):
+    """ Unpack a devicelist, the sender is taken from the stanza unless it
+        is known from the request.
+    """
+    xml = as_stanza(stanza).xml
 
-    try:
-        sender_jid = xml.attrib.get('from')
-    except AttributeError:
-        sender_jid = None
+    if sender_jid is None:
+        try:
+            sender_jid = xml.attrib.get('from')
+        except AttributeError:
+            sender_jid = None
 
     if sender_jid is None:
         event_node = xml.find('./{%s}event' % 'http://jabber.org/protocol/pubsub#event')
@@ -329,7 +535,7 @@ def unpack_devicelist_info(stanza):
             # device list info is result of a request for our own account
             sender_jid = ProfOmemoUser().account
 
-    logger.debug('Found sender jid {0}'.format(sender_jid))
+    logger.debug('Found sender jid %s', sender_jid)
 
     item_list = xml.find('.//{%s}list' % NS_OMEMO)
     if item_list is not None:
@@ -337,7 +543,7 @@ def unpack_devicelist_info(stanza):
     else:
         device_ids = []
 
-    logger.debug('Found device ids {0}'.format(device_ids))
+    logger.debug('Found device ids %s', device_ids)
     msg_dict = {'from': sender_jid,
                 'devices': device_ids}
 
@@ -348,177 +554,140 @@ def unpack_devicelist_info(stanza):
 # Create XMPP stanzas
 ################################################################################
 
-def create_own_bundle_stanza():
-    announce_template = ('<iq from="{from_jid}" type="set" id="{req_id}">'
-                         '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
-                         '<publish node="{bundles_ns}:{device_id}">'
-                         '<item>'
-                         '<bundle xmlns="{omemo_ns}">'
-                         '</bundle>'
-                         '</item>'
-                         '</publish>'
-                         '</pubsub>'
-                         '</iq>')
+# the rendered <bundle/> content of the last published bundle, the
+# per prekey fragments survive bundle changes and are reused
+_own_bundle_xml = {'bundle': None, 'xml': None, 'prekeys': {}}
 
-    omemo_state = ProfOmemoState()
-    own_bundle = omemo_state.bundle
-    own_jid = omemo_state.own_jid
-    bundle_msg = announce_template.format(from_jid=own_jid,
-                                          req_id=str(uuid.uuid4()),
-                                          device_id=omemo_state.own_device_id,
-                                          bundles_ns=NS_BUNDLES,
-                                          omemo_ns=NS_OMEMO)
-
-    bundle_xml = ET.fromstring(bundle_msg)
-
-    # to be appended to announce_template
-    find_str = './/{%s}bundle' % NS_OMEMO
-    bundle_node = bundle_xml.find(find_str)
-    pre_key_signed_node = ET.SubElement(bundle_node, 'signedPreKeyPublic',
-                                        attrib={'signedPreKeyId': str(
-                                            own_bundle['signedPreKeyId'])})
-    pre_key_signed_node.text = own_bundle.get('signedPreKeyPublic')
-
-    signedPreKeySignature_node = ET.SubElement(bundle_node,
-                                               'signedPreKeySignature')
-    signedPreKeySignature_node.text = own_bundle.get('signedPreKeySignature')
-
-    identityKey_node = ET.SubElement(bundle_node, 'identityKey')
-    identityKey_node.text = own_bundle.get('identityKey')
-
-    prekeys_node = ET.SubElement(bundle_node, 'prekeys')
+
+def _render_own_bundle(own_bundle):
+    if _own_bundle_xml['bundle'] is own_bundle:
+        return _own_bundle_xml['xml']
+
+    known_fragments = _own_bundle_xml['prekeys']
+    fragments = {}
+    prekeys = []
     for key_id, key in own_bundle.get('prekeys', []):
-        key_node = ET.SubElement(prekeys_node, 'preKeyPublic',
-                                 attrib={'preKeyId': str(key_id)})
-        key_node.text = str(key)
+        fragment = known_fragments.get((key_id, key))
+        if fragment is None:
+            fragment = PREKEY_PUBLIC.render(key_id=str(key_id), key=key)
+        fragments[(key_id, key)] = fragment
+        prekeys.append(fragment)
 
-    # reconvert xml to stanza
+    bundle_xml = OWN_BUNDLE_CONTENT.render(
+        spk_id=str(own_bundle['signedPreKeyId']),
+        spk=own_bundle['signedPreKeyPublic'],
+        spk_signature=own_bundle['signedPreKeySignature'],
+        identity_key=own_bundle['identityKey'],
+        prekeys=''.join(prekeys))
+
+    _own_bundle_xml.update({'bundle': own_bundle,
+                            'xml': bundle_xml,
+                            'prekeys': fragments})
+
+    return bundle_xml
+
+
+def own_bundle_node():
+    return '{0}:{1}'.format(NS_BUNDLES, ProfOmemoState().own_device_id)
+
+
+def own_bundle_hash():
+    """ Content hash of the own bundle as it would be published. """
+    bundle_xml = _render_own_bundle(ProfOmemoState().bundle)
+    return hashlib.sha256(bundle_xml.encode('utf-8')).hexdigest()
+
+
+def create_own_bundle_stanza(req_id=None):
+    req_id = req_id or str(uuid.uuid4())
+    omemo_state = ProfOmemoState()
     try:
-        bundle_stanza = ET.tostring(bundle_xml, encoding='utf-8', method='html')
-    except:
-        logger.exception('Could not convert Bunle XML to Stanza.')
+        bundle_xml = _render_own_bundle(omemo_state.bundle)
+    except Exception:
+        logger.exception('Could not convert Bundle to Stanza.')
         raise CouldNotCreateBundleStanza
 
-    return bundle_stanza
+    bundle_stanza = OWN_BUNDLE.render(from_jid=quote_attr(omemo_state.own_jid),
+                                      id=req_id,
+                                      device_id=str(omemo_state.own_device_id),
+                                      bundle=bundle_xml)
 
+    return bundle_stanza
 
-def create_bundle_request_stanza(account, recipient, deviceid):
-    logger.info('Fetching bundle for device id {0} of {1}'.format(deviceid, recipient))
 
-    bundle_req_root = ET.Element('iq')
-    bundle_req_root.set('type', 'get')
-    bundle_req_root.set('from', account)
-    bundle_req_root.set('to', recipient)
-    bundle_req_root.set('id', str(uuid.uuid4()))
-    pubsub_node = ET.SubElement(bundle_req_root, 'pubsub')
-    pubsub_node.set('xmlns', 'http://jabber.org/protocol/pubsub')
-    items_node = ET.SubElement(pubsub_node, 'items')
-    items_node.set('node', '{0}:{1}'.format(NS_BUNDLES, deviceid))
+def create_bundle_request_stanza(account, recipient, deviceid, req_id=None):
+    logger.info('Fetching bundle for device id %s of %s', deviceid, recipient)
 
-    stanza = ET.tostring(bundle_req_root, encoding='utf-8', method='html')
+    req_id = req_id or str(uuid.uuid4())
+    stanza = BUNDLE_REQUEST.render(from_jid=quote_attr(account),
+                                   to=quote_attr(recipient),
+                                   id=quote_attr(req_id),
+                                   device_id=quote_attr(str(deviceid)))
 
     return stanza
 
 
 def create_encrypted_message(from_jid, to_jid, plaintext, msg_id=None):
-
-    OMEMO_MSG = ('<message to="{to}" from="{from}" id="{id}" type="chat">'
-                 '<body>I sent you an OMEMO encrypted message.</body>'
-                 '<encrypted xmlns="{omemo_ns}">'
-                 '<header sid="{sid}">'
-                 '{keys}'
-                 '<iv>{iv}</iv>'
-                 '</header>'
-                 '<payload>{enc_body}</payload>'
-                 '</encrypted>'
-                 '<markable xmlns="urn:xmpp:chat-markers:0"/>'
-                 '<request xmlns="urn:xmpp:receipts"/>'
-                 '<store xmlns="urn:xmpp:hints"/>'
-                 '</message>')
-
     omemo_state = ProfOmemoState()
     account = ProfOmemoUser.account
     msg_data = omemo_state.create_msg(account, to_jid, plaintext)
 
-    # build encrypted message from here
+    return build_encrypted_message(from_jid, to_jid, msg_data, msg_id=msg_id)
+
+
+def build_encrypted_message(from_jid, to_jid, msg_data, msg_id=None):
+    """ Render the message stanza for the result of
+        :py:meth:`OmemoState.create_msg`.
+    """
     keys_dict = msg_data['keys'] or {}
 
     # key is now a tuple of (key, is_prekey)
-    keys_str = ''
-    for rid, key_info in keys_dict.items():
-        key, is_prekey = key_info
+    keys = []
+    prekeys = []
+    for rid, (key, is_prekey) in keys_dict.items():
+        row = (str(rid), b64encode(key).decode('ascii'))
         if is_prekey:
-            logger.debug('PreKey=True')
-            tpl = '<key prekey="true" rid="{0}">{1}</key>'
+            prekeys.append(row)
         else:
-            tpl = '<key rid="{0}">{1}</key>'
-        keys_str += tpl.format(rid, b64encode(key).decode('ascii'))
+            keys.append(row)
 
-    msg_dict = {'to': to_jid,
-                'from': from_jid,
-                'id': msg_id or str(uuid.uuid4()),
-                'omemo_ns': NS_OMEMO,
-                'sid': msg_data['sid'],
-                'keys': keys_str,
-                'iv': b64encode(msg_data['iv']).decode('ascii'),
-                'enc_body': b64encode(msg_data['payload']).decode('ascii')}
-
-    enc_msg = OMEMO_MSG.format(**msg_dict)
+    enc_msg = ENCRYPTED_MESSAGE.render(
+        to=quote_attr(to_jid),
+        from_jid=quote_attr(from_jid),
+        id=quote_attr(msg_id or str(uuid.uuid4())),
+        sid=str(msg_data['sid']),
+        keys=KEY.render_each(keys) + PREKEY_KEY.render_each(prekeys),
+        iv=b64encode(msg_data['iv']).decode('ascii'),
+        payload=b64encode(msg_data['payload']).decode('ascii'))
 
     return enc_msg
 
 
 def create_devicelist_update_msg(fulljid):
-    logger.debug('Create devicelist update message for jid {0}.'.format(fulljid))
-    QUERY_MSG = ('<iq type="set" from="{from}" id="{id}">'
-                 '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
-                 '<publish node="{devicelist_ns}">'
-                 '<item id="1">'
-                 '<list xmlns="{omemo_ns}">'
-                 '{devices}'
-                 '</list>'
-                 '</item>'
-                 '</publish>'
-                 '</pubsub>'
-                 '</iq>')
+    logger.debug('Create devicelist update message for jid %s.', fulljid)
 
     omemo_state = ProfOmemoState()
 
-    own_devices = set(omemo_state.own_devices + [omemo_state.own_device_id])
-    logger.debug('Found own devices {0}'.format(own_devices))
-    device_nodes = ['<device id="{0}"/>'.format(d) for d in own_devices]
-
-    msg_dict = {'from': fulljid,
-                'devices': ''.join(device_nodes),
-                'id': str(uuid.uuid4()),
-                'omemo_ns': NS_OMEMO,
-                'devicelist_ns': NS_DEVICE_LIST}
+    own_devices = set(omemo_state.own_devices)
+    own_devices.add(omemo_state.own_device_id)
+    logger.debug('Found own devices %s', own_devices)
+    device_nodes = [DEVICE.render(id=str(d)) for d in own_devices]
 
-    query_msg = QUERY_MSG.format(**msg_dict)
+    query_msg = DEVICELIST_UPDATE.render(from_jid=quote_attr(fulljid),
+                                         id=str(uuid.uuid4()),
+                                         devices=''.join(device_nodes))
 
     return query_msg
 
 
-def create_devicelist_query_msg(sender, recipient):
-    logger.debug(
-        'Create devicelist query message from {0} to {1}'.format(sender, recipient)
-    )
-
-    QUERY_MSG = ('<iq type="get" from="{from}" to="{to}" id="{id}">'
-                 '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
-                 '<items node="{device_list_ns}" />'
-                 '</pubsub>'
-                 '</iq>')
-
-    msg_dict = {
-        'from': sender,
-        'to': recipient,
-        'id': str(uuid.uuid4()),
-        'device_list_ns': NS_DEVICE_LIST
-        }
+def create_devicelist_query_msg(sender, recipient, req_id=None):
+    logger.debug('Create devicelist query message from %s to %s',
+                 sender, recipient)
 
-    query_msg = QUERY_MSG.format(**msg_dict)
+    req_id = req_id or str(uuid.uuid4())
+    query_msg = DEVICELIST_QUERY.render(from_jid=quote_attr(sender),
+                                        to=quote_attr(recipient),
+                                        id=quote_attr(req_id))
 
-    logger.debug('Sending Device List Query: {0}'.format(query_msg))
+    logger.debug('Sending Device List Query: %s', ShortStanza(query_msg))
 
     return query_msg
@@ -1,6 +1,8 @@
+from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
+import sqlite3
 
 here = os.path.abspath(__file__)
 stanzas_root = os.path.join(os.path.dirname(here), 'stanzas')
@@ -12,4 +14,24 @@ def get_stanza_fixture(name):
     with open(stanza_path, 'rb') as stanza_file:
         stanza = stanza_file.read()
 
-    return stanza
\ No newline at end of file
+    return stanza
+
+
+databases_root = os.path.join(os.path.dirname(here), 'databases')
+
+
+def get_database_fixture(name):
+    script_path = os.path.join(databases_root, name)
+
+    with open(script_path, 'r') as script_file:
+        return script_file.read()
+
+
+def get_test_db_connection():
+    print('Using In-Memory Database')
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+
+class DummyPlugin(object):
+    def publish_bundle(self, account):
+        pass
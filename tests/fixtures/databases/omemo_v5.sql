@@ -0,0 +1,50 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE identities (
+    _id INTEGER PRIMARY KEY AUTOINCREMENT, recipient_id TEXT,
+    registration_id INTEGER, public_key BLOB, private_key BLOB,
+    next_prekey_id INTEGER, timestamp INTEGER, trust INTEGER,
+    shown INTEGER DEFAULT 0);
+
+CREATE UNIQUE INDEX public_key_index ON identities (public_key, recipient_id);
+
+CREATE TABLE prekeys(
+    _id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prekey_id INTEGER UNIQUE, sent_to_server BOOLEAN,
+    record BLOB);
+
+CREATE TABLE signed_prekeys (
+    _id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prekey_id INTEGER UNIQUE,
+    timestamp NUMERIC DEFAULT CURRENT_TIMESTAMP, record BLOB);
+
+CREATE TABLE sessions (
+    _id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient_id TEXT, device_id INTEGER,
+    record BLOB, timestamp INTEGER, active INTEGER DEFAULT 1,
+    UNIQUE(recipient_id, device_id));
+
+CREATE TABLE encryption_state (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    jid TEXT UNIQUE,
+    encryption INTEGER
+    );
+
+INSERT INTO identities (recipient_id, registration_id, public_key, private_key)
+    VALUES ('-1', 4711, X'0501', X'0502');
+INSERT INTO identities (recipient_id, public_key, trust, shown)
+    VALUES ('bob@builder.org', X'0503', 1, 1);
+
+INSERT INTO prekeys (prekey_id, record) VALUES (1, X'01');
+INSERT INTO prekeys (prekey_id, record) VALUES (2, X'02');
+
+INSERT INTO signed_prekeys (prekey_id, timestamp, record)
+    VALUES (1, '2017-05-01 12:00:00', X'03');
+
+INSERT INTO sessions (recipient_id, device_id, record, active)
+    VALUES ('bob@builder.org', 42, X'04', 0);
+
+INSERT INTO encryption_state (jid, encryption) VALUES ('bob@builder.org', 1);
+
+PRAGMA user_version=5;
+END TRANSACTION;
@@ -0,0 +1,49 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE identities (
+    _id INTEGER PRIMARY KEY AUTOINCREMENT, recipient_id TEXT,
+    registration_id INTEGER, public_key BLOB, private_key BLOB,
+    next_prekey_id INTEGER, timestamp INTEGER, trust INTEGER,
+    shown INTEGER DEFAULT 0);
+
+CREATE TABLE prekeys(
+    prekey_id INTEGER PRIMARY KEY, record BLOB)
+    WITHOUT ROWID;
+
+CREATE TABLE signed_prekeys (
+    prekey_id INTEGER PRIMARY KEY,
+    timestamp INTEGER NOT NULL
+        DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+    record BLOB)
+    WITHOUT ROWID;
+
+CREATE TABLE sessions (
+    _id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient_id TEXT, device_id INTEGER,
+    record BLOB, timestamp INTEGER, active INTEGER DEFAULT 1,
+    UNIQUE(recipient_id, device_id));
+
+CREATE TABLE encryption_state (
+    jid TEXT PRIMARY KEY,
+    encryption INTEGER)
+    WITHOUT ROWID;
+
+CREATE UNIQUE INDEX identities_recipient_index
+    ON identities (recipient_id, public_key);
+CREATE INDEX identities_trust_index
+    ON identities (recipient_id, trust, public_key);
+CREATE INDEX identities_public_key_index ON identities (public_key);
+CREATE INDEX sessions_device_index ON sessions (device_id, recipient_id);
+CREATE INDEX sessions_active_index
+    ON sessions (active, recipient_id, device_id);
+
+INSERT INTO identities (recipient_id, registration_id, public_key, private_key)
+    VALUES ('-1', 4711, X'0501', X'0502');
+
+-- a SessionRecord with a remote identity key, as written by python-axolotl
+INSERT INTO sessions (recipient_id, device_id, record, active)
+    VALUES ('bob@builder.org', 42,
+    X'0aff0208031221059249b7b46877aa03da5db2d4a3ff4f2b28e7ca7de1ac541baf89f7c543d6e9691a2105e2dc51c77d4d05fdba642ca760e67e0208dcf78b489d2944191ce6fbd7d1f43a22209e3686343b4afdd3b0c90165b27c0ac6114e9bde6e3b4251e87a10922f3288fe326b0a21054db191f6438d07695a2e936a126f0eb6df4b9a551bfe8b9ea9baed5ba5be405e1220b0d25be4f7d7a3a3a8e988b6af6265eff5ff602534511853c4c63cb00ab4c46f1a24080012209a0fb841c41b0858734dc784d30523e6e2c965dd027197cbfe7767de296cdc603a490a2105d33023f5c2a54c42240a809403d4aa00c607abbdc2b77581315b5ce4ac79d7221a24080012209a5c69a16eb2cb2a00f9df0299cb9750b2679bab6ad9ddeaac26251f0efb70a64a2c0892effe031221059ef3c77a25d9a9f042bc1a259e26b1fa33aab5d0aa6fe7ce3ef02c69b27fb64f18d6d10250c8c2bac00158c8c2bac0016a21059ef3c77a25d9a9f042bc1a259e26b1fa33aab5d0aa6fe7ce3ef02c69b27fb64f', 1);
+
+PRAGMA user_version=6;
+END TRANSACTION;
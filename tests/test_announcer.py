@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from profanity_omemo_plugin.announcer import DevicelistAnnouncer
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingAnnouncer(DevicelistAnnouncer):
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingAnnouncer, self).__init__(*args, **kwargs)
+        self.published = 0
+
+    def publish(self):
+        self.published += 1
+
+
+class TestDevicelistAnnouncer(object):
+
+    def setup_method(self, test_method):
+        self.clock = Clock()
+        self.announcer = RecordingAnnouncer(interval=10, echo_timeout=30,
+                                            clock=self.clock)
+
+    def test_waits_for_echo(self):
+        for _ in range(50):
+            self.announcer.announce()
+
+        assert self.announcer.published == 1
+        assert self.announcer.suppressed == 49
+
+        self.clock.now += 20
+        assert not self.announcer.announce()
+
+        self.announcer.received(True)
+        assert not self.announcer.run()
+        assert self.announcer.published == 1
+
+    def test_publishes_again_without_echo(self):
+        self.announcer.announce()
+
+        self.clock.now += 31
+        assert self.announcer.announce()
+        assert self.announcer.published == 2
+
+    def test_suppressed_announcement_is_published_later(self):
+        self.announcer.announce()
+        self.announcer.received(False)
+
+        assert not self.announcer.announce()
+        assert not self.announcer.run()
+
+        self.clock.now += 10
+        assert self.announcer.run()
+        assert self.announcer.published == 2
+        assert not self.announcer.run()
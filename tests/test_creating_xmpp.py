@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+
+from mock import MagicMock, patch
+
+# we need to mock the prof module as it is not available outside profanity
+sys.modules['prof'] = MagicMock()
+import profanity_omemo_plugin.xmpp as xmpp
+from profanity_omemo_plugin.stanza_builder import StanzaTemplate
+from profanity_omemo_plugin.constants import NS_BUNDLES, NS_OMEMO
+from profanity_omemo_plugin.omemo.state import OmemoState
+from .fixtures import DummyPlugin, get_test_db_connection
+
+
+class TestCreatingXMPP(object):
+
+    def setup_method(self, test_method):
+        self.state = OmemoState('romeo@montague.lit', get_test_db_connection(),
+                                'romeo@montague.lit', DummyPlugin())
+
+    def test_own_bundle_stanza(self):
+        with patch.object(xmpp, 'ProfOmemoState', return_value=self.state):
+            stanza = xmpp.create_own_bundle_stanza()
+
+        bundle = self.state.bundle
+        xml = xmpp.stanza_as_xml(stanza)
+        publish_node = xmpp.find_node(xml, 'publish',
+                                      ns='http://jabber.org/protocol/pubsub')
+        bundle_node = xmpp.find_node(xml, 'bundle', ns=NS_OMEMO)
+        spk_node = xmpp.find_node(bundle_node, 'signedPreKeyPublic', ns=NS_OMEMO)
+        prekeys_node = xmpp.find_node(bundle_node, 'prekeys', ns=NS_OMEMO)
+        prekeys = [(int(n.attrib['preKeyId']), n.text) for n in prekeys_node]
+
+        assert xml.attrib['from'] == 'romeo@montague.lit'
+        assert publish_node.attrib['node'] == '{0}:{1}'.format(
+            NS_BUNDLES, self.state.own_device_id)
+        assert int(spk_node.attrib['signedPreKeyId']) == bundle['signedPreKeyId']
+        assert spk_node.text == bundle['signedPreKeyPublic']
+        assert prekeys == bundle['prekeys']
+
+    def test_own_bundle_stanza_follows_bundle_changes(self):
+        with patch.object(xmpp, 'ProfOmemoState', return_value=self.state):
+            stanza = xmpp.create_own_bundle_stanza()
+            pre_key_id, pre_key = self.state.bundle['prekeys'][0]
+            fragment = '<preKeyPublic preKeyId="{0}">'.format(pre_key_id)
+            assert fragment in stanza
+
+            self.state.store.removePreKey(pre_key_id)
+            self.state._remove_bundle_prekey(pre_key_id)
+
+            new_stanza = xmpp.create_own_bundle_stanza()
+
+        assert fragment not in new_stanza
+        assert new_stanza.count('<preKeyPublic ') == 99
+
+    def test_attribute_values_are_escaped(self):
+        stanza = xmpp.create_devicelist_query_msg('romeo@montague.lit/"a&b"',
+                                                  'juliet@capulet.lit')
+        xml = xmpp.stanza_as_xml(stanza)
+
+        assert xml.attrib['from'] == 'romeo@montague.lit/"a&b"'
+
+    def test_requests_use_given_id(self):
+        bundle_request = xmpp.create_bundle_request_stanza(
+            'romeo@montague.lit', 'juliet@capulet.lit', 4711, req_id='req-1')
+        devicelist_query = xmpp.create_devicelist_query_msg(
+            'romeo@montague.lit', 'juliet@capulet.lit', req_id='req-2')
+
+        assert xmpp.stanza_as_xml(bundle_request).attrib['id'] == 'req-1'
+        assert xmpp.stanza_as_xml(devicelist_query).attrib['id'] == 'req-2'
+
+    def test_encrypted_message(self):
+        msg_data = {'sid': 4711,
+                    'keys': {1: (b'key', False), 2: (b'prekey', True)},
+                    'iv': b'iv',
+                    'payload': b'payload'}
+
+        stanza = xmpp.build_encrypted_message('romeo@montague.lit/balcony',
+                                              'juliet@capulet.lit', msg_data,
+                                              msg_id='msg<1>')
+        xml = xmpp.stanza_as_xml(stanza)
+        header = xmpp.find_node(xml, 'header', ns=NS_OMEMO)
+        keys = dict((node.attrib['rid'], node.attrib.get('prekey'))
+                    for node in header.findall('{%s}key' % NS_OMEMO))
+
+        assert xml.attrib['id'] == 'msg<1>'
+        assert header.attrib['sid'] == '4711'
+        assert keys == {'1': None, '2': 'true'}
+
+
+class TestStanzaTemplate(object):
+
+    def test_render(self):
+        template = StanzaTemplate('<a x="{static}" y="{slot}">{body}</a>',
+                                  static='"&"')
+
+        assert template.render(slot='1', body='text') == \
+            '<a x="&quot;&amp;&quot;" y="1">text</a>'
+
+    def test_render_each(self):
+        template = StanzaTemplate('<d id="{id}"/>')
+
+        assert template.render_each([('1', ), ('2', )]) == \
+            '<d id="1"/><d id="2"/>'
+        assert template.render_each([]) == ''
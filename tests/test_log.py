@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import logging
+import threading
+
+import pytest
+
+from profanity_omemo_plugin.constants import OMEMO_DEFAULT_LOG_LEVEL
+from profanity_omemo_plugin.log import (MAX_LOGGED_STANZA_LENGTH,
+                                        AsyncLogHandler, ShortStanza,
+                                        get_plugin_logger, set_log_level)
+
+
+class CountingStanza(object):
+    """ Counts how often the stanza text is accessed. """
+
+    def __init__(self):
+        self.accessed = 0
+
+    @property
+    def text(self):
+        self.accessed += 1
+        return '<message/>'
+
+
+class TestPluginLogger(object):
+
+    def teardown_method(self, test_method):
+        set_log_level(OMEMO_DEFAULT_LOG_LEVEL)
+
+    def test_plugin_logger_is_cached(self):
+        logger = get_plugin_logger('profanity_omemo_plugin.test')
+
+        assert get_plugin_logger('profanity_omemo_plugin.test') is logger
+        assert len(logger.handlers) == 1
+
+    def test_set_log_level_applies_to_all_plugin_loggers(self):
+        logger = get_plugin_logger('profanity_omemo_plugin.test')
+
+        assert set_log_level('DEBUG') == logging.DEBUG
+        assert logger.isEnabledFor(logging.DEBUG)
+
+        set_log_level('warning')
+        assert not logger.isEnabledFor(logging.INFO)
+
+    def test_set_unknown_log_level(self):
+        with pytest.raises(ValueError):
+            set_log_level('verbose')
+
+    def test_disabled_level_does_not_format_stanza(self):
+        logger = get_plugin_logger('profanity_omemo_plugin.test')
+        stanza = CountingStanza()
+
+        logger.debug('Received Message: %s', ShortStanza(stanza))
+
+        assert stanza.accessed == 0
+
+
+class TestShortStanza(object):
+
+    def test_short_stanza_is_unchanged(self):
+        stanza = '<message to="juliet@capulet.lit"/>'
+
+        assert '{0}'.format(ShortStanza(stanza)) == stanza
+
+    def test_long_stanza_is_cut_off(self):
+        stanza = '<message>{0}</message>'.format('a' * MAX_LOGGED_STANZA_LENGTH)
+        text = '{0}'.format(ShortStanza(stanza))
+
+        assert text.startswith(stanza[:MAX_LOGGED_STANZA_LENGTH])
+        assert text.endswith('[{0} characters]'.format(len(stanza)))
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super(RecordingHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class TestAsyncLogHandler(object):
+
+    def get_logger(self, handler):
+        logger = logging.getLogger('profanity_omemo_plugin.test.async')
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        return logger
+
+    def test_records_are_passed_to_target(self):
+        target = RecordingHandler()
+        logger = self.get_logger(AsyncLogHandler(target))
+
+        logger.info('Message %s', 1)
+        logger.info('Message %s', 2)
+        logger.handlers[0].flush()
+
+        assert target.messages == ['Message 1', 'Message 2']
+
+    def test_arguments_are_resolved_on_emit(self):
+        target = RecordingHandler()
+        logger = self.get_logger(AsyncLogHandler(target))
+        devices = [1]
+
+        logger.info('Devices %s', devices)
+        devices.append(2)
+        logger.handlers[0].flush()
+
+        assert target.messages == ['Devices [1]']
+
+    def test_overflow_is_dropped_and_counted(self):
+        target = RecordingHandler()
+        handler = AsyncLogHandler(target, capacity=2)
+        logger = self.get_logger(handler)
+
+        for i in range(5):
+            logger.info('Message %s', i)
+
+        assert handler.dropped == 3
+        assert target.messages == []
+
+        handler.flush()
+        assert target.messages == ['3 log records dropped', 'Message 3',
+                                   'Message 4']
+
+    def test_target_is_called_on_flushing_thread(self):
+        target = RecordingHandler()
+        threads = []
+        target.handle = lambda record: threads.append(
+            threading.current_thread())
+        logger = self.get_logger(AsyncLogHandler(target))
+
+        worker = threading.Thread(target=logger.info, args=('Message', ))
+        worker.start()
+        worker.join()
+        assert threads == []
+
+        logger.handlers[0].flush()
+        assert threads == [threading.current_thread()]
+
+    def test_dump_writes_last_records(self, tmpdir):
+        handler = AsyncLogHandler(RecordingHandler(), history=3)
+        logger = self.get_logger(handler)
+
+        for i in range(5):
+            logger.info('Message %s', i)
+        handler.flush()
+
+        path = str(tmpdir.join('dump.txt'))
+        assert handler.dump(path, 2) == 2
+
+        with io.open(path, encoding='utf-8') as dump_file:
+            lines = dump_file.read().splitlines()
+
+        assert len(lines) == 2
+        assert lines[0].endswith('INFO profanity_omemo_plugin.test.async - Message 3')
+        assert lines[1].endswith('Message 4')
@@ -0,0 +1,655 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import binascii
+import os
+import sqlite3
+import time
+from base64 import b64decode
+from contextlib import contextmanager
+
+import pytest
+from mock import patch
+
+from profanity_omemo_plugin.omemo.liteaxolotlstore import LiteAxolotlStore
+from profanity_omemo_plugin.omemo.lru import LRUCache
+from profanity_omemo_plugin.omemo.prekeypool import PreKeyPool
+from profanity_omemo_plugin.omemo.sql import SQLDatabase
+from profanity_omemo_plugin.omemo.state import (OmemoState, TRUSTED,
+                                                 UNDECIDED, UNTRUSTED)
+from .fixtures import (DummyPlugin, get_database_fixture,
+                       get_test_db_connection)
+
+
+def create_state(jid):
+    return OmemoState(jid, get_test_db_connection(), jid, DummyPlugin())
+
+
+def as_bundle_dict(bundle):
+    pre_key_id, pre_key_public = bundle['prekeys'][0]
+    return {'preKeyId': pre_key_id,
+            'preKeyPublic': b64decode(pre_key_public),
+            'signedPreKeyId': bundle['signedPreKeyId'],
+            'signedPreKeyPublic': b64decode(bundle['signedPreKeyPublic']),
+            'signedPreKeySignature': b64decode(bundle['signedPreKeySignature']),
+            'identityKey': b64decode(bundle['identityKey'])}
+
+
+def as_received_msg(msg_data, sender_jid):
+    msg_dict = dict(msg_data)
+    msg_dict['sender_jid'] = sender_jid
+    msg_dict['keys'] = dict((rid, key)
+                            for rid, (key, _) in msg_data['keys'].items())
+    return msg_dict
+
+
+def count_session_rows(state):
+    c = state.store.sessionStore.dbConn.cursor()
+    return c.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+class RecordingCursor(object):
+    """ Records the queries executed on a cursor. """
+
+    def __init__(self, cursor, queries):
+        self._cursor = cursor
+        self._queries = queries
+
+    def execute(self, query, *args):
+        self._queries.append(query)
+        return self._cursor.execute(query, *args)
+
+    def executemany(self, query, *args):
+        self._queries.append(query)
+        return self._cursor.executemany(query, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@contextmanager
+def recorded_queries(*states):
+    """ Collect the queries the stores of the given states execute. """
+    queries = []
+    connections = [state.store.dbConn for state in states]
+    for conn in connections:
+        conn.cursor = lambda cursor=conn.cursor: RecordingCursor(cursor(),
+                                                                queries)
+    try:
+        yield queries
+    finally:
+        for conn in connections:
+            del conn.cursor
+
+
+class TestLRUCache(object):
+
+    def test_evicts_least_recently_used(self):
+        evicted = []
+        cache = LRUCache(2, on_evict=lambda k, v: evicted.append(k))
+
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        assert evicted == ['b']
+        assert 'a' in cache and 'c' in cache
+        assert len(cache) == 2
+        assert (cache.hits, cache.misses, cache.evictions) == (1, 0, 1)
+
+    def test_session_ciphers_are_bounded(self):
+        state = OmemoState('alice@wonder.land', get_test_db_connection(),
+                           'alice@wonder.land', DummyPlugin(),
+                           cipher_cache_size=2)
+
+        first = state.get_session_cipher('bob@builder.org', 1)
+        assert state.get_session_cipher('bob@builder.org', 1) is first
+        state.get_session_cipher('bob@builder.org', 2)
+        state.get_session_cipher('bob@builder.org', 3)
+
+        assert len(state.session_ciphers) == 2
+        assert state.get_session_cipher('bob@builder.org', 1) is not first
+        assert state.session_ciphers.hits == 1
+
+
+@patch.object(OmemoState, 'isTrusted', lambda *args: TRUSTED)
+class TestSessionCache(object):
+
+    def setup_method(self, test_method):
+        self.alice = create_state('alice@wonder.land')
+        self.bob = create_state('bob@builder.org')
+
+        self.bob_device = self.bob.own_device_id
+        self.alice.build_session('bob@builder.org', self.bob_device,
+                                 as_bundle_dict(self.bob.bundle))
+        self.alice.set_devices('bob@builder.org', [self.bob_device])
+
+    def test_build_session_flushes_session(self):
+        assert count_session_rows(self.alice) == 1
+        assert not self.alice.store.sessionStore.dirty
+
+    def test_load_session_is_served_from_cache(self):
+        store = self.alice.store
+        record = store.loadSession('bob@builder.org', self.bob_device)
+
+        assert store.loadSession('bob@builder.org', self.bob_device) is record
+
+    def test_store_session_is_written_on_flush(self):
+        session_store = self.alice.store.sessionStore
+        record = session_store.loadSession('bob@builder.org', self.bob_device)
+
+        session_store.storeSession('bob@builder.org', 4711, record)
+        assert session_store.containsSession('bob@builder.org', 4711)
+        assert count_session_rows(self.alice) == 1
+
+        session_store.flush()
+        assert count_session_rows(self.alice) == 2
+
+    def test_evicted_dirty_session_is_not_lost(self):
+        session_store = self.alice.store.sessionStore
+        session_store.records = LRUCache(1)
+        record = session_store.loadSession('bob@builder.org', self.bob_device)
+
+        session_store.storeSession('bob@builder.org', 4711, record)
+        session_store.storeSession('bob@builder.org', 4712, record)
+
+        assert ('bob@builder.org', 4711) not in session_store.records
+        assert session_store.containsSession('bob@builder.org', 4711)
+        assert not session_store.loadSession('bob@builder.org', 4711).isFresh()
+
+    def test_session_readiness_is_served_from_memory(self):
+        self.alice.set_devices('bob@builder.org', [self.bob_device, 4711])
+        assert self.alice.devices_without_sessions('bob@builder.org') == [4711]
+
+        with recorded_queries(self.alice) as queries:
+            assert self.alice.devices_without_sessions('bob@builder.org') == \
+                [4711]
+
+        assert queries == []
+
+    def test_session_readiness_follows_store_and_delete(self):
+        session_store = self.alice.store.sessionStore
+        record = session_store.loadSession('bob@builder.org', self.bob_device)
+        assert not session_store.containsSession('bob@builder.org', 4711)
+
+        session_store.storeSession('bob@builder.org', 4711, record)
+        assert session_store.containsSession('bob@builder.org', 4711)
+
+        self.alice.store.deleteSession('bob@builder.org', self.bob_device)
+        assert session_store.getSessionDevices('bob@builder.org') == \
+            set([4711])
+
+    def test_messages_roundtrip_through_cached_sessions(self):
+        for text in ['first', 'second', 'third']:
+            msg = self.alice.create_msg('alice@wonder.land',
+                                        'bob@builder.org', text.encode('utf-8'))
+            msg_dict = as_received_msg(msg, 'alice@wonder.land')
+            assert self.bob.decrypt_msg(msg_dict) == text
+
+        assert not self.alice.store.sessionStore.dirty
+        assert not self.bob.store.sessionStore.dirty
+
+    def test_local_identity_is_not_queried_per_message(self):
+        def roundtrip(text):
+            msg = self.alice.create_msg('alice@wonder.land',
+                                        'bob@builder.org', text.encode('utf-8'))
+            msg_dict = as_received_msg(msg, 'alice@wonder.land')
+            assert self.bob.decrypt_msg(msg_dict) == text
+
+        roundtrip('first')
+
+        with recorded_queries(self.alice, self.bob) as queries:
+            roundtrip('second')
+            assert not self.alice.own_device_id_published()
+
+        assert queries
+        assert not [q for q in queries if 'recipient_id = -1' in q]
+
+
+@patch.object(OmemoState, 'isTrusted', lambda *args: TRUSTED)
+class TestBundleCache(object):
+
+    def setup_method(self, test_method):
+        self.alice = create_state('alice@wonder.land')
+        self.bob = create_state('bob@builder.org')
+
+    def test_bundle_is_cached(self):
+        bundle = self.bob.bundle
+
+        assert len(bundle['prekeys']) == 100
+        assert self.bob.bundle is bundle
+
+    def send_first_message(self):
+        bob_device = self.bob.own_device_id
+        self.alice.build_session('bob@builder.org', bob_device,
+                                 as_bundle_dict(self.bob.bundle))
+        self.alice.set_devices('bob@builder.org', [bob_device])
+        msg = self.alice.create_msg('alice@wonder.land', 'bob@builder.org',
+                                    b'Hello')
+        return self.bob.decrypt_msg(as_received_msg(msg, 'alice@wonder.land'))
+
+    def test_consumed_prekey_is_removed_from_bundle(self):
+        bundle = self.bob.bundle
+        used_pre_key_id = bundle['prekeys'][0][0]
+
+        self.send_first_message()
+
+        new_bundle = self.bob.bundle
+        new_pre_key_ids = [key_id for key_id, _ in new_bundle['prekeys']]
+
+        assert new_bundle is not bundle
+        assert used_pre_key_id not in new_pre_key_ids
+        assert new_bundle['prekeys'] == bundle['prekeys'][1:]
+
+    def test_bundle_is_published_after_commit(self):
+        published = []
+
+        def publish_bundle(account):
+            published.append(self.bob.store.dbConn.in_transaction)
+
+        with patch.object(self.bob.plugin, 'publish_bundle', publish_bundle):
+            assert self.send_first_message() == 'Hello'
+
+        assert published == [False]
+
+    def test_rolled_back_prekey_removal_is_kept_in_bundle(self):
+        pre_key_ids = [key_id for key_id, _ in self.bob.bundle['prekeys']]
+
+        with patch.object(self.bob.plugin, 'publish_bundle') as publish, \
+                patch.object(self.bob, 'add_device',
+                             side_effect=RuntimeError('Abort')):
+            with pytest.raises(RuntimeError):
+                self.send_first_message()
+
+        assert not publish.called
+        assert [key_id for key_id, _ in self.bob.bundle['prekeys']] == \
+            pre_key_ids
+        assert all(self.bob.store.containsPreKey(key_id)
+                   for key_id in pre_key_ids)
+
+
+class TestRemoteIdentityKey(object):
+
+    def setup_method(self, test_method):
+        self.alice = create_state('alice@wonder.land')
+        self.bob = create_state('bob@builder.org')
+
+        self.bob_device = self.bob.own_device_id
+        self.bob_key = self.bob.store.getIdentityKeyPair().getPublicKey() \
+            .getPublicKey().serialize()
+        self.alice.build_session('bob@builder.org', self.bob_device,
+                                 as_bundle_dict(self.bob.bundle))
+
+    def query(self, q):
+        conn = self.alice.store.sessionStore.dbConn
+        return conn.execute(q).fetchall()
+
+    def test_identity_key_is_stored_with_session(self):
+        rows = self.query('SELECT remote_identity_key, fingerprint '
+                          'FROM sessions')
+
+        assert rows == [(self.bob_key, binascii.hexlify(self.bob_key[1:]))]
+
+    def test_trust_lookup_does_not_parse_records(self):
+        store = self.alice.store
+
+        with patch('profanity_omemo_plugin.omemo.litesessionstore.'
+                   'SessionRecord', side_effect=AssertionError('parsed')):
+            public_key = store.getRemoteIdentityKey('bob@builder.org',
+                                                    self.bob_device)
+            assert public_key == self.bob_key
+            assert store.getTrust('bob@builder.org', public_key) == UNDECIDED
+
+    def test_inactive_sessions_keys(self):
+        self.alice.store.sessionStore.setActiveState([4711], 'bob@builder.org')
+
+        assert self.alice.store.getInactiveSessionsKeys('bob@builder.org') \
+            == [self.bob_key]
+        assert self.alice.getUndecidedFingerprints('bob@builder.org') == set()
+
+    def test_removed_device_deactivates_session(self):
+        self.alice.update_devices('bob@builder.org', [self.bob_device])
+        assert self.alice.update_devices('bob@builder.org', [4711])
+
+        assert self.alice.store.getActiveDeviceTuples() == []
+        assert self.alice.device_list_for('bob@builder.org') == set([4711])
+
+    def test_failed_devicelist_update_is_not_kept(self):
+        self.alice.update_devices('bob@builder.org', [self.bob_device])
+
+        with patch.object(self.alice.store.sessionStore, 'updateActiveState',
+                          side_effect=RuntimeError('Abort')):
+            with pytest.raises(RuntimeError):
+                self.alice.update_devices('bob@builder.org', [4711])
+
+        assert self.alice.device_list_for('bob@builder.org') == \
+            set([self.bob_device])
+        assert self.alice.store.getJidFromDevice(4711) is None
+
+        assert self.alice.update_devices('bob@builder.org', [4711])
+        assert self.alice.store.getActiveDeviceTuples() == []
+
+    def test_unchanged_devicelist_is_not_written(self):
+        self.alice.update_devices('bob@builder.org', [self.bob_device, 4711])
+
+        with recorded_queries(self.alice) as queries:
+            assert not self.alice.update_devices('bob@builder.org',
+                                                 [4711, self.bob_device])
+
+        assert queries == []
+
+    def test_migration_backfills_identity_keys(self):
+        self.query('UPDATE sessions SET remote_identity_key = NULL, '
+                   'fingerprint = NULL')
+
+        self.alice.store.sql._backfillRemoteIdentityKeys()
+
+        assert self.query('SELECT remote_identity_key FROM sessions') == \
+            [(self.bob_key, )]
+
+
+class TestTrustIndex(object):
+
+    def setup_method(self, test_method):
+        self.alice = create_state('alice@wonder.land')
+        self.bob = create_state('bob@builder.org')
+
+        self.bob_device = self.bob.own_device_id
+        self.bob_identity = self.bob.store.getIdentityKeyPair().getPublicKey()
+        self.alice.build_session('bob@builder.org', self.bob_device,
+                                 as_bundle_dict(self.bob.bundle))
+
+    def is_trusted(self):
+        return self.alice.isTrusted('bob@builder.org', self.bob_device)
+
+    def test_trust_is_served_from_memory(self):
+        assert self.is_trusted() == UNDECIDED
+
+        with patch.object(self.alice.store.identityKeyStore, 'getTrust',
+                          side_effect=AssertionError('queried')):
+            assert self.is_trusted() == UNDECIDED
+
+    def test_ratchet_step_keeps_trust(self):
+        self.is_trusted()
+        store = self.alice.store
+        record = store.loadSession('bob@builder.org', self.bob_device)
+
+        store.storeSession('bob@builder.org', self.bob_device, record)
+
+        assert ('bob@builder.org', self.bob_device) in store.trustIndex
+
+    def test_set_trust_invalidates(self):
+        assert self.is_trusted() == UNDECIDED
+
+        self.alice.store.setTrust(self.bob_identity, TRUSTED)
+
+        assert self.is_trusted() == TRUSTED
+
+    def test_blind_trust(self):
+        self.alice.blind_trust = True
+        assert self.is_trusted() == TRUSTED
+
+        self.alice.store.setTrust(self.bob_identity, UNTRUSTED)
+        assert self.is_trusted() == UNTRUSTED
+
+
+class TestWhisperMessageTrust(object):
+
+    def setup_method(self, test_method):
+        self.alice = create_state('alice@wonder.land')
+        self.bob = create_state('bob@builder.org')
+
+        bob_device = self.bob.own_device_id
+        self.bob_identity = self.bob.store.getIdentityKeyPair().getPublicKey()
+        self.alice.build_session('bob@builder.org', bob_device,
+                                 as_bundle_dict(self.bob.bundle))
+        self.alice.set_devices('bob@builder.org', [bob_device])
+
+        # the first message of alice sets up the session of bob, its replies
+        # are WhisperMessages
+        with patch.object(OmemoState, 'isTrusted', lambda *args: TRUSTED):
+            msg = self.alice.create_msg('alice@wonder.land',
+                                        'bob@builder.org', b'hello')
+            self.bob.decrypt_msg(as_received_msg(msg, 'alice@wonder.land'))
+            reply = self.bob.create_msg('bob@builder.org',
+                                        'alice@wonder.land', b'reply')
+        self.reply = as_received_msg(reply, 'bob@builder.org')
+
+    def test_reply_of_trusted_device_is_decrypted(self):
+        self.alice.store.setTrust(self.bob_identity, TRUSTED)
+
+        assert self.alice.decrypt_msg(self.reply) == 'reply'
+
+    def test_reply_of_untrusted_device_is_dropped(self):
+        self.alice.store.setTrust(self.bob_identity, UNTRUSTED)
+
+        assert self.alice.decrypt_msg(self.reply) is None
+
+    def test_reply_of_undecided_device_is_dropped(self):
+        assert self.alice.isTrusted('bob@builder.org',
+                                    self.bob.own_device_id) == UNDECIDED
+
+        assert self.alice.decrypt_msg(self.reply) is None
+
+    def test_blind_trust_decrypts_reply_of_undecided_device(self):
+        self.alice.blind_trust = True
+
+        assert self.alice.decrypt_msg(self.reply) == 'reply'
+
+
+class TestSignedPreKeyRotation(object):
+
+    def setup_method(self, test_method):
+        self.state = create_state('alice@wonder.land')
+
+    def test_bundle_does_no_rotation_work(self):
+        with patch.object(self.state, 'cycleSignedPreKey',
+                          side_effect=AssertionError('rotated')):
+            assert self.state.bundle['signedPreKeyId']
+
+    def test_rotation_is_not_due_for_fresh_key(self):
+        assert self.state.rotate_signed_prekey_if_due() is False
+
+    def test_due_rotation_changes_bundle(self):
+        bundle = self.state.bundle
+        two_days_later = time.time() + 2 * 86400
+
+        with patch('time.time', return_value=two_days_later):
+            assert self.state.rotate_signed_prekey_if_due() is True
+
+        new_bundle = self.state.bundle
+        assert new_bundle['signedPreKeyId'] != bundle['signedPreKeyId']
+        assert new_bundle['prekeys'] == bundle['prekeys']
+        assert not self.state.spk_rotation.due()
+
+
+class TestPreKeyPool(object):
+
+    def setup_method(self, test_method):
+        self.store = LiteAxolotlStore(get_test_db_connection())
+        self.pool = PreKeyPool(self.store.preKeyStore)
+
+    def remove_prekeys(self, count):
+        for pre_key in self.store.loadPreKeys()[:count]:
+            self.store.removePreKey(pre_key.getId())
+
+    def test_full_pool_is_left_alone(self):
+        assert self.pool.refill() == []
+        assert self.store.preKeyStore.getPreKeyCount() == 100
+
+    def test_refills_in_background(self):
+        self.remove_prekeys(60)
+
+        assert self.pool.refill() == []
+        self.pool.join()
+        added = self.pool.refill()
+
+        assert len(added) == 60
+        assert self.store.preKeyStore.getPreKeyCount() == 100
+        assert len(set(k.getId() for k in self.store.loadPreKeys())) == 100
+
+    def test_refills_synchronously_below_minimum(self):
+        self.remove_prekeys(90)
+
+        assert len(self.pool.refill()) == 90
+        assert self.store.preKeyStore.getPreKeyCount() == 100
+
+    def test_pool_grows_with_consumption(self):
+        assert self.pool.target_size == 100
+
+        self.pool.consumed(80)
+
+        assert self.pool.low_watermark == 125
+        assert self.pool.target_size == 250
+
+
+class TestTransaction(object):
+
+    @pytest.fixture(autouse=True)
+    def setup_store(self, tmpdir):
+        self.db_path = os.path.join(str(tmpdir), 'omemo.db')
+        self.store = LiteAxolotlStore(sqlite3.connect(self.db_path))
+
+    def count_prekeys_on_disk(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM prekeys').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_commits_once_when_leaving_the_block(self):
+        pre_key_ids = [k.getId() for k in self.store.loadPreKeys()[:3]]
+
+        with self.store.transaction():
+            for pre_key_id in pre_key_ids:
+                self.store.removePreKey(pre_key_id)
+            assert self.count_prekeys_on_disk() == 100
+
+        assert self.count_prekeys_on_disk() == 97
+
+    def test_rolls_back_on_error(self):
+        pre_key_id = self.store.loadPreKeys()[0].getId()
+
+        with pytest.raises(RuntimeError):
+            with self.store.transaction():
+                self.store.removePreKey(pre_key_id)
+                raise RuntimeError('Abort')
+
+        assert self.store.containsPreKey(pre_key_id)
+        assert self.count_prekeys_on_disk() == 100
+
+
+class TestPublishState(object):
+
+    def setup_method(self, test_method):
+        self.store = LiteAxolotlStore(get_test_db_connection())
+
+    def test_published_hash_roundtrip(self):
+        node = 'eu.siacs.conversations.axolotl.bundles:4711'
+        assert self.store.getPublishedHash(node) is None
+
+        self.store.setPublishedHash(node, 'abc')
+        self.store.setPublishedHash(node, 'def')
+
+        assert self.store.getPublishedHash(node) == 'def'
+
+
+class TestDeviceListStore(object):
+
+    def setup_method(self, test_method):
+        self.conn = get_test_db_connection()
+        self.state = OmemoState('alice@wonderland.lit', self.conn,
+                                'alice@wonderland.lit', DummyPlugin())
+
+    def test_devicelists_survive_restart(self):
+        self.state.set_devices('bob@builder.org', [1, 2])
+        self.state.add_device('bob@builder.org', 3)
+        self.state.set_own_devices([4711])
+
+        state = OmemoState('alice@wonderland.lit', self.conn,
+                           'alice@wonderland.lit', DummyPlugin())
+
+        assert state.device_list_for('bob@builder.org') == set([1, 2, 3])
+        assert state.own_devices == set([4711])
+
+    def test_reverse_index(self):
+        self.state.set_devices('bob@builder.org', [1, 2])
+        assert self.state.store.getJidFromDevice(2) == 'bob@builder.org'
+
+        self.state.set_devices('bob@builder.org', [1])
+        assert self.state.store.getJidFromDevice(2) is None
+        assert self.state.store.getJidFromDevice(1) == 'bob@builder.org'
+
+
+class TestSessionSchemaMigration(object):
+
+    def setup_method(self, test_method):
+        self.conn = get_test_db_connection()
+        self.conn.executescript(get_database_fixture('omemo_v6.sql'))
+        self.store = LiteAxolotlStore(self.conn)
+
+    def test_backfills_identity_keys_of_existing_sessions(self):
+        rows = self.conn.execute('SELECT remote_identity_key, fingerprint '
+                                 'FROM sessions').fetchall()
+        public_key = binascii.unhexlify(
+            '05e2dc51c77d4d05fdba642ca760e67e0208dcf78b489d2944191ce6fbd7d1f43a')
+
+        assert rows == [(public_key, binascii.hexlify(public_key[1:]))]
+        assert self.store.getRemoteIdentityKey('bob@builder.org', 42) == \
+            public_key
+
+    def test_migration_is_committed(self):
+        self.conn.rollback()
+
+        assert self.conn.execute('PRAGMA user_version').fetchall() == [(9, )]
+        assert self.conn.execute('SELECT COUNT(*) FROM sessions '
+                                 'WHERE remote_identity_key IS NOT NULL') \
+            .fetchall() == [(1, )]
+
+
+class TestSchemaMigration(object):
+
+    def setup_method(self, test_method):
+        self.conn = get_test_db_connection()
+        self.conn.executescript(get_database_fixture('omemo_v5.sql'))
+        SQLDatabase(self.conn)
+
+    def query(self, q):
+        return self.conn.execute(q).fetchall()
+
+    def test_migrates_to_latest_version(self):
+        assert self.query('PRAGMA user_version') == [(9, )]
+
+    def test_rows_are_kept(self):
+        assert self.query('SELECT prekey_id FROM prekeys') == [(1, ), (2, )]
+        assert self.query('SELECT recipient_id, device_id, active '
+                          'FROM sessions') == [('bob@builder.org', 42, 0)]
+        assert self.query('SELECT jid, encryption '
+                          'FROM encryption_state') == [('bob@builder.org', 1)]
+        assert len(self.query('SELECT _id FROM identities')) == 2
+
+    def test_signed_prekey_timestamp_is_epoch(self):
+        assert self.query('SELECT timestamp FROM signed_prekeys') == \
+            [(1493640000, )]
+
+    def test_key_tables_have_no_rowid(self):
+        for table in ['prekeys', 'signed_prekeys', 'encryption_state',
+                      'published_nodes', 'devicelists']:
+            with pytest.raises(sqlite3.OperationalError):
+                self.query('SELECT rowid FROM {}'.format(table))
+
+    def test_hot_queries_use_indexes(self):
+        queries = [
+            "SELECT recipient_id FROM sessions WHERE device_id = 42",
+            "SELECT recipient_id, device_id FROM sessions WHERE active = 1",
+            "SELECT public_key FROM identities "
+            "WHERE recipient_id = 'bob@builder.org' AND trust = 1",
+            "SELECT public_key, private_key FROM identities "
+            "WHERE recipient_id = -1"]
+
+        for q in queries:
+            plan = ' '.join(row[-1] for row in
+                            self.query('EXPLAIN QUERY PLAN ' + q))
+            assert 'USING' in plan and 'INDEX' in plan, q
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from profanity_omemo_plugin.prefetch import SessionPrefetcher
+
+
+class RecordingPrefetcher(SessionPrefetcher):
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingPrefetcher, self).__init__(*args, **kwargs)
+        self.missing = {}
+        self.requests = []
+
+    def missing_devices(self, jid):
+        return self.missing.get(jid, [])
+
+    def query_device_list(self, jid):
+        self.requests.append(jid)
+        return True
+
+    def query_bundle(self, jid, device_id):
+        self.requests.append((jid, device_id))
+        return True
+
+
+class TestSessionPrefetcher(object):
+
+    def test_devicelists_before_bundles(self):
+        prefetcher = RecordingPrefetcher(budget=5)
+        prefetcher.missing = {'juliet@capulet.lit': [1, 2],
+                              'tybalt@capulet.lit': [3]}
+
+        prefetcher.add(['juliet@capulet.lit', 'tybalt@capulet.lit'])
+
+        assert prefetcher.run() == 2
+        assert prefetcher.requests == ['juliet@capulet.lit',
+                                       'tybalt@capulet.lit']
+
+        assert prefetcher.run() == 3
+        assert prefetcher.requests[2:] == [('juliet@capulet.lit', 1),
+                                           ('juliet@capulet.lit', 2),
+                                           ('tybalt@capulet.lit', 3)]
+        assert len(prefetcher) == 0
+        assert prefetcher.run() == 0
+
+    def test_requests_per_run_are_limited(self):
+        prefetcher = RecordingPrefetcher(budget=2)
+        prefetcher.missing = {'juliet@capulet.lit': [1, 2, 3]}
+
+        prefetcher.add(['juliet@capulet.lit', 'tybalt@capulet.lit',
+                        'romeo@montague.lit'])
+
+        assert prefetcher.run() == 2
+        assert prefetcher.run() == 2
+        assert prefetcher.requests[2:] == ['romeo@montague.lit',
+                                           ('juliet@capulet.lit', 1)]
+
+    def test_contacts_are_queued_once(self):
+        prefetcher = RecordingPrefetcher()
+
+        prefetcher.add(['juliet@capulet.lit', 'juliet@capulet.lit', None])
+        prefetcher.add(['juliet@capulet.lit'])
+
+        assert prefetcher.run() == 1
+
+    def test_suppressed_requests_do_not_count(self):
+        prefetcher = RecordingPrefetcher(budget=1)
+        prefetcher.query_device_list = lambda jid: False
+
+        prefetcher.add(['juliet@capulet.lit', 'tybalt@capulet.lit'])
+
+        assert prefetcher.run() == 0
+        assert len(prefetcher) == 2
@@ -5,7 +5,7 @@ from __future__ import unicode_literals
 import os
 import sys
 
-from mock import MagicMock, patch
+from mock import ANY, MagicMock, patch
 
 here = os.path.abspath(os.path.dirname(__file__))
 deploy_root = os.path.join(here, '..', 'deploy')
@@ -15,7 +15,9 @@ sys.path.append(deploy_root)
 sys.modules['prof'] = MagicMock()
 import prof_omemo_plugin as plugin
 from profanity_omemo_plugin.constants import NS_OMEMO, NS_DEVICE_LIST
+from profanity_omemo_plugin.omemo.state import OmemoState
 from profanity_omemo_plugin.prof_omemo_state import ProfActiveOmemoChats, ProfOmemoUser
+from .fixtures import DummyPlugin, get_test_db_connection
 
 
 class TestPluginHooks(object):
@@ -30,6 +32,11 @@ class TestPluginHooks(object):
     def teardown_method(self, test_method):
         ProfActiveOmemoChats.reset()
         ProfOmemoUser.reset()
+        plugin._requests.clear()
+        plugin._prefetcher.clear()
+        plugin._announcer.clear()
+        plugin._pending_publishes.clear()
+        plugin._init_pending = False
 
     def test_ensure_valid_stanza(self):
         assert plugin.send_stanza(None) is False
@@ -183,3 +190,290 @@ class TestPluginHooks(object):
         stanza = '<message to="{}"></message>'.format(recipient)
 
         assert func(stanza) == 'enabled_first'
+
+    @patch('prof_omemo_plugin._announce_own_bundle')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_maintenance_announces_changed_bundle_once(self, state_mock,
+                                                       announce_mock):
+        state_mock.return_value.rotate_signed_prekey_if_due.return_value = True
+        state_mock.return_value.checkPreKeyAmount.return_value = [object()]
+
+        plugin._run_maintenance()
+
+        announce_mock.assert_called_once_with()
+
+    @patch('prof_omemo_plugin._announce_own_bundle')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_maintenance_skips_unchanged_bundle(self, state_mock,
+                                                announce_mock):
+        state_mock.return_value.rotate_signed_prekey_if_due.return_value = False
+        state_mock.return_value.checkPreKeyAmount.return_value = []
+
+        plugin._run_maintenance()
+
+        assert not announce_mock.called
+
+    @patch('prof_omemo_plugin.set_log_level')
+    @patch('prof.settings_string_set')
+    def test_set_log_level(self, settings_string_set, set_log_level):
+        plugin._parse_args('set', 'log_level', 'DEBUG')
+
+        set_log_level.assert_called_once_with('DEBUG')
+        settings_string_set.assert_called_once_with('omemo', 'log_level',
+                                                    'debug')
+
+    @patch('prof.settings_string_set')
+    def test_set_unknown_log_level_is_not_stored(self, settings_string_set):
+        plugin._parse_args('set', 'log_level', 'verbose')
+
+        assert not settings_string_set.called
+
+    @patch('prof_omemo_plugin.os.path.isdir')
+    @patch('prof_omemo_plugin.dump_log')
+    def test_log_dump(self, dump_log, isdir):
+        isdir.return_value = True
+        dump_log.return_value = 10
+
+        plugin._parse_args('log', 'dump', '10')
+
+        dump_log.assert_called_once_with(plugin.OMEMO_LOG_DUMP_PATH, 10)
+
+    @patch('prof_omemo_plugin._query_bundle_info_for')
+    @patch('prof_omemo_plugin._message_store')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_message_is_queued_without_sessions(self, state_mock, store_mock,
+                                                query_mock):
+        recipient = 'juliet@capulet.lit'
+        ProfActiveOmemoChats.add(recipient)
+        state_mock.return_value.devices_without_sessions.side_effect = [
+            [4711], []]
+
+        with patch('prof.settings_boolean_get', return_value=True):
+            result = plugin.prof_pre_chat_message_send(recipient, 'Hello')
+
+        assert result is None
+        query_mock.assert_called_once_with(recipient, 4711)
+        queued = store_mock.add.call_args[0][0]
+        assert queued['to'] == recipient
+        assert queued['message'] == 'Hello'
+
+    @patch('prof_omemo_plugin._query_device_list')
+    @patch('prof_omemo_plugin._query_bundle_info_for')
+    @patch('prof_omemo_plugin._message_store')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_has_session_decorator_queues_message_without_sessions(
+            self, state_mock, store_mock, query_mock, devicelist_mock):
+        recipient = 'juliet@capulet.lit'
+        ProfActiveOmemoChats.add(recipient)
+        state_mock.return_value.devices_without_sessions.side_effect = [
+            [4711], []]
+
+        func = MagicMock()
+        wrapped = plugin.require_sessions_for_all_devices('to')(func)
+        stanza = ('<message to="{0}/balcony" id="1" type="chat">'
+                  '<body>Hello</body></message>').format(recipient)
+
+        assert wrapped(stanza) is None
+        assert not func.called
+        query_mock.assert_called_once_with(recipient, 4711)
+        queued = store_mock.add.call_args[0][0]
+        assert queued['to'] == recipient
+        assert queued['message'] == 'Hello'
+
+    @patch('prof_omemo_plugin.send_stanza')
+    def test_duplicate_bundle_request_is_suppressed(self, send_mock):
+        send_mock.return_value = True
+
+        assert plugin._query_bundle_info_for('juliet@capulet.lit', 4711)
+        assert not plugin._query_bundle_info_for('juliet@capulet.lit', 4711)
+
+        assert send_mock.call_count == 1
+
+    @patch('prof_omemo_plugin._handle_bundle_update')
+    @patch('prof_omemo_plugin.send_stanza')
+    def test_bundle_response_is_dispatched_by_id(self, send_mock,
+                                                 handle_mock):
+        plugin._query_bundle_info_for('juliet@capulet.lit', 4711)
+        req_id = plugin.xmpp.stanza_as_xml(send_mock.call_args[0][0]).attrib['id']
+
+        response = ('<iq type="result" from="juliet@capulet.lit" id="{0}">'
+                    '</iq>').format(req_id)
+
+        with patch('prof.settings_boolean_get', return_value=True):
+            assert plugin.prof_on_iq_stanza_receive(response) is False
+
+        handle_mock.assert_called_once_with(
+            ANY, sender='juliet@capulet.lit', device_id=4711)
+        assert plugin._requests.lookup(req_id) is None
+
+    @patch('prof_omemo_plugin._handle_bundle_update')
+    @patch('prof_omemo_plugin.send_stanza')
+    def test_error_response_backs_off(self, send_mock, handle_mock):
+        plugin._query_bundle_info_for('juliet@capulet.lit', 4711)
+        req_id = plugin.xmpp.stanza_as_xml(send_mock.call_args[0][0]).attrib['id']
+
+        response = ('<iq type="error" from="juliet@capulet.lit" id="{0}">'
+                    '</iq>').format(req_id)
+
+        with patch('prof.settings_boolean_get', return_value=True):
+            assert plugin.prof_on_iq_stanza_receive(response) is False
+
+        assert not handle_mock.called
+        assert not plugin._query_bundle_info_for('juliet@capulet.lit', 4711)
+
+    @patch('prof_omemo_plugin.send_stanza')
+    def test_response_from_other_sender_is_not_correlated(self, send_mock):
+        plugin._query_bundle_info_for('juliet@capulet.lit', 4711)
+        req_id = plugin.xmpp.stanza_as_xml(send_mock.call_args[0][0]).attrib['id']
+
+        response = ('<iq type="result" from="tybalt@capulet.lit" id="{0}">'
+                    '</iq>').format(req_id)
+
+        with patch('prof.settings_boolean_get', return_value=True):
+            assert plugin.prof_on_iq_stanza_receive(response) is True
+
+        assert plugin._requests.lookup(req_id) is not None
+
+    @patch('prof_omemo_plugin.send_stanza')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    @patch('prof.settings_string_list_get')
+    def test_prefetch_queues_known_contacts(self, sessions_setting,
+                                            state_mock, send_mock):
+        send_mock.return_value = True
+        sessions_setting.return_value = ['juliet@capulet.lit']
+        state = OmemoState('me@there.com', get_test_db_connection(),
+                           'me@there.com', DummyPlugin())
+        state.set_devices('tybalt@capulet.lit', [1, 2])
+        state.set_devices('juliet@capulet.lit', [3])
+        state_mock.return_value = state
+
+        plugin._start_prefetch()
+
+        assert list(plugin._prefetcher._devicelists) == [
+            'me@there.com', 'juliet@capulet.lit', 'tybalt@capulet.lit']
+
+        assert plugin._prefetcher.run() == 3
+        assert send_mock.call_count == 3
+
+    @patch('prof_omemo_plugin._scheduler')
+    def test_stanzas_are_sent_by_scheduler(self, scheduler_mock):
+        assert plugin.send_stanza('<iq></iq>', priority=plugin.PRIORITY_CHAT)
+
+        scheduler_mock.send.assert_called_once_with('<iq></iq>',
+                                                    plugin.PRIORITY_CHAT)
+
+    @patch('prof_omemo_plugin._finish_init')
+    @patch('prof_omemo_plugin._announce_own_bundle')
+    @patch('prof_omemo_plugin._query_device_list')
+    def test_init_waits_for_own_devicelist(self, query_mock, announce_mock,
+                                           finish_mock):
+        query_mock.return_value = True
+
+        plugin._init_omemo()
+
+        query_mock.assert_called_once_with('me@there.com')
+        assert plugin._init_pending
+        assert not announce_mock.called
+        assert not finish_mock.called
+
+    @patch('prof_omemo_plugin._get_omemo_prefetch_setting')
+    @patch('prof_omemo_plugin._announce_own_devicelist')
+    @patch('prof_omemo_plugin._announce_own_bundle')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_finish_init_with_published_device(self, state_mock,
+                                               announce_mock,
+                                               devicelist_mock,
+                                               prefetch_setting):
+        prefetch_setting.return_value = False
+        state_mock.return_value.own_device_id_published.return_value = True
+        plugin._init_pending = True
+
+        plugin._finish_init(True)
+        plugin._finish_init(True)
+
+        announce_mock.assert_called_once_with(force=False)
+        assert not devicelist_mock.called
+
+    @patch('prof_omemo_plugin._get_omemo_prefetch_setting')
+    @patch('prof_omemo_plugin._announce_own_devicelist')
+    @patch('prof_omemo_plugin._announce_own_bundle')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_finish_init_without_devicelist(self, state_mock, announce_mock,
+                                            devicelist_mock,
+                                            prefetch_setting):
+        prefetch_setting.return_value = False
+        plugin._init_pending = True
+
+        plugin._finish_init(False)
+
+        devicelist_mock.assert_called_once_with()
+        announce_mock.assert_called_once_with(force=True)
+
+    @patch('prof_omemo_plugin.send_stanza')
+    @patch('prof_omemo_plugin.xmpp.own_bundle_hash', return_value='abc')
+    @patch('prof_omemo_plugin.xmpp.own_bundle_node', return_value='bundle')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_unchanged_bundle_is_not_published(self, state_mock, node_mock,
+                                               hash_mock, send_mock):
+        state_mock.return_value.store.getPublishedHash.return_value = 'abc'
+
+        plugin._announce_own_bundle(force=False)
+
+        assert not send_mock.called
+
+    @patch('prof_omemo_plugin.send_stanza')
+    @patch('prof_omemo_plugin.xmpp.create_own_bundle_stanza')
+    @patch('prof_omemo_plugin.xmpp.own_bundle_hash', return_value='abc')
+    @patch('prof_omemo_plugin.xmpp.own_bundle_node', return_value='bundle')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_bundle_hash_is_stored_on_publish_result(self, state_mock,
+                                                     node_mock, hash_mock,
+                                                     create_mock, send_mock):
+        state_mock.return_value.store.getPublishedHash.return_value = 'old'
+
+        plugin._announce_own_bundle(force=False)
+
+        req_id = create_mock.call_args[1]['req_id']
+        assert not state_mock.return_value.store.setPublishedHash.called
+
+        response = '<iq type="result" id="{0}"></iq>'.format(req_id)
+        with patch('prof.settings_boolean_get', return_value=True):
+            assert plugin.prof_on_iq_stanza_receive(response) is False
+
+        state_mock.return_value.store.setPublishedHash.assert_called_once_with(
+            'bundle', 'abc')
+
+    @patch('prof_omemo_plugin.add_recipient_to_completer')
+    @patch('prof_omemo_plugin._announce_own_devicelist')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_devicelist_updates_announce_once(self, state_mock,
+                                              announce_mock, completer_mock):
+        state_mock.return_value.own_jid = 'me@there.com'
+        state_mock.return_value.device_list_for.return_value = set()
+        state_mock.return_value.own_device_id_published.return_value = False
+
+        for contact in ['juliet@capulet.lit', 'tybalt@capulet.lit']:
+            update = ('<iq type="result" from="{0}"><pubsub><items>'
+                      '<item><list><device id="1" /></list></item>'
+                      '</items></pubsub></iq>').format(contact)
+            plugin._handle_devicelist_update(update)
+
+        announce_mock.assert_called_once_with()
+
+    @patch('prof_omemo_plugin._finish_init')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    @patch('prof_omemo_plugin.send_stanza')
+    def test_maintenance_waits_for_pending_devicelist(self, send_mock,
+                                                      state_mock, finish_mock):
+        state_mock.return_value.rotate_signed_prekey_if_due.return_value = False
+        state_mock.return_value.checkPreKeyAmount.return_value = []
+        send_mock.return_value = True
+        plugin._init_pending = True
+        assert plugin._query_device_list('me@there.com')
+
+        plugin._run_maintenance()
+        assert not finish_mock.called
+
+        plugin._requests.clear()
+        plugin._run_maintenance()
+        finish_mock.assert_called_once_with(False)
@@ -1,15 +1,9 @@
-import sqlite3
-
 import pytest
 from mock import patch
 
 from profanity_omemo_plugin.prof_omemo_state import ProfOmemoUser, \
     ProfOmemoState, ProfActiveOmemoChats
-
-
-def get_test_db_connection():
-    print('Using In-Memory Database')
-    return sqlite3.connect(':memory:', check_same_thread=False)
+from .fixtures import get_test_db_connection
 
 
 class TestProfOmemoUtils(object):
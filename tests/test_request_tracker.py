@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from profanity_omemo_plugin.request_tracker import RequestTracker
+
+
+class TestRequestTracker(object):
+
+    def test_duplicate_request_is_suppressed(self):
+        tracker = RequestTracker(timeout=30)
+
+        req_id = tracker.start('juliet@capulet.lit', 4711, now=100)
+
+        assert req_id is not None
+        assert tracker.start('juliet@capulet.lit', 4711, now=110) is None
+        assert tracker.start('juliet@capulet.lit', 4712, now=110) is not None
+        assert tracker.start('juliet@capulet.lit', now=110) is not None
+
+    def test_response_is_matched_by_id(self):
+        tracker = RequestTracker()
+        req_id = tracker.start('juliet@capulet.lit', 4711)
+
+        assert tracker.resolve('unknown') is None
+
+        request = tracker.resolve(req_id)
+        assert request.id == req_id
+        assert (request.jid, request.device_id) == ('juliet@capulet.lit', 4711)
+        assert ('juliet@capulet.lit', 4711) not in tracker
+        assert tracker.start('juliet@capulet.lit', 4711) is not None
+
+    def test_unanswered_requests_back_off_exponentially(self):
+        tracker = RequestTracker(timeout=30, backoff=60, max_backoff=200)
+        jid = 'juliet@capulet.lit'
+
+        tracker.start(jid, 4711, now=0)
+        assert tracker.expire(now=30) == 1
+
+        # first failure: wait 60 seconds
+        assert tracker.start(jid, 4711, now=89) is None
+        assert tracker.start(jid, 4711, now=90) is not None
+
+        # second failure, detected on the next attempt: wait 120 seconds
+        assert tracker.start(jid, 4711, now=120) is None
+        assert tracker.start(jid, 4711, now=239) is None
+        assert tracker.start(jid, 4711, now=240) is not None
+
+        # the delay is capped
+        tracker.expire(now=270)
+        assert tracker.start(jid, 4711, now=469) is None
+        assert tracker.start(jid, 4711, now=470) is not None
+
+    def test_answer_resets_backoff(self):
+        tracker = RequestTracker(timeout=30, backoff=60)
+        jid = 'juliet@capulet.lit'
+
+        tracker.start(jid, 4711, now=0)
+        tracker.expire(now=30)
+        req_id = tracker.start(jid, 4711, now=90)
+        tracker.resolve(req_id)
+
+        assert tracker.start(jid, 4711, now=91) is not None
+
+    def test_forget_allows_request(self):
+        tracker = RequestTracker()
+        tracker.start('juliet@capulet.lit')
+
+        tracker.forget('juliet@capulet.lit')
+
+        assert tracker.start('juliet@capulet.lit') is not None
+
+    def test_request_context(self):
+        tracker = RequestTracker()
+        req_id = tracker.start('juliet@capulet.lit', 4711,
+                               requester='romeo@montague.lit', now=100)
+
+        request = tracker.lookup(req_id)
+
+        assert request.requester == 'romeo@montague.lit'
+        assert request.jid == 'juliet@capulet.lit'
+        assert request.device_id == 4711
+        assert request.sent == 100
+        assert tracker.lookup('unknown') is None
+
+    def test_error_response_backs_off(self):
+        tracker = RequestTracker(backoff=60)
+        req_id = tracker.start('juliet@capulet.lit', now=0)
+
+        tracker.resolve(req_id, error=True, now=10)
+
+        assert tracker.lookup(req_id) is None
+        assert tracker.start('juliet@capulet.lit', now=69) is None
+        assert tracker.start('juliet@capulet.lit', now=70) is not None
+
+    def test_expired_requests_are_removed(self):
+        tracker = RequestTracker(timeout=30)
+        req_id = tracker.start('juliet@capulet.lit', now=0)
+
+        tracker.expire(now=30)
+
+        assert tracker.lookup(req_id) is None
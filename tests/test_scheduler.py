@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from profanity_omemo_plugin.scheduler import (PRIORITY_BACKGROUND,
+                                              PRIORITY_CHAT, PRIORITY_SESSION,
+                                              OutboundScheduler, TokenBucket)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingScheduler(OutboundScheduler):
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingScheduler, self).__init__(*args, **kwargs)
+        self.posted = []
+
+    def post(self, stanza):
+        self.posted.append(stanza)
+
+
+class TestTokenBucket(object):
+
+    def test_bucket_refills_at_rate(self):
+        clock = Clock()
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+
+        assert bucket.take()
+        assert bucket.take()
+        assert not bucket.take()
+
+        clock.now += 0.5
+        assert bucket.take()
+        assert not bucket.take()
+
+        # the bucket never holds more than its capacity
+        clock.now += 60
+        assert [bucket.take() for _ in range(3)] == [True, True, False]
+
+
+class TestOutboundScheduler(object):
+
+    def test_stanzas_are_sent_immediately_within_burst(self):
+        scheduler = RecordingScheduler(rate=1, burst=2, clock=Clock())
+
+        scheduler.send('<iq id="1"/>')
+        scheduler.send('<iq id="2"/>')
+
+        assert scheduler.posted == ['<iq id="1"/>', '<iq id="2"/>']
+        assert len(scheduler) == 0
+
+    def test_queued_stanzas_are_sent_by_priority(self):
+        clock = Clock()
+        scheduler = RecordingScheduler(rate=1, burst=1, clock=clock)
+
+        scheduler.send('background 1', PRIORITY_BACKGROUND)
+        scheduler.send('background 2', PRIORITY_BACKGROUND)
+        scheduler.send('session', PRIORITY_SESSION)
+        scheduler.send('chat', PRIORITY_CHAT)
+
+        assert scheduler.posted == ['background 1']
+        assert len(scheduler) == 3
+
+        clock.now += 3
+        assert scheduler.drain() == 1
+        clock.now += 1
+        scheduler.drain()
+        clock.now += 1
+        scheduler.drain()
+
+        assert scheduler.posted == ['background 1', 'chat', 'session',
+                                    'background 2']
+
+    def test_metrics(self):
+        clock = Clock()
+        scheduler = RecordingScheduler(rate=1, burst=1, clock=clock)
+
+        scheduler.send('chat 1', PRIORITY_CHAT)
+        scheduler.send('chat 2', PRIORITY_CHAT)
+        scheduler.send('chat 3', PRIORITY_CHAT)
+        clock.now += 2
+        scheduler.drain()
+
+        chat = scheduler.stats()[PRIORITY_CHAT]
+        assert chat['name'] == 'chat'
+        assert chat['sent'] == 2
+        assert chat['depth'] == 1
+        assert chat['max_depth'] == 2
+        assert chat['max_wait'] == 2
+        assert chat['avg_wait'] == 1
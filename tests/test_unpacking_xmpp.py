@@ -2,8 +2,6 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import sqlite3
-
 import pytest
 from mock import patch
 
@@ -11,15 +9,23 @@ import profanity_omemo_plugin.xmpp as xmpp
 from profanity_omemo_plugin.constants import NS_DEVICE_LIST, NS_OMEMO
 from profanity_omemo_plugin.prof_omemo_state import ProfOmemoUser, \
     ProfOmemoState
-from .fixtures import get_stanza_fixture
+from .fixtures import get_stanza_fixture, get_test_db_connection
+
 
+class TestUnpackingXMPP(object):
 
-def get_test_db_connection():
-    print('Using In-Memory Database')
-    return sqlite3.connect(':memory:', check_same_thread=False)
+    def test_stanza_is_parsed_once(self):
+        stanza = xmpp.Stanza('<message to="juliet@capulet.lit" id="1">'
+                             '<body>Hello</body></message>')
 
+        with patch.object(xmpp, 'stanza_as_xml',
+                          wraps=xmpp.stanza_as_xml) as parse_mock:
+            assert xmpp.get_root_attrib(stanza, 'to') == 'juliet@capulet.lit'
+            assert xmpp.get_recipient(stanza) == 'juliet@capulet.lit'
+            assert xmpp.stanza_is_valid_xml(stanza)
+            assert xmpp.is_xmpp_plaintext_message(stanza)
 
-class TestUnpackingXMPP(object):
+        assert parse_mock.call_count == 1
 
     def test_unpack_bundle_info(self):
         stanza = get_stanza_fixture('iq_bundle_info.xml')
@@ -28,6 +34,26 @@ class TestUnpackingXMPP(object):
         assert bundle_info.get('sender') == 'bob@secure.it'
         assert bundle_info.get('device') == '666666'
 
+    def test_unpack_bundle_info_with_known_sender(self):
+        stanza = get_stanza_fixture('iq_bundle_info.xml')
+        bundle_info = xmpp.unpack_bundle_info(stanza, sender='carol@secure.it',
+                                              device_id=4711)
+
+        assert bundle_info.get('sender') == 'carol@secure.it'
+        assert bundle_info.get('device') == 4711
+
+    def test_root_attributes(self):
+        stanza = xmpp.Stanza('<iq type="result" id="req-1" from="bob@secure.it">'
+                             '<pubsub xmlns="http://jabber.org/protocol/pubsub"/>'
+                             '</iq>')
+
+        with patch.object(xmpp, 'stanza_as_xml') as parse_mock:
+            assert stanza.root == {'type': 'result', 'id': 'req-1',
+                                   'from': 'bob@secure.it'}
+
+        assert not parse_mock.called
+        assert xmpp.root_attributes('<iq') == {}
+
     def test_unpack_bundle_info_chatsecure(self):
         stanza = get_stanza_fixture('iq_bundle_info_chatsecure.xml')
         bundle_info = xmpp.unpack_bundle_info(stanza)
@@ -133,4 +159,66 @@ class TestUnpackingXMPP(object):
                       '</message>'
                       ).format(recipient)
 
-        encrypted = xmpp.encrypt_stanza(raw_stanza)
\ No newline at end of file
+        encrypted = xmpp.encrypt_stanza(raw_stanza)
+
+
+class TestStanzaClassifier(object):
+
+    def test_plaintext_mentioning_encrypted(self):
+        stanza = ('<message to="juliet@capulet.lit" type="chat">'
+                  '<body>Is this encrypted?</body></message>')
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_OTHER
+        assert not xmpp.is_encrypted_message(stanza)
+
+    def test_omemo_message(self):
+        stanza = ('<message xmlns="jabber:client" type="chat">'
+                  '<body>I sent you an OMEMO encrypted message.</body>'
+                  '<encrypted xmlns="{0}"><header sid="1"/></encrypted>'
+                  '</message>').format(NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_OMEMO_MESSAGE
+
+    def test_carbon_copied_omemo_message(self):
+        stanza = ('<message xmlns="jabber:client" type="chat">'
+                  '<received xmlns="urn:xmpp:carbons:2">'
+                  '<forwarded xmlns="urn:xmpp:forward:0">'
+                  '<message xmlns="jabber:client" type="chat">'
+                  '<encrypted xmlns="{0}"><header sid="1"/></encrypted>'
+                  '</message></forwarded></received></message>'
+                  ).format(NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_OMEMO_MESSAGE
+
+    def test_devicelist_event(self):
+        stanza = ('<message from="juliet@capulet.lit" type="headline">'
+                  '<event xmlns="http://jabber.org/protocol/pubsub#event">'
+                  '<items node="{0}"><item><list xmlns="{1}">'
+                  '<device id="12345"/></list></item></items>'
+                  '</event></message>').format(NS_DEVICE_LIST, NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_DEVICELIST
+
+    def test_bundle_result(self):
+        for name in ['iq_bundle_info.xml', 'iq_bundle_info_chatsecure.xml']:
+            stanza = get_stanza_fixture(name)
+
+            assert xmpp.classify_stanza(stanza) == xmpp.STANZA_BUNDLE
+
+    def test_other_stanzas(self):
+        stanzas = ['<presence from="juliet@capulet.lit"/>',
+                   '<iq type="result" id="1"/>',
+                   '<iq type="error"><pubsub xmlns="http://jabber.org/'
+                   'protocol/pubsub"><items node="{0}"/></pubsub></iq>'
+                   .format(NS_DEVICE_LIST),
+                   '<message><body>not well formed',
+                   None]
+
+        for stanza in stanzas:
+            assert xmpp.classify_stanza(stanza) == xmpp.STANZA_OTHER
+
+    def test_parsing_stops_when_kind_is_known(self):
+        stanza = ('<message><encrypted xmlns="{0}"/>'
+                  '<unclosed>').format(NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_OMEMO_MESSAGE
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from mock import patch
+
+from profanity_omemo_plugin.weak_message_store import WeakMessageStore
+
+
+class RecordingMessageStore(WeakMessageStore):
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingMessageStore, self).__init__(*args, **kwargs)
+        self.missing = {}
+        self.posted = []
+        self.timed_out = []
+
+    def missing_devices(self, recipient):
+        return self.missing.get(recipient, [])
+
+    def encrypt(self, message_dict):
+        return '<message>{0}</message>'.format(message_dict['message'])
+
+    def post_message(self, stanza, message_dict):
+        self.posted.append(stanza)
+
+    def on_timeout(self, message_dict):
+        self.timed_out.append(message_dict['message'])
+
+
+def message(text, to='juliet@capulet.lit', timestamp=None):
+    message_dict = {'from': 'romeo@montague.lit/profanity',
+                    'to': to,
+                    'message': text}
+    if timestamp is not None:
+        message_dict['timestamp'] = timestamp
+    return message_dict
+
+
+class TestWeakMessageStore(object):
+
+    def test_message_is_posted_immediately_with_sessions(self):
+        store = RecordingMessageStore()
+
+        store.add(message('Hello'))
+
+        assert store.posted == ['<message>Hello</message>']
+        assert len(store) == 0
+
+    def test_messages_are_posted_in_order_once_sessions_exist(self):
+        store = RecordingMessageStore()
+        store.missing['juliet@capulet.lit'] = [4711]
+
+        store.add(message('First'))
+        store.add(message('Second'))
+        store.add(message('Other', to='tybalt@capulet.lit'))
+
+        assert store.posted == ['<message>Other</message>']
+        assert store.has_messages_for('juliet@capulet.lit')
+
+        store.missing = {}
+        assert store.trigger() == 2
+
+        assert store.posted[1:] == ['<message>First</message>',
+                                    '<message>Second</message>']
+        assert not store.has_messages_for('juliet@capulet.lit')
+
+    def test_oldest_message_is_dropped_on_overflow(self):
+        store = RecordingMessageStore(max_size=2)
+        store.missing['juliet@capulet.lit'] = [4711]
+
+        for text in ('1', '2', '3'):
+            store.add(message(text))
+
+        assert store.timed_out == ['1']
+        assert len(store) == 2
+
+    def test_expired_messages_are_reported(self):
+        store = RecordingMessageStore(timeout=60)
+        store.missing['juliet@capulet.lit'] = [4711]
+
+        store.add(message('Old', timestamp=100))
+        store.add(message('New', timestamp=150))
+
+        assert store.expire(now=200) == 1
+        assert store.timed_out == ['Old']
+        assert len(store) == 1
+
+    def test_failed_encryption_keeps_the_message(self):
+        store = RecordingMessageStore()
+
+        with patch.object(store, 'encrypt', side_effect=Exception):
+            store.add(message('Hello'))
+
+        assert store.posted == []
+        assert len(store) == 1